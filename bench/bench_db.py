@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+# قياس زمن استجابة المعالجات (p50/p95/p99) تحت حمل متزامن قبل وبعد طبقة
+# قاعدة البيانات غير الحاجبة. "قبل" = sqlite3 متزامن على حلقة الأحداث مع اتصال
+# جديد لكل استدعاء (كما كان bot.py)، و"بعد" = bot.db.
+#
+#   python bench/bench_db.py --items 200000 --rate 100 --duration 10
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+from contextlib import closing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CATS = ["file", "image", "video", "audio", "app"]
+
+
+def seed(con: sqlite3.Connection, n_items: int, n_users: int):
+    # اتصال من bot.db_connect() لأن مشغّلات فهرس البحث تحتاج الدالة ar_norm
+    with closing(con), con:
+        con.executemany(
+            "INSERT OR IGNORE INTO users(user_id, full_name, is_registered, is_mod, created_at) VALUES(?,?,1,?,?)",
+            ((uid, f"user {uid}", int(uid % 50 == 0), "2024-01-01T00:00:00") for uid in range(1, n_users + 1)),
+        )
+        con.executemany(
+            "INSERT INTO items(type, file_id, name, caption, uploader_id, status, created_at, deleted_at) "
+            "VALUES(?,?,?,?,?,?,?,?)",
+            ((CATS[i % 5], f"F{i}", f"name {i}", f"caption {i}", i % n_users + 1,
+              "trashed" if i % 20 == 0 else "active",
+              "2024-01-01T%02d:%02d:%02d" % (i // 3600 % 24, i // 60 % 60, i % 60),
+              "2024-02-01T%02d:%02d:%02d" % (i // 3600 % 24, i // 60 % 60, i % 60) if i % 20 == 0 else None)
+             for i in range(n_items)),
+        )
+
+
+def percentile(samples, p):
+    s = sorted(samples)
+    return s[min(len(s) - 1, int(round(p / 100 * (len(s) - 1))))]
+
+
+# ---- التنفيذ القديم: اتصال جديد لكل استدعاء وعلى حلقة الأحداث مباشرة ----
+def make_legacy(path: str, page_size: int):
+    async def is_mod(uid):
+        with closing(sqlite3.connect(path)) as con:
+            row = con.execute("SELECT is_mod FROM users WHERE user_id=?", (uid,)).fetchone()
+        return bool(row and row[0])
+
+    async def list_page(cat):
+        with closing(sqlite3.connect(path)) as con:
+            return con.execute(
+                "SELECT id, name, caption, file_id, type FROM items WHERE status='active' AND type=? "
+                "ORDER BY created_at DESC LIMIT ?", (cat, page_size + 1)).fetchall()
+
+    async def search(kw):
+        kw = f"%{kw.lower()}%"
+        with closing(sqlite3.connect(path)) as con:
+            return con.execute(
+                "SELECT id, type, name, caption FROM items WHERE status='active' AND "
+                "(LOWER(COALESCE(name,'')) LIKE ? OR LOWER(COALESCE(caption,'')) LIKE ?) "
+                "ORDER BY created_at DESC LIMIT 25", (kw, kw)).fetchall()
+
+    return is_mod, list_page, search
+
+
+def make_current(bot):
+    return bot.user_is_mod, bot.fetch_items, bot.search_items
+
+
+async def run_load(is_mod, list_page, search, rate: float, duration: float, search_every: int, n_users: int):
+    # حمل مفتوح: التحديثات تصل بمعدل ثابت بغض النظر عن انشغال الحلقة، والزمن
+    # يُقاس من لحظة الوصول المجدولة (وإلا لاختفى زمن الانتظار خلف الحلقة المحجوبة).
+    latencies = {"list": [], "search": []}
+    rnd = random.Random(1)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    tasks = []
+
+    async def handle(kind, arrival, arg):
+        if kind == "search":
+            await search(arg)
+        else:
+            await is_mod(rnd.randint(1, n_users))
+            await list_page(arg)
+        latencies[kind].append(loop.time() - arrival)
+
+    total = int(rate * duration)
+    for i in range(total):
+        arrival = start + i / rate
+        delay = arrival - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if search_every and i % search_every == 0:
+            tasks.append(asyncio.ensure_future(handle("search", arrival, f"no-such-word-{i}")))  # مسح كامل
+        else:
+            tasks.append(asyncio.ensure_future(handle("list", arrival, rnd.choice(CATS))))
+    await asyncio.gather(*tasks)
+    return latencies, loop.time() - start
+
+
+def report(label, latencies, elapsed):
+    for kind, samples in latencies.items():
+        if not samples:
+            continue
+        ms = [x * 1000 for x in samples]
+        print(f"{label:7} {kind:7} n={len(ms):6d}  thr={len(ms) / elapsed:7.1f}/s  "
+              f"p50={percentile(ms, 50):8.2f}ms  p95={percentile(ms, 95):8.2f}ms  "
+              f"p99={percentile(ms, 99):8.2f}ms  mean={statistics.mean(ms):8.2f}ms")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--items", type=int, default=200_000)
+    ap.add_argument("--users", type=int, default=1_000)
+    ap.add_argument("--rate", type=float, default=100.0, help="تحديثات في الثانية")
+    ap.add_argument("--duration", type=float, default=10.0, help="ثوانٍ لكل تشغيل")
+    ap.add_argument("--search-every", type=int, default=50, help="بحث LIKE كامل كل N تحديث (0 = بلا)")
+    args = ap.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="bench-db-")
+    os.environ["DB_PATH"] = os.path.join(tmp, "storage.db")
+    sys.path.insert(0, ROOT)
+    import bot  # noqa: E402  (يجب ضبط DB_PATH قبل الاستيراد)
+
+    seed(bot.db_connect(), args.items, args.users)
+    print(f"items={args.items} rate={args.rate}/s duration={args.duration}s search-every={args.search_every}")
+    loop = asyncio.new_event_loop()
+    for label, fns in (("before", make_legacy(os.environ["DB_PATH"], bot.PAGE_SIZE)),
+                       ("after", make_current(bot))):
+        lat, elapsed = loop.run_until_complete(
+            run_load(*fns, args.rate, args.duration, args.search_every, args.users))
+        report(label, lat, elapsed)
+    bot.db.close()
+    loop.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+# حمل شامل دون إنترنت: خادم Bot API وهمي (aiohttp) على 127.0.0.1 يستقبل طلبات
+# bot.bot عبر BOT_API_SERVER، وكتالوج مُولَّد بالحجم المطلوب، ومستخدمون افتراضيون
+# يمررون سيناريوهات مكتوبة (تصفح، تنقل بين الصفحات، بحث، رفع، حذف نهائي من السلة)
+# عبر dp.process_update كما يصلها التحديث من تيليجرام. كل مستخدم يقرأ الأزرار
+# من آخر رسالة أرسلها له البوت ويضغط أحدها، فالمؤشرات والمعرّفات حقيقية.
+# النتيجة: الإنتاجية وp50/p95/p99 لكل معالج في ملف JSON، و--compare يقارن بتشغيل سابق.
+#
+#   python bench/bench_harness.py --items 100000 --concurrency 50 --duration 20 --out run.json
+#   python bench/bench_harness.py --db /tmp/cat-5m.db --items 5000000 --compare run.json
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict, deque
+from itertools import count, islice
+
+import aiohttp
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_db import CATS, percentile, seed  # noqa: E402
+
+TOKEN = "123456:BENCH-harness-token-000000000000000"
+DEFAULT_MIX = "browse=40,paginate=25,search=20,upload=10,purge=5"
+
+
+class FakeBotAPI:
+    # يرد على كل طريقة بما يكفي لـ aiogram، ويحفظ آخر لوحة أزرار لكل محادثة
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.markups = {}
+        self._msg_id = count(1)
+        self._runner = None
+        self.url = None
+        self.updates = deque()      # ما يسلّمه getUpdates للاستطلاع
+        self._new_updates = asyncio.Event()
+
+    def feed(self, updates: list):
+        self.updates.extend(updates)
+        self._new_updates.set()
+
+    async def get_updates(self, data):
+        offset = int(data.get("offset") or 0)
+        while self.updates and self.updates[0]["update_id"] < offset:
+            self.updates.popleft()
+        if not self.updates and float(data.get("timeout") or 0):
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), float(data["timeout"]))
+            except asyncio.TimeoutError:
+                pass
+        return list(islice(self.updates, int(data.get("limit") or 100)))
+
+    def _message(self, chat_id, data):
+        msg = {"message_id": next(self._msg_id), "date": int(time.time()),
+               "chat": {"id": int(chat_id) if str(chat_id).lstrip("-").isdigit() else -1, "type": "private"}}
+        if data.get("text"):
+            msg["text"] = data["text"]
+        if data.get("reply_markup"):
+            msg["reply_markup"] = json.loads(data["reply_markup"])
+            self.markups[str(chat_id)] = msg["reply_markup"]
+        return msg
+
+    async def handle(self, request: web.Request):
+        method = request.match_info["method"]
+        data = dict(await request.post())
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method in ("answerCallbackQuery", "deleteMessage", "deleteWebhook", "setWebhook"):
+            result = True
+        elif method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method == "getUpdates":
+            result = await self.get_updates(data)
+        elif method == "getFile":
+            result = {"file_id": data["file_id"], "file_unique_id": "u-" + data["file_id"], "file_size": 1}
+        elif method == "sendMediaGroup":
+            result = [self._message(data["chat_id"], {}) for _ in json.loads(data["media"])]
+        else:
+            result = self._message(data.get("chat_id", -1), data)
+        return web.json_response({"ok": True, "result": result})
+
+    async def deliver(self, url: str, updates: list, connections: int) -> int:
+        # مثل تيليجرام مع webhook: حتى connections طلبًا متزامنًا، كل اتصال يرسل التحديث
+        # التالي بعد رد الخادم، وما يُرد بغير 200 يُعاد إرساله. يعيد عدد الرفض.
+        pending = deque(updates)
+        rejected = 0
+
+        async def connection(session):
+            nonlocal rejected
+            while pending:
+                u = pending.popleft()
+                while True:
+                    async with session.post(url, json=u) as r:
+                        if r.status == 200:
+                            break
+                    rejected += 1
+                    await asyncio.sleep(0.05)
+
+        async with aiohttp.ClientSession() as session:
+            await asyncio.gather(*(connection(session) for _ in range(connections)))
+        return rejected
+
+    async def control(self, request: web.Request):
+        # تحكم من عملية أخرى عند تشغيل الخادم في عملية مستقلة (spawn_fake_api)
+        op = request.match_info["op"]
+        if op == "feed":
+            self.feed(await request.json())
+            return web.json_response({"ok": True})
+        if op == "deliver":
+            body = await request.json()
+            return web.json_response({"rejected": await self.deliver(body["url"], body["updates"], body["connections"])})
+        return web.json_response(dict(self.calls))
+
+    async def start(self):
+        app = web.Application(client_max_size=256 * 1024 ** 2)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        app.router.add_post("/_control/{op}", self.control)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self.url
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    def buttons(self, chat_id) -> list:
+        kb = self.markups.get(str(chat_id)) or {}
+        return [(b["text"], b["callback_data"]) for row in kb.get("inline_keyboard", [])
+                for b in row if "callback_data" in b]
+
+
+def _serve_fake_api(latency: float, pipe):
+    async def serve():
+        api = FakeBotAPI(latency)
+        pipe.send(await api.start())
+        await asyncio.Event().wait()
+    asyncio.run(serve())
+
+
+def spawn_fake_api(latency: float = 0.0):
+    # الخادم الوهمي في عملية مستقلة حتى لا يتقاسم المعالج مع البوت المقاس
+    parent, child = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=_serve_fake_api, args=(latency, child), daemon=True)
+    proc.start()
+    return parent.recv(), proc
+
+
+def seed_catalog(bot, path: str, n_items: int, n_users: int):
+    # يُعاد استخدام ملف --db إن كان بالحجم نفسه، فالكتالوج الكبير يُولَّد مرة واحدة
+    with sqlite3.connect(path) as con:
+        have = con.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+    if have >= n_items:
+        return False
+    seed(bot.db_connect(), n_items - have, n_users)
+    return True
+
+
+class VirtualUser:
+    def __init__(self, h: "Harness", uid: int, rnd: random.Random):
+        self.h, self.uid, self.rnd = h, uid, rnd
+
+    async def press(self, data: str):
+        if data is None:
+            return
+        await self.h.send(self.uid, self.h.callback_update(self.uid, data), self.h.label_for(data))
+
+    async def say(self, label: str, **fields):
+        await self.h.send(self.uid, self.h.message_update(self.uid, **fields), label)
+
+    def pick(self, predicate):
+        found = [d for text, d in self.h.api.buttons(self.uid) if predicate(text, d)]
+        return self.rnd.choice(found) if found else None
+
+    def routed(self, handler: str):
+        return lambda text, d: self.h.label_for(d) == handler
+
+    async def browse(self):
+        await self.press(self.h.bot.cb("main:open"))
+        await self.press(self.h.bot.cb("cat:open", self.rnd.choice(CATS)))
+        await self.press(self.pick(self.routed("cb_list_cat")))
+        item = self.pick(self.routed("cb_item_view"))
+        if item:
+            await self.press(item)
+
+    async def paginate(self):
+        await self.press(self.h.bot.cb("cat:list", self.rnd.choice(CATS), 1))
+        for _ in range(self.rnd.randint(2, 8)):
+            nxt = self.pick(lambda text, d: "التالي" in text)
+            if not nxt:
+                break
+            await self.press(nxt)
+
+    async def search(self):
+        await self.press(self.h.bot.cb("search:open"))
+        await self.say("on_search_global", text=str(self.rnd.randrange(self.h.args.items)))
+
+    async def upload(self):
+        await self.press(self.h.bot.cb("cat:upload", "image"))
+        # جزء من الرفعات ملفات مكررة ليمر مسار منع التكرار أيضًا
+        n = self.rnd.randrange(self.h.uploads + 1) if self.rnd.random() < 0.2 else next(self.h.upload_seq)
+        self.h.uploads = max(self.h.uploads, n)
+        await self.say("on_upload_any", photo=[{"file_id": f"BENCH{n}", "file_unique_id": f"bench-{n}",
+                                                "width": 1, "height": 1}])
+
+    async def purge(self):
+        # مشرف يفتح السلة ثم عنصرًا منها ويحذفه نهائيًا
+        mod = self.rnd.randrange(50, self.h.args.users + 1, 50)
+        user = VirtualUser(self.h, mod, self.rnd)
+        await user.press(self.h.bot.cb("trash:list", 1))
+        item = user.pick(user.routed("cb_item_view"))
+        if item:
+            await user.press(item)
+            purge = user.pick(user.routed("cb_trash_purge"))
+            if purge:
+                await user.press(purge)
+
+
+class Harness:
+    def __init__(self, bot, api: FakeBotAPI, args):
+        self.bot, self.api, self.args = bot, api, args
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        self._ids = count(1)
+        self.upload_seq = count(1)
+        self.uploads = 0
+
+    def label_for(self, data: str) -> str:
+        parsed = self.bot.router.parse(data) if data else None
+        return parsed[0].__name__ if parsed else "unknown_callback"
+
+    def user(self, uid):
+        return {"id": uid, "is_bot": False, "first_name": f"user {uid}"}
+
+    def callback_update(self, uid, data):
+        from aiogram import types
+        return types.Update.to_object({"update_id": next(self._ids), "callback_query": {
+            "id": str(next(self._ids)), "chat_instance": "bench", "data": data, "from": self.user(uid),
+            "message": {"message_id": 1, "date": 0, "chat": {"id": uid, "type": "private"}, "text": "x"}}})
+
+    def message_update(self, uid, **fields):
+        from aiogram import types
+        msg = {"message_id": next(self._ids), "date": int(time.time()), "chat": {"id": uid, "type": "private"},
+               "from": self.user(uid)}
+        msg.update(fields)
+        return types.Update.to_object({"update_id": next(self._ids), "message": msg})
+
+    async def send(self, uid, update, label):
+        t0 = time.perf_counter()
+        try:
+            # مهمة مستقلة لكل تحديث كما في executor (ContextVar الحالة لا يتسرب بين التحديثات)
+            await asyncio.create_task(self.bot.dp.process_update(update))
+        except Exception as e:
+            self.errors[f"{label}: {type(e).__name__}"] += 1
+        self.latencies[label].append(time.perf_counter() - t0)
+
+    async def session_loop(self, worker: int, deadline: float, mix: list):
+        rnd = random.Random(self.args.seed * 1000 + worker)
+        names, weights = zip(*mix)
+        while time.perf_counter() < deadline:
+            uid = rnd.randint(1, self.args.users)
+            scenario = rnd.choices(names, weights)[0]
+            await getattr(VirtualUser(self, uid, rnd), scenario)()
+
+
+def parse_mix(spec: str) -> list:
+    out = []
+    for part in spec.split(","):
+        name, _, w = part.partition("=")
+        if name.strip() not in ("browse", "paginate", "search", "upload", "purge"):
+            raise SystemExit(f"سيناريو غير معروف: {name}")
+        out.append((name.strip(), float(w or 1)))
+    return out
+
+
+def summarize(latencies: dict, elapsed: float) -> dict:
+    out = {}
+    for label, samples in sorted(latencies.items()):
+        ms = [x * 1000 for x in samples]
+        out[label] = {"n": len(ms), "per_sec": round(len(ms) / elapsed, 2),
+                      "p50_ms": round(percentile(ms, 50), 3), "p95_ms": round(percentile(ms, 95), 3),
+                      "p99_ms": round(percentile(ms, 99), 3), "mean_ms": round(sum(ms) / len(ms), 3)}
+    return out
+
+
+def compare(base: dict, cur: dict, threshold: float):
+    # يطبع فرق p95 لكل معالج ويعيد عدد التراجعات الأسوأ من العتبة
+    regressions = 0
+    print(f"\n{'handler':28} {'p95 base':>10} {'p95 now':>10} {'change':>8}")
+    for label, now in cur["handlers"].items():
+        old = base.get("handlers", {}).get(label)
+        if not old:
+            print(f"{label:28} {'-':>10} {now['p95_ms']:10.2f}      new")
+            continue
+        change = (now["p95_ms"] - old["p95_ms"]) / old["p95_ms"] if old["p95_ms"] else 0.0
+        flag = "  ⚠️" if change > threshold else ""
+        regressions += change > threshold
+        print(f"{label:28} {old['p95_ms']:10.2f} {now['p95_ms']:10.2f} {change:+8.1%}{flag}")
+    print(f"throughput: {base.get('throughput', 0):.1f} -> {cur['throughput']:.1f} updates/s")
+    return regressions
+
+
+def git_rev():
+    try:
+        return subprocess.check_output(["git", "-C", ROOT, "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return None
+
+
+async def run(args):
+    api = FakeBotAPI(args.api_latency / 1000)
+    os.environ["BOT_API_SERVER"] = await api.start()
+    sys.path.insert(0, ROOT)
+    import bot  # noqa: E402  (يجب ضبط DB_PATH وBOT_API_SERVER قبل الاستيراد)
+    from aiogram import Bot, Dispatcher
+
+    t0 = time.perf_counter()
+    seeded = seed_catalog(bot, os.environ["DB_PATH"], args.items, args.users)
+    seed_s = time.perf_counter() - t0
+    print(f"catalog: {args.items} items, {args.users} users ({'seeded in %.1fs' % seed_s if seeded else 'reused'})")
+
+    Bot.set_current(bot.bot)
+    Dispatcher.set_current(bot.dp)
+    await bot.on_startup(bot.dp)
+    h = Harness(bot, api, args)
+    start = time.perf_counter()
+    await asyncio.gather(*(h.session_loop(i, start + args.duration, parse_mix(args.mix))
+                           for i in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+    await bot.on_shutdown(bot.dp)
+    await (await bot.bot.get_session()).close()
+    await api.stop()
+
+    total = sum(len(v) for v in h.latencies.values())
+    result = {
+        "meta": {"items": args.items, "users": args.users, "concurrency": args.concurrency,
+                 "duration": args.duration, "mix": args.mix, "api_latency_ms": args.api_latency,
+                 "seed": args.seed, "git": git_rev(), "sqlite": sqlite3.sqlite_version,
+                 "python": sys.version.split()[0], "at": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "throughput": round(total / elapsed, 2),
+        "updates": total,
+        "handlers": summarize(h.latencies, elapsed),
+        "api_calls": dict(api.calls),
+        "errors": dict(h.errors),
+    }
+    return result
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--items", type=int, default=100_000, help="حجم الكتالوج (10k–5M)")
+    ap.add_argument("--users", type=int, default=1_000)
+    ap.add_argument("--db", help="ملف قاعدة يُعاد استخدامه بين التشغيلات (افتراضيًا ملف مؤقت)")
+    ap.add_argument("--concurrency", type=int, default=50, help="مستخدمون افتراضيون متزامنون")
+    ap.add_argument("--duration", type=float, default=20.0, help="ثوانٍ")
+    ap.add_argument("--mix", default=DEFAULT_MIX, help="أوزان السيناريوهات")
+    ap.add_argument("--api-latency", type=float, default=0.0, help="تأخير مصطنع لكل طلب Bot API بالملّي ثانية")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out", default="bench-harness.json")
+    ap.add_argument("--compare", help="ملف JSON من تشغيل سابق")
+    ap.add_argument("--threshold", type=float, default=0.10, help="نسبة تراجع p95 التي تُعد فشلًا")
+    args = ap.parse_args()
+
+    os.environ["DB_PATH"] = args.db or os.path.join(tempfile.mkdtemp(prefix="bench-harness-"), "storage.db")
+    os.environ["BOT_TOKEN"] = TOKEN
+    os.environ.setdefault("OWNER_ID", "1")
+    os.environ.setdefault("METRICS_PORT", "0")
+    os.environ.setdefault("THROTTLE", "0")     # الحمل المصطنع من مستخدمين قليلين يتجاوز حدود المستخدم
+    result = asyncio.run(run(args))
+
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"\n{result['updates']} updates in {args.duration:.0f}s → {result['throughput']:.1f}/s")
+    print(f"{'handler':28} {'n':>7} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for label, s in result["handlers"].items():
+        print(f"{label:28} {s['n']:7d} {s['p50_ms']:8.2f}ms {s['p95_ms']:8.2f}ms {s['p99_ms']:8.2f}ms")
+    if result["errors"]:
+        print("errors:", result["errors"])
+    print(f"→ {args.out}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            sys.exit(1 if compare(json.load(f), result, args.threshold) else 0)
+
+
+if __name__ == "__main__":
+    main()
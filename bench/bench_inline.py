@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# زمن البحث المضمّن بسرعة الكتابة: كل كلمة تُكتب حرفًا حرفًا فيصير كل حرف استعلامًا
+# (مع صفحات تالية عبر next_offset)، ويُقاس bot.inline_search لكل استعلام:
+# "cold" بذاكرة فارغة (قاعدة فقط)، و"warm" تكرار الجلسة نفسها من الذاكرة، و"bm25"
+# ترتيب الصلة القديم (search_items) على الاستعلامات نفسها للمقارنة.
+#
+#   python bench/bench_inline.py --items 200000 --sessions 200
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_db import ROOT, percentile, seed  # noqa: E402
+
+
+def make_sessions(n: int, n_items: int, rnd: random.Random) -> list:
+    # كلمات شائعة جدًا ("name" تطابق كل العناصر) ونادرة (رقم عنصر بعينه)
+    sessions = []
+    for _ in range(n):
+        phrase = rnd.choice(["name", "caption"]) + " " + str(rnd.randrange(n_items))
+        typed = [phrase[:i] for i in range(1, len(phrase) + 1) if not phrase[:i].endswith(" ")]
+        pages = [(phrase, off) for off in range(20, 20 * rnd.randint(1, 4), 20)]
+        sessions.append([(q, 0) for q in typed] + pages)
+    return sessions
+
+
+def report(label: str, lat: list):
+    print(f"{label:6} {len(lat):6d} q  p50={percentile(lat, 50):7.2f}ms  p95={percentile(lat, 95):7.2f}ms  "
+          f"p99={percentile(lat, 99):7.2f}ms  max={max(lat):7.2f}ms")
+
+
+async def run(bot, sessions: list):
+    async def timed(fn, queries):
+        lat = []
+        for q, off in queries:
+            t0 = time.perf_counter()
+            await fn(q, off)
+            lat.append((time.perf_counter() - t0) * 1000)
+        return lat
+
+    queries = [x for s in sessions for x in s]
+    bot.inline_cache.clear()
+    report("cold", await timed(bot.inline_search, queries))
+    report("warm", await timed(bot.inline_search, queries))
+    report("bm25", await timed(lambda q, off: bot.search_items(q), [x for x in queries if x[1] == 0]))
+    print(f"cache: {bot.inline_cache.stats()}")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--items", type=int, default=200_000)
+    ap.add_argument("--users", type=int, default=1_000)
+    ap.add_argument("--sessions", type=int, default=200)
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="bench-inline-"), "storage.db")
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCH-inline")
+    sys.path.insert(0, ROOT)
+    import bot  # noqa: E402  (يجب ضبط DB_PATH قبل الاستيراد)
+
+    seed(bot.db_connect(), args.items, args.users)
+    sessions = make_sessions(args.sessions, args.items, random.Random(args.seed))
+    print(f"items={args.items} sessions={args.sessions}")
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(run(bot, sessions))
+    bot.db.close()
+    loop.close()
+
+
+if __name__ == "__main__":
+    main()
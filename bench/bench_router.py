@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# قياس مصغّر لتكلفة توجيه الزر الواحد: سلسلة مرشّحات lambda بالتتابع (كما كانت
+# معالجات callback_query_handler) مقابل CallbackRouter.parse (قاموس + تحليل واحد)،
+# مرة كتحليل Python مجرد ومرة عبر Dispatcher الحقيقي في aiogram.
+#
+#   python bench/bench_router.py --updates 200000
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# مرشّحات المعالجات القديمة بترتيب تسجيلها، مع التحليل الذي كان يجري داخل كل معالج
+LEGACY = [
+    (lambda c: c == "user:register", lambda c: ()),
+    (lambda c: c == "user:profile", lambda c: ()),
+    (lambda c: c == "main:open", lambda c: ()),
+    (lambda c: c.startswith("cat:open:"), lambda c: (c.split(":")[2],)),
+    (lambda c: c.startswith("cat:list:"), lambda c: (lambda p: (p[2], 1 if p[3] == "recent" else int(p[3]), p[4:]))(c.split(":"))),
+    (lambda c: c.startswith("nav:page:"), lambda c: ("cat:list:" + c.split(":", 2)[2]).split(":")),
+    (lambda c: c.startswith("item:view:"), lambda c: (int(c.split(":")[2]),)),
+    (lambda c: c.startswith("item:del:"), lambda c: (int(c.split(":")[2]),)),
+    (lambda c: c.startswith("item:edit:"), lambda c: (int(c.split(":")[2]),)),
+    (lambda c: c in ("edit:name", "edit:caption"), lambda c: (c.split(":")[1],)),
+    (lambda c: c.startswith("trash:list:"), lambda c: (lambda p: (int(p[2]), p[3:]))(c.split(":"))),
+    (lambda c: c.startswith("trash:restore:"), lambda c: (int(c.split(":")[2]),)),
+    (lambda c: c.startswith("trash:purge:"), lambda c: (int(c.split(":")[2]),)),
+    (lambda c: c == "trash:purge_all:confirm", lambda c: ()),
+    (lambda c: c == "trash:purge_all:do", lambda c: ()),
+    (lambda c: c.startswith("cat:upload:"), lambda c: (c.split(":")[2],)),
+    (lambda c: c == "search:open", lambda c: ()),
+    (lambda c: c.startswith("search:cat:"), lambda c: (c.split(":")[2],)),
+    (lambda c: c == "admin:open", lambda c: ()),
+    (lambda c: c.startswith("admin:users:"), lambda c: (lambda p: (int(p[2]), p[3:]))(c.split(":"))),
+    (lambda c: c.startswith("admin:toggle_mod:"), lambda c: (int(c.split(":")[2]),)),
+    (lambda c: c == "admin:stats", lambda c: ()),
+    (lambda c: c == "admin:settings", lambda c: ()),
+    (lambda c: c in ("admin:outbox", "admin:outbox:retry"), lambda c: ()),
+]
+
+
+def legacy_dispatch(data):
+    for check, parse in LEGACY:
+        if check(data):
+            return parse(data)
+    return None
+
+
+def workload(bot, n: int):
+    # توزيع نقرات تقريبي: التصفح وعرض العناصر هو الغالب
+    rnd = random.Random(5)
+    v0, v1 = [], []
+    for _ in range(n):
+        kind = rnd.random()
+        item = rnd.randint(1, 5_000_000)
+        cat = rnd.choice(["file", "image", "video", "audio", "app"])
+        cursor = bot.encode_cursor("n", "2024-05-01T12:00:00", item)
+        if kind < 0.35:
+            v0.append(f"item:view:{item}"), v1.append(bot.cb("item:view", item))
+        elif kind < 0.65:
+            v0.append(f"nav:page:{cat}:3:{cursor}"), v1.append(bot.cb("cat:list", cat, 3, cursor))
+        elif kind < 0.8:
+            v0.append("main:open"), v1.append(bot.cb("main:open"))
+        elif kind < 0.9:
+            v0.append(f"cat:open:{cat}"), v1.append(bot.cb("cat:open", cat))
+        else:
+            v0.append("admin:outbox"), v1.append(bot.cb("admin:outbox"))
+    return v0, v1
+
+
+def as_updates(data):
+    from aiogram import types
+    return [types.Update.to_object({"update_id": i, "callback_query": {
+        "id": str(i), "chat_instance": "c", "data": d,
+        "from": {"id": 7, "is_bot": False, "first_name": "u"},
+        "message": {"message_id": 1, "date": 0, "chat": {"id": 7, "type": "private"}, "text": "x"}}})
+        for i, d in enumerate(data)]
+
+
+async def dispatch_cost(dp, updates):
+    # كل تحديث في مهمة مستقلة كما يفعل executor، والمعالج نفسه لا يفعل شيئًا
+    loop = asyncio.get_running_loop()
+    t0 = loop.time()
+    for upd in updates:
+        await asyncio.ensure_future(dp.process_update(upd))
+    return (loop.time() - t0) / len(updates)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--updates", type=int, default=200_000)
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--aiogram-updates", type=int, default=20_000, help="تحديثات تمر عبر Dispatcher الحقيقي")
+    args = ap.parse_args()
+
+    os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="bench-router-"), "storage.db")
+    os.environ.setdefault("THROTTLE", "0")     # الحمل المصطنع من مستخدمين قليلين يتجاوز حدود المستخدم
+    sys.path.insert(0, ROOT)
+    import bot  # noqa: E402  (يجب ضبط DB_PATH قبل الاستيراد)
+    from aiogram import Bot, Dispatcher
+    from aiogram.contrib.fsm_storage.memory import MemoryStorage
+
+    v0, v1 = workload(bot, args.updates)
+    parse = bot.router.parse
+    print("parse only (pure python):")
+    for label, fn, data in (("lambda-chain", legacy_dispatch, v0), ("router v1", parse, v1), ("router v0", parse, v0)):
+        best = min(timeit.repeat(lambda: [fn(d) for d in data], number=1, repeat=args.repeat))
+        size = sum(len(d) for d in data) / len(data)
+        print(f"  {label:13} {best / len(data) * 1e9:8.0f} ns/update   avg callback_data={size:5.1f} bytes")
+
+    # المسار الكامل داخل aiogram: مرشّحات كل المعالجات بالتتابع مقابل معالج واحد + قاموس
+    async def noop(*_):
+        pass
+
+    legacy_dp = Dispatcher(bot.bot, storage=MemoryStorage())
+    for check, parse_args in LEGACY:
+        legacy_dp.register_callback_query_handler(
+            lambda call, p=parse_args: noop(p(call.data)), lambda c, check=check: check(c.data))
+    router_dp = Dispatcher(bot.bot, storage=MemoryStorage())
+    router_dp.register_callback_query_handler(lambda call: noop(parse(call.data)))
+
+    n = min(args.aiogram_updates, args.updates)
+    loop = asyncio.new_event_loop()
+    Bot.set_current(bot.bot)
+    print("full aiogram dispatch:")
+    for label, dp, data in (("lambda-chain", legacy_dp, v0[:n]), ("router v1", router_dp, v1[:n])):
+        Dispatcher.set_current(dp)
+        per = loop.run_until_complete(dispatch_cost(dp, as_updates(data)))
+        print(f"  {label:13} {per * 1e6:8.1f} us/update")
+    loop.close()
+    bot.db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# مقارنة البحث القديم (LIKE '%kw%' = مسح كامل) بفهرس FTS5 على كتالوج اصطناعي.
+#
+#   python bench/bench_search.py --items 1000000 --queries 200
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import closing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CATS = ["file", "image", "video", "audio", "app"]
+WORDS = [
+    "كتاب", "الإحصاء", "مدرسة", "رحلة", "صورة", "الجامعة", "محاضرة", "تقرير", "برنامج", "تطبيق",
+    "الرياضيات", "فيزياء", "كيمياء", "تاريخ", "جغرافيا", "مكتبة", "أغنية", "نشيد", "دورة", "شرح",
+    "holiday", "report", "lecture", "physics", "android", "windows", "invoice", "summer", "family", "project",
+    "backup", "notes", "slides", "exam", "music", "video", "tutorial", "archive", "draft", "final",
+]
+
+
+def vocabulary(size: int):
+    # كلمات حقيقية شائعة + كلمات اصطناعية نادرة بتوزيع يشبه Zipf
+    rnd = random.Random(11)
+    letters = "ابتثجحخدذرزسشصضطظعغفقكلمنهوي"
+    extra = ["".join(rnd.choices(letters if i % 2 else "abcdefghijklmnopqrstuvwxyz", k=rnd.randint(4, 9)))
+             for i in range(size)]
+    vocab = WORDS + extra
+    weights = list(itertools.accumulate(1.0 / (rank + 1) for rank in range(len(vocab))))
+    return vocab, weights   # أوزان تراكمية (cum_weights) لتسريع random.choices
+
+
+def seed(con, n_items: int, vocab, weights, batch: int = 50_000):
+    rnd = random.Random(7)
+
+    def rows(start, stop):
+        for i in range(start, stop):
+            name = " ".join(rnd.choices(vocab, cum_weights=weights, k=rnd.randint(1, 3))) + f" {i}"
+            caption = " ".join(rnd.choices(vocab, cum_weights=weights, k=rnd.randint(3, 8)))
+            yield (CATS[i % 5], f"F{i}", name, caption, i % 1000,
+                   "trashed" if i % 20 == 0 else "active", "2024-01-01T00:00:00")
+
+    t0 = time.perf_counter()
+    with closing(con):
+        for start in range(0, n_items, batch):
+            with con:
+                con.executemany(
+                    "INSERT INTO items(type, file_id, name, caption, uploader_id, status, created_at) VALUES(?,?,?,?,?,?,?)",
+                    rows(start, min(n_items, start + batch)))
+            print(f"\rseeded {min(n_items, start + batch):,}/{n_items:,}", end="", flush=True)
+    print(f"  ({time.perf_counter() - t0:.1f}s)")
+
+
+def legacy_search(path, keyword, cat=None):
+    kw = f"%{keyword.lower()}%"
+    with closing(__import__("sqlite3").connect(path)) as con:
+        if cat:
+            return con.execute("""
+                SELECT id, type, name, caption FROM items
+                WHERE status='active' AND type=? AND (LOWER(COALESCE(name,'')) LIKE ? OR LOWER(COALESCE(caption,'')) LIKE ?)
+                ORDER BY created_at DESC LIMIT 25
+            """, (cat, kw, kw)).fetchall()
+        return con.execute("""
+            SELECT id, type, name, caption FROM items
+            WHERE status='active' AND (LOWER(COALESCE(name,'')) LIKE ? OR LOWER(COALESCE(caption,'')) LIKE ?)
+            ORDER BY created_at DESC LIMIT 25
+        """, (kw, kw)).fetchall()
+
+
+def percentile(samples, p):
+    s = sorted(samples)
+    return s[min(len(s) - 1, int(round(p / 100 * (len(s) - 1))))]
+
+
+def report(label, samples, hits):
+    ms = [x * 1000 for x in samples]
+    print(f"{label:12} n={len(ms):5d}  p50={percentile(ms, 50):9.2f}ms  p95={percentile(ms, 95):9.2f}ms  "
+          f"p99={percentile(ms, 99):9.2f}ms  mean={statistics.mean(ms):9.2f}ms  avg_hits={hits / len(ms):.1f}")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--items", type=int, default=1_000_000)
+    ap.add_argument("--queries", type=int, default=200)
+    ap.add_argument("--vocab", type=int, default=50_000, help="عدد الكلمات الاصطناعية")
+    ap.add_argument("--legacy-queries", type=int, default=20, help="LIKE بطيء جدًا؛ عيّنة أصغر")
+    args = ap.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="bench-search-")
+    os.environ["DB_PATH"] = os.path.join(tmp, "storage.db")
+    sys.path.insert(0, ROOT)
+    import bot  # noqa: E402  (يجب ضبط DB_PATH قبل الاستيراد)
+
+    vocab, weights = vocabulary(args.vocab)
+    seed(bot.db_connect(), args.items, vocab, weights)
+    rnd = random.Random(3)
+    # كلمات بتوزيع الاستخدام نفسه، وكلمات نادرة، وبادئات، وصيغ بلا "ال"/همزة للتحقق من التطبيع
+    queries = rnd.choices(vocab, cum_weights=weights, k=args.queries // 4)
+    queries += rnd.choices(vocab, k=args.queries // 4)
+    queries += [w[:3] for w in rnd.choices(vocab, cum_weights=weights, k=args.queries // 4)]
+    queries += [rnd.choice(["احصاء", "جامعه", "الاحصاء", "مكتبه"]) for _ in range(args.queries - len(queries))]
+    cats = [rnd.choice([None] + CATS) for _ in queries]
+
+    loop = asyncio.new_event_loop()
+    print(f"items={args.items:,} queries={len(queries)}")
+    for label, n, run in (
+        ("like", args.legacy_queries, lambda q, c: legacy_search(os.environ["DB_PATH"], q, c)),
+        ("fts5", len(queries), lambda q, c: loop.run_until_complete(bot.search_items(q, c))),
+    ):
+        samples, hits = [], 0
+        for q, c in list(zip(queries, cats))[:n]:
+            t0 = time.perf_counter()
+            hits += len(run(q, c))
+            samples.append(time.perf_counter() - t0)
+        report(label, samples, hits)
+    bot.db.close()
+    loop.close()
+
+
+if __name__ == "__main__":
+    main()
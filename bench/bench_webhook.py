@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+# الاستطلاع مقابل الـ webhook على الخادم الوهمي نفسه (bench_harness.FakeBotAPI)،
+# يعمل في عملية مستقلة تمثّل جهة تيليجرام فلا يزاحم البوت على المعالج.
+# الحمل دفعة من التحديثات (أزرار تصفح وعرض عناصر من مستخدمين كثيرين، عدة
+# تحديثات متتالية لكل مستخدم) تُسلَّم مرة عبر getUpdates لـ dp.start_polling كما
+# يشغّله executor، ومرة كطلبات POST متزامنة إلى WebhookServer كما يرسلها تيليجرام
+# (حتى --connections اتصال). يُقاس زمن كل تحديث من تسليمه حتى انتهاء معالجته،
+# والإنتاجية، وعدد التحديثات التي انتهت قبل تحديث أسبق من المستخدم نفسه.
+#
+#   python bench/bench_webhook.py --updates 5000 --users 200 --api-latency 30
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_db import CATS, percentile  # noqa: E402
+from bench_harness import ROOT, TOKEN, seed_catalog, spawn_fake_api  # noqa: E402
+
+
+def make_updates(bot, n: int, n_users: int, n_items: int, rnd: random.Random) -> list:
+    # كل مستخدم يرسل سلسلة قصيرة متتالية، والسلاسل متداخلة كما تصل من مستخدمين حقيقيين
+    streams = []
+    for uid in rnd.sample(range(1, n_users + 1), min(n_users, n)):
+        streams.append([uid, rnd.randint(3, 8)])
+    updates, upd_id = [], 1
+    while len(updates) < n:
+        s = rnd.choice(streams)
+        uid = s[0]
+        data = rnd.choice([bot.cb("main:open"), bot.cb("cat:open", rnd.choice(CATS)),
+                           bot.cb("cat:list", rnd.choice(CATS), 1), bot.cb("item:view", rnd.randint(1, n_items))])
+        updates.append({"update_id": upd_id, "callback_query": {
+            "id": str(upd_id), "chat_instance": "bench", "data": data,
+            "from": {"id": uid, "is_bot": False, "first_name": f"user {uid}"},
+            "message": {"message_id": 1, "date": 0, "chat": {"id": uid, "type": "private"}, "text": "x"}}})
+        upd_id += 1
+    return updates
+
+
+class Tracker:
+    # middleware على مستوى التحديث: يسجّل لحظة انتهاء كل تحديث
+    def __init__(self, total: int):
+        from aiogram.dispatcher.middlewares import BaseMiddleware
+
+        tracker = self
+
+        class Done(BaseMiddleware):
+            async def on_post_process_update(self, update, results, data):
+                tracker.done[update.update_id] = time.perf_counter()
+                if len(tracker.done) >= tracker.total:
+                    tracker.finished.set()
+
+        self.middleware = Done()
+        self.reset(total)
+
+    def reset(self, total: int):
+        self.total = total
+        self.done = {}
+        self.finished = asyncio.Event()
+
+
+def report(name: str, updates: list, sent: dict, done: dict, elapsed: float) -> dict:
+    lat = [(done[u["update_id"]] - sent[u["update_id"]]) * 1000 for u in updates if u["update_id"] in done]
+    per_user = defaultdict(list)
+    for u in updates:
+        per_user[u["callback_query"]["from"]["id"]].append(u["update_id"])
+    out_of_order = sum(1 for ids in per_user.values() for a, b in zip(ids, ids[1:])
+                       if a in done and b in done and done[b] < done[a])
+    res = {"updates": len(lat), "elapsed_s": round(elapsed, 3), "throughput": round(len(lat) / elapsed, 1),
+           "p50_ms": round(percentile(lat, 50), 2), "p95_ms": round(percentile(lat, 95), 2),
+           "p99_ms": round(percentile(lat, 99), 2), "out_of_order": out_of_order}
+    print(f"{name:8} {res['updates']:6d} upd  {res['throughput']:8.1f}/s  p50={res['p50_ms']:8.2f}ms  "
+          f"p95={res['p95_ms']:8.2f}ms  p99={res['p99_ms']:8.2f}ms  out-of-order={out_of_order}")
+    return res
+
+
+async def run_polling(bot, control, tracker: Tracker, updates: list) -> dict:
+    from aiogram import Bot, Dispatcher
+    Bot.set_current(bot.bot)
+    Dispatcher.set_current(bot.dp)
+    tracker.reset(len(updates))
+    # القيم نفسها التي يمررها executor.start_polling
+    polling = asyncio.ensure_future(bot.dp.start_polling(timeout=20, relax=0.1, fast=True))
+    await asyncio.sleep(0.2)
+    t0 = time.perf_counter()
+    sent = {u["update_id"]: t0 for u in updates}
+    await control("feed", updates)
+    await tracker.finished.wait()
+    elapsed = time.perf_counter() - t0
+    bot.dp.stop_polling()
+    await control("feed", [])    # يوقظ getUpdates المعلّق
+    await polling
+    return report("polling", updates, sent, tracker.done, elapsed)
+
+
+async def run_webhook(bot, control, tracker: Tracker, updates: list, connections: int, port: int) -> dict:
+    server = bot.WebhookServer("127.0.0.1", port, "/webhook")
+    await server.start()
+    tracker.reset(len(updates))
+    # الدفعة كلها وصلت تيليجرام عند t0 كما في الاستطلاع، فالزمن يشمل الانتظار قبل التسليم
+    t0 = time.perf_counter()
+    sent = {u["update_id"]: t0 for u in updates}
+    rejected = (await control("deliver", {"url": f"http://127.0.0.1:{port}/webhook",
+                                          "updates": updates, "connections": connections}))["rejected"]
+    await tracker.finished.wait()
+    elapsed = time.perf_counter() - t0
+    await server.stop(5)
+    res = report("webhook", updates, sent, tracker.done, elapsed)
+    res["rejected_503"] = rejected
+    return res
+
+
+async def main_async(args, api_url: str):
+    os.environ["BOT_API_SERVER"] = api_url
+    sys.path.insert(0, ROOT)
+    import bot  # noqa: E402
+
+    seed_catalog(bot, os.environ["DB_PATH"], args.items, args.users)
+    tracker = Tracker(args.updates)
+    bot.dp.middleware.setup(tracker.middleware)
+    await bot.on_startup(bot.dp)
+    updates = make_updates(bot, args.updates, args.users, args.items, random.Random(args.seed))
+    print(f"{args.updates} updates from {args.users} users, api latency {args.api_latency}ms, "
+          f"UPDATE_CONCURRENCY={bot.UPDATE_CONCURRENCY}, connections={args.connections}")
+    result = {"meta": vars(args)}
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=None)) as session:
+        async def control(op, body):
+            async with session.post(f"{api_url}/_control/{op}", json=body) as r:
+                return await r.json()
+        result["polling"] = await run_polling(bot, control, tracker, updates)
+        result["webhook"] = await run_webhook(bot, control, tracker, updates, args.connections, args.port)
+    await bot.on_shutdown(bot.dp)
+    await (await bot.bot.get_session()).close()
+    return result
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--items", type=int, default=50_000)
+    ap.add_argument("--users", type=int, default=200)
+    ap.add_argument("--db", help="ملف قاعدة يُعاد استخدامه بين التشغيلات")
+    ap.add_argument("--updates", type=int, default=3_000)
+    ap.add_argument("--api-latency", type=float, default=30.0, help="زمن الذهاب والإياب لكل طلب Bot API (ms)")
+    ap.add_argument("--connections", type=int, default=40, help="اتصالات webhook المتزامنة (max_connections)")
+    ap.add_argument("--concurrency", type=int, default=64, help="UPDATE_CONCURRENCY")
+    ap.add_argument("--port", type=int, default=18080)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out", default="bench-webhook.json")
+    args = ap.parse_args()
+
+    os.environ["DB_PATH"] = args.db or os.path.join(tempfile.mkdtemp(prefix="bench-webhook-"), "storage.db")
+    os.environ["BOT_TOKEN"] = TOKEN
+    os.environ["UPDATE_CONCURRENCY"] = str(args.concurrency)
+    os.environ.setdefault("METRICS_PORT", "0")
+    os.environ.setdefault("THROTTLE", "0")     # الحمل المصطنع من مستخدمين قليلين يتجاوز حدود المستخدم
+    api_url, api_proc = spawn_fake_api(args.api_latency / 1000)
+    try:
+        result = asyncio.run(main_async(args, api_url))
+    finally:
+        api_proc.terminate()
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"→ {args.out}")
+
+
+if __name__ == "__main__":
+    main()
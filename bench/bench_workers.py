@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# قابلية التوسع بعدد العمال: يشغّل bot.py كما في الإنتاج (WORKERS=N، استطلاع) أمام
+# خادم Bot API الوهمي (bench_harness.FakeBotAPI) في عملية مستقلة، على الكتالوج
+# نفسه، لكل N في --workers. دفعة إحماء قصيرة (تضمن أن العمال بدؤوا)، ثم الدفعة
+# المقاسة كاملة في getUpdates، والإنتاجية = عدد التحديثات ÷ الزمن حتى يصل آخر
+# answerCallbackQuery. WORKERS=1 هو الوضع الحالي بعملية واحدة.
+# التوسع محدود بعدد الأنوية: على جهاز بنواة واحدة لا يُتوقع تحسن.
+#
+#   python bench/bench_workers.py --workers 1,2,4 --updates 5000 --api-latency 5
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from bench_harness import ROOT, TOKEN, seed_catalog, spawn_fake_api  # noqa: E402
+from bench_webhook import make_updates  # noqa: E402
+
+
+async def wait_calls(control, method: str, target: int, timeout: float) -> dict:
+    deadline = time.monotonic() + timeout
+    while True:
+        calls = await control("calls", {})
+        if calls.get(method, 0) >= target:
+            return calls
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"{method}: {calls.get(method, 0)}/{target}")
+        await asyncio.sleep(0.02)
+
+
+async def measure(api_url: str, warmup: list, updates: list, timeout: float) -> float:
+    async with aiohttp.ClientSession() as session:
+        async def control(op, body):
+            async with session.post(f"{api_url}/_control/{op}", json=body) as r:
+                return await r.json()
+        await wait_calls(control, "getUpdates", 1, timeout)
+        await control("feed", warmup)
+        await wait_calls(control, "answerCallbackQuery", len(warmup), timeout)
+        t0 = time.perf_counter()
+        await control("feed", updates)
+        await wait_calls(control, "answerCallbackQuery", len(warmup) + len(updates), timeout)
+        return time.perf_counter() - t0
+
+
+def run_one(args, workers: int, warmup: list, updates: list, log) -> dict:
+    api_url, api_proc = spawn_fake_api(args.api_latency / 1000)
+    env = dict(os.environ, WORKERS=str(workers), BOT_API_SERVER=api_url)
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, "bot.py")], env=env,
+                            stdout=log, stderr=subprocess.STDOUT)
+    try:
+        elapsed = asyncio.run(measure(api_url, warmup, updates, args.timeout))
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(60)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        api_proc.terminate()
+    res = {"workers": workers, "updates": len(updates), "elapsed_s": round(elapsed, 3),
+           "throughput": round(len(updates) / elapsed, 1)}
+    print(f"workers={workers:<3d} {res['updates']:6d} upd  {res['elapsed_s']:8.3f}s  {res['throughput']:8.1f}/s")
+    return res
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--workers", default="1,2,4", help="أعداد العمال المقاسة، مفصولة بفواصل")
+    ap.add_argument("--items", type=int, default=50_000)
+    ap.add_argument("--users", type=int, default=400)
+    ap.add_argument("--db", help="ملف قاعدة يُعاد استخدامه بين التشغيلات")
+    ap.add_argument("--updates", type=int, default=5_000)
+    ap.add_argument("--api-latency", type=float, default=5.0, help="زمن الذهاب والإياب لكل طلب Bot API (ms)")
+    ap.add_argument("--concurrency", type=int, default=64, help="UPDATE_CONCURRENCY لكل عامل")
+    ap.add_argument("--timeout", type=float, default=300.0)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--log", default="bench-workers.log", help="مخرجات bot.py")
+    ap.add_argument("--out", default="bench-workers.json")
+    args = ap.parse_args()
+
+    os.environ["DB_PATH"] = args.db or os.path.join(tempfile.mkdtemp(prefix="bench-workers-"), "storage.db")
+    os.environ["BOT_TOKEN"] = TOKEN
+    os.environ["UPDATE_CONCURRENCY"] = str(args.concurrency)
+    os.environ.setdefault("OWNER_ID", "1")
+    os.environ.setdefault("METRICS_PORT", "0")
+    os.environ.setdefault("THROTTLE", "0")     # الحمل المصطنع من مستخدمين قليلين يتجاوز حدود المستخدم
+    sys.path.insert(0, ROOT)
+    import bot  # noqa: E402
+
+    seed_catalog(bot, os.environ["DB_PATH"], args.items, args.users)
+    rnd = random.Random(args.seed)
+    warmup = make_updates(bot, args.users, args.users, args.items, rnd)
+    updates = make_updates(bot, args.updates, args.users, args.items, rnd)
+    for i, u in enumerate(updates, start=len(warmup) + 1):
+        u["update_id"] = i
+        u["callback_query"]["id"] = str(i)
+    print(f"{args.updates} updates from {args.users} users, {args.items} items, api latency {args.api_latency}ms, "
+          f"UPDATE_CONCURRENCY={args.concurrency}, cpus={os.cpu_count()}")
+    result = {"meta": dict(vars(args), cpus=os.cpu_count()), "runs": []}
+    with open(args.log, "w") as log:
+        for n in (int(x) for x in args.workers.split(",")):
+            result["runs"].append(run_one(args, n, warmup, updates, log))
+    base = result["runs"][0]["throughput"]
+    for r in result["runs"]:
+        r["speedup"] = round(r["throughput"] / base, 2)
+    print("speedup: " + "  ".join(f"{r['workers']}→×{r['speedup']}" for r in result["runs"]))
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
+    print(f"→ {args.out}")
+
+
+if __name__ == "__main__":
+    main()
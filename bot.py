@@ -1,62 +1,989 @@
 # -*- coding: utf-8 -*-
+import argparse
+import asyncio
+import base64
+import contextvars
+import copy
+import csv
+import gzip
+import inspect
+import io
+import json
 import logging
+import multiprocessing
 import os
+import queue
+import random
+import re
+import signal
 import sqlite3
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing
-from datetime import datetime
-from typing import Optional, Tuple
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache, partial
+from typing import Callable, Dict, Optional, Tuple
 
 from aiogram import Bot, Dispatcher, executor, types
+from aiogram.bot.api import TELEGRAM_PRODUCTION, TelegramAPIServer
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.dispatcher import FSMContext
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher.storage import BaseStorage
+from aiogram.dispatcher.handler import CancelHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.utils.exceptions import (BotBlocked, BotKicked, CantInitiateConversation, ChatNotFound, MessageCantBeDeleted,
+                                      MessageNotModified, MessageToDeleteNotFound, RetryAfter, UserDeactivated)
+from aiohttp import ContentTypeError, web
 
 # ================== إعدادات أساسية (عدّل هنا) ==================
 API_TOKEN = os.getenv("BOT_TOKEN", "8298120558:AAFA2oXim7IPR900tXqT-T8VS7su9UVpzpk")
 OWNER_ID = int(os.getenv("OWNER_ID", "2045209268"))              # آيدي المالك
 CHANNEL_ID = os.getenv("CHANNEL_ID", "-2853252241")          # آيدي القناة أو @username
 DB_PATH = os.getenv("DB_PATH", "storage.db")
+BOT_API_SERVER = os.getenv("BOT_API_SERVER")                   # خادم Bot API بديل (محلي أو للقياس)، فارغ = تيليجرام
 # ===============================================================
 
 logging.basicConfig(level=logging.INFO)
-bot = Bot(token=API_TOKEN, parse_mode="HTML")
-dp = Dispatcher(bot, storage=MemoryStorage())
+
+# ================== القياس (Prometheus) ==================
+# مدرجات زمنية بحدود ثابتة لكل معالج (بحسب بادئة الزر) ولكل استعلام SQL ولكل
+# طلب Bot API، تُعرض بصيغة Prometheus النصية على METRICS_HOST:METRICS_PORT/metrics
+# ويُلخّصها زر "⏱️ الأداء" في لوحة الإدارة.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9102"))   # 0 = بلا خادم
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC_LABELS = {   # الاسم -> (اسم الوسم، الوصف)
+    "bot_handler_seconds": ("handler", "Update handling time by handler"),
+    "bot_sql_seconds": ("statement", "SQLite statement execution time"),
+    "bot_db_wait_seconds": ("pool", "Time a DB job waited for a connection thread"),
+    "bot_api_seconds": ("method", "Bot API request time"),
+    "bot_api_errors_total": ("method", "Failed Bot API requests"),
+    "bot_webhook_rejected_total": ("reason", "Webhook updates refused with 503 (Telegram retries them)"),
+    "bot_throttled_total": ("reason", "Updates dropped by the rate limiter (class:reason)"),
+    "bot_api_calls_total": ("handler", "Bot API requests made while handling updates"),
+    "bot_api_round_trips_total": ("handler", "Sequential Bot API round trips while handling updates (overlapping requests count once)"),
+    "bot_edits_skipped_total": ("reason", "Message edits not sent because nothing changed"),
+}
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(METRIC_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, v: float):
+        self.counts[bisect_left(METRIC_BUCKETS, v)] += 1
+        self.sum += v
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # تقدير من حدود الفئات باستيفاء خطي داخل الفئة، كما يفعل histogram_quantile
+        rank, seen = q * self.count, 0
+        for i, c in enumerate(self.counts):
+            if c and seen + c >= rank:
+                lo = METRIC_BUCKETS[i - 1] if i else 0.0
+                hi = METRIC_BUCKETS[min(i, len(METRIC_BUCKETS) - 1)]
+                return lo + (hi - lo) * (rank - seen) / c
+            seen += c
+        return 0.0
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()   # استعلامات SQL تُسجَّل من خيوط القاعدة
+        self.hist: dict = {}            # (name, label) -> Histogram
+        self.counters: dict = {}        # (name, label) -> int
+
+    def observe(self, name: str, label: str, seconds: float):
+        with self._lock:
+            h = self.hist.get((name, label))
+            if h is None:
+                h = self.hist[(name, label)] = Histogram()
+            h.observe(seconds)
+
+    def inc(self, name: str, label: str, n: int = 1):
+        with self._lock:
+            self.counters[(name, label)] = self.counters.get((name, label), 0) + n
+
+    def counter(self, name: str) -> dict:
+        # {label: n} لعدّاد واحد
+        with self._lock:
+            return {label: n for (name_, label), n in self.counters.items() if name_ == name}
+
+    def render(self) -> str:
+        with self._lock:
+            hist = sorted(self.hist.items())
+            counters = sorted(self.counters.items())
+        out, seen = [], set()
+        def header(name, kind):
+            if name not in seen:
+                seen.add(name)
+                out.append(f"# HELP {name} {METRIC_LABELS[name][1]}")
+                out.append(f"# TYPE {name} {kind}")
+        for (name, label), h in hist:
+            header(name, "histogram")
+            tag = f'{METRIC_LABELS[name][0]}="{prom_escape(label)}"'
+            acc = 0
+            for le, c in zip(METRIC_BUCKETS + (float("inf"),), h.counts):
+                acc += c
+                out.append(f'{name}_bucket{{{tag},le="{"+Inf" if le == float("inf") else le}"}} {acc}')
+            out.append(f"{name}_sum{{{tag}}} {h.sum:.6f}")
+            out.append(f"{name}_count{{{tag}}} {h.count}")
+        for (name, label), n in counters:
+            header(name, "counter")
+            out.append(f'{name}{{{METRIC_LABELS[name][0]}="{prom_escape(label)}"}} {n}')
+        return "\n".join(out) + "\n"
+
+    def top(self, name: str, n: int, by: str = "p95") -> list:
+        # [(label, count, p50, p95, sum)] مرتبة تنازليًا بـ p95 أو بالوقت الإجمالي
+        with self._lock:
+            rows = [(label, h.count, h.quantile(0.5), h.quantile(0.95), h.sum)
+                    for (name_, label), h in self.hist.items() if name_ == name]
+        rows.sort(key=lambda r: r[3] if by == "p95" else r[4], reverse=True)
+        return rows[:n]
+
+def prom_escape(v: str) -> str:
+    return v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+metrics = Metrics()
+
+_SQL_TABLE = re.compile(r"\b(?:FROM|INTO|UPDATE|JOIN)\s+(\w+)", re.I)
+_SQL_DDL = re.compile(r"\b(?:TABLE|INDEX|TRIGGER)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?(\w+)", re.I)
+
+@lru_cache(maxsize=512)
+def sql_label(sql: str) -> str:
+    # وسم قليل التنوع: الفعل + أول جدول ("SELECT items")، والنص نفسه ثابت في الكود فيُخزَّن
+    verb = sql.split(None, 1)[0].upper() if sql.strip() else "?"
+    m = (_SQL_DDL if verb in ("CREATE", "DROP") else _SQL_TABLE).search(sql)
+    return f"{verb} {m.group(1)}" if m else verb
+
+# [طلبات جارية، رحلات، طلبات] للتحديث الجاري؛ يضبطها MetricsMiddleware. الرحلة تبدأ
+# حين يُرسل طلب ولا طلب آخر في الطريق، فالطلبات المتوازية (asyncio.gather) رحلة واحدة.
+_api_trips: contextvars.ContextVar = contextvars.ContextVar("api_trips", default=None)
+# UpdateProfile للتحديث المُحلَّل تُجمع فيه عباراته (قسم تحليل التحديثات البطيئة)؛ None
+# خارجه. المهام التي يطلقها التحديث ترث السياق وقد تعمل بعده، فلا يُضاف لملف مغلق
+_sql_trace: contextvars.ContextVar = contextvars.ContextVar("sql_trace", default=None)
+
+class TimedBot(Bot):
+    # كل استدعاءات bot.* تمر عبر request: تُعدّ وتُوقَّت لكل طريقة
+    async def request(self, method, data=None, files=None, **kwargs):
+        trips = _api_trips.get()
+        if trips is not None:
+            trips[1] += trips[0] == 0
+            trips[0] += 1
+            trips[2] += 1
+        t0 = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except Exception:
+            metrics.inc("bot_api_errors_total", method)
+            raise
+        finally:
+            metrics.observe("bot_api_seconds", method, time.perf_counter() - t0)
+            if trips is not None:
+                trips[0] -= 1
+
+bot = TimedBot(token=API_TOKEN, parse_mode="HTML",
+               server=TelegramAPIServer.from_base(BOT_API_SERVER) if BOT_API_SERVER else TELEGRAM_PRODUCTION)
 
 # ================== قاعدة البيانات ==================
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))       # عدد اتصالات القراءة الدائمة
+# ملف الأرشيف البارد (قسم أرشيف السلة) يُلحق بكل اتصال باسم archive
+ARCHIVE_PATH = os.getenv("ARCHIVE_PATH") or os.path.splitext(DB_PATH)[0] + ".archive.db"
+DB_BUSY_TIMEOUT = float(os.getenv("DB_BUSY_TIMEOUT", "30"))
+
+# تطبيع عربي للبحث: حذف التشكيل والتطويل، وتوحيد الألف والياء والتاء المربوطة،
+# وحذف "ال" التعريف من أول الكلمة حتى تطابق "احصاء" كلمة "الإحصاء".
+# يُسجَّل كدالة SQL باسم ar_norm لأن مشغّلات فهرس FTS تستدعيه عند كل كتابة،
+# لذا يجب فتح أي اتصال يكتب على items عبر db_connect().
+_AR_MARKS = re.compile("[\u0610-\u061a\u0640\u064b-\u065f\u0670\u06d6-\u06ed]")
+_AR_UNIFY = str.maketrans({"أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا", "ى": "ي", "ة": "ه"})
+_AR_ARTICLE = re.compile(r"\bال(?=\w{2})")
+
+def normalize_ar(text: Optional[str]) -> str:
+    if not text:
+        return ""
+    return _AR_ARTICLE.sub("", _AR_MARKS.sub("", text).translate(_AR_UNIFY)).lower()
+
+class TimedConnection(sqlite3.Connection):
+    # يوقّت كل عبارة (لـ SELECT يشمل ذلك إيجاد الصف الأول، وبقية الجلب خارجه)
+    def execute(self, sql, params=()):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            self._timed(sql, time.perf_counter() - t0)
+
+    def executemany(self, sql, seq):
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(sql, seq)
+        finally:
+            self._timed(sql, time.perf_counter() - t0)
+
+    @staticmethod
+    def _timed(sql: str, seconds: float):
+        metrics.observe("bot_sql_seconds", sql_label(sql), seconds)
+        prof = _sql_trace.get()
+        if prof is not None and not prof.closed:
+            prof.sql.append((sql, seconds))
+
 def db_connect():
-    return sqlite3.connect(DB_PATH)
+    con = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT, check_same_thread=False, factory=TimedConnection)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.create_function("ar_norm", 1, normalize_ar, deterministic=True)
+    # مشغّلات items_gen_* تبلّغ عن الفئات المتغيرة؛ يلتقطها كاتب Database فقط
+    con.create_function("catalog_touch", 1, lambda cat: None)
+    con.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_PATH,))
+    con.execute("PRAGMA archive.journal_mode=WAL")
+    # FULL: نسخ الدفعة إلى الأرشيف يثبت على القرص قبل حذفها من items
+    con.execute("PRAGMA archive.synchronous=FULL")
+    return con
 
-def db_init():
-    with closing(db_connect()) as con, con:
-        con.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            full_name TEXT,
-            is_registered INTEGER DEFAULT 0,
-            is_mod INTEGER DEFAULT 0,
-            created_at TEXT
-        )
-        """)
+class Database:
+    # طبقة وصول غير حاجبة: الاستعلامات تُنفَّذ في خيوط خارج حلقة الأحداث.
+    # القراءة عبر مجمع محدود من الاتصالات الدائمة، والكتابة عبر طابور واحد
+    # (خيط واحد واتصال واحد) فلا يتنافس كاتبان على قفل SQLite. في وضع العمال
+    # المتعددين لكل عملية كاتبها، فتبدأ كل معاملة كتابة بـ BEGIN IMMEDIATE: تأخذ
+    # القفل أولًا (بانتظار حتى DB_BUSY_TIMEOUT) بدل أن تفشل فورًا عند ترقية قفل
+    # قراءة قديم إلى كتابة.
+    # الفئات التي لمستها المعاملة (catalog_touch من المشغّلات) تُسلَّم لـ on_commit بعد
+    # COMMIT وقبل أن يستأنف المستدعي، فلا يُقرأ الجديد تحت جيل قديم ولا العكس.
+    def __init__(self, pool_size: int):
+        self.pool_size = max(1, pool_size)
+        self._readers: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        self._writer: Optional[sqlite3.Connection] = None
+        self._read_exec: Optional[ThreadPoolExecutor] = None
+        self._write_exec: Optional[ThreadPoolExecutor] = None
+        self._touched: set = set()
+        self.on_commit: Optional[Callable[[set], None]] = None
+
+    def _open(self):
+        if self._write_exec is not None:
+            return
+        for _ in range(self.pool_size):
+            self._readers.put(db_connect())
+        self._writer = db_connect()
+        self._writer.isolation_level = None   # المعاملات يديرها _run_write
+        self._writer.create_function("catalog_touch", 1, self._touched.add)
+        self._read_exec = ThreadPoolExecutor(self.pool_size, thread_name_prefix="db-read")
+        self._write_exec = ThreadPoolExecutor(1, thread_name_prefix="db-write")
+
+    def _run_read(self, fn: Callable, queued: float):
+        metrics.observe("bot_db_wait_seconds", "read", time.perf_counter() - queued)
+        con = self._readers.get()
+        try:
+            return fn(con)
+        finally:
+            self._readers.put(con)
+
+    def _run_write(self, fn: Callable, queued: float):
+        metrics.observe("bot_db_wait_seconds", "write", time.perf_counter() - queued)
+        # كل مهمة كتابة = معاملة واحدة (commit أو rollback)
+        con = self._writer
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(con)
+        except BaseException:
+            con.execute("ROLLBACK")
+            self._touched.clear()
+            raise
+        con.execute("COMMIT")
+        if self._touched:
+            touched = set(self._touched)
+            self._touched.clear()
+            if self.on_commit is not None:
+                self.on_commit(touched)
+        return result
+
+    @staticmethod
+    def _in_context(run: Callable) -> Callable:
+        # التحديث المُحلَّل يتتبّع عباراته في خيط القاعدة أيضًا، فيُمرَّر سياقه إليه
+        prof = _sql_trace.get()
+        return run if prof is None or prof.closed else partial(contextvars.copy_context().run, run)
+
+    async def read(self, fn: Callable):
+        self._open()
+        return await asyncio.get_running_loop().run_in_executor(
+            self._read_exec, self._in_context(self._run_read), fn, time.perf_counter())
+
+    async def write(self, fn: Callable):
+        self._open()
+        return await asyncio.get_running_loop().run_in_executor(
+            self._write_exec, self._in_context(self._run_write), fn, time.perf_counter())
+
+    async def fetchone(self, sql: str, params: tuple = ()):
+        return await self.read(lambda con: con.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql: str, params: tuple = ()):
+        return await self.read(lambda con: con.execute(sql, params).fetchall())
+
+    async def execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        return await self.write(lambda con: con.execute(sql, params))
+
+    def close(self):
+        if self._write_exec is None:
+            return
+        self._read_exec.shutdown(wait=True)
+        self._write_exec.shutdown(wait=True)
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
+        self._writer.close()
+        self._read_exec = self._write_exec = self._writer = None
+
+db = Database(DB_POOL_SIZE)
+
+# ================== المخطط والترحيلات ==================
+# الجداول تُنشأ وتتغير عبر MIGRATIONS المرتبة، ونسخة المخطط سطر لكل ترحيل في
+# schema_version. كل ترحيل معاملة BEGIN IMMEDIATE تعيد فحص النسخة بعد أخذ القفل،
+# فالعمال الذين يبدؤون معًا لا يطبّقونه مرتين. الترحيلات إضافية فقط (جداول وأعمدة
+# وفهارس جديدة، والقديم يُحذف بعد إنشاء بديله) فتعمل على قاعدة حية دون إعادة كتابة.
+# الفهارس والمشغّلات وجدول البحث معرّفة مرة واحدة في SCHEMA_OBJECTS، والترحيل الذي
+# يضيفها ينشئها بالاسم، وensure_objects يعيد عند كل بدء ما ينقص منها (بعد استيراد
+# منقطع مثلًا) ويملأ جدول البحث إن أُعيد إنشاؤه.
+FTS_PREFIX = "2 3 4 5"
+# ترتيب الصلة الدائم للجدول (الاسم أثقل وزنًا من الوصف)، فيُكتب ORDER BY rank ويرتب FTS5 داخليًا
+FTS_RANK_SQL = "INSERT INTO items_fts(items_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0)')"
+
+SCHEMA_OBJECTS = {   # الاسم -> (النوع، تعريف الإنشاء)
+    "idx_items_file_unique": ("INDEX", "CREATE UNIQUE INDEX IF NOT EXISTS idx_items_file_unique ON items(file_unique_id) WHERE file_unique_id IS NOT NULL"),
+    # صفحات الفئة: type=? AND status='active' ORDER BY created_at, id
+    "idx_items_type_status_created": ("INDEX", "CREATE INDEX IF NOT EXISTS idx_items_type_status_created ON items(type, status, created_at)"),
+    "idx_items_created": ("INDEX", "CREATE INDEX IF NOT EXISTS idx_items_created ON items(created_at DESC)"),
+    # السلة والكنس: status='trashed' ORDER BY deleted_at، والنشطة بالأحدث (deleted_at IS NULL)
+    "idx_items_status_deleted": ("INDEX", "CREATE INDEX IF NOT EXISTS idx_items_status_deleted ON items(status, deleted_at)"),
+    # صفحات "رفعاتي": عناصر المستخدم بترتيب الإضافة (rowid ملحق بالفهرس ضمنًا)
+    "idx_items_uploader": ("INDEX", "CREATE INDEX IF NOT EXISTS idx_items_uploader ON items(uploader_id, status, created_at)"),
+    # تغطي صفحات المستخدمين في الإدارة كاملة دون الرجوع للجدول
+    "idx_users_page": ("INDEX", "CREATE INDEX IF NOT EXISTS idx_users_page ON users(created_at, user_id, full_name, is_registered, is_mod)"),
+    "idx_outbox_next": ("INDEX", "CREATE INDEX IF NOT EXISTS idx_outbox_next ON outbox(next_at)"),
+    # حذف مهام العنصر من الطابور عند الدمج والحذف النهائي
+    "idx_outbox_item": ("INDEX", "CREATE INDEX IF NOT EXISTS idx_outbox_item ON outbox(item_id, kind)"),
+    # مسح الدمج: العناصر بلا file_unique_id فقط، ويصغر الفهرس كلما تقدم
+    "idx_items_unique_pending": ("INDEX", "CREATE INDEX IF NOT EXISTS idx_items_unique_pending ON items(id, file_id) WHERE file_unique_id IS NULL"),
+    "idx_fsm_updated": ("INDEX", "CREATE INDEX IF NOT EXISTS idx_fsm_updated ON fsm(updated_at)"),
+    # فهرس البحث النصي: يضم العناصر النشطة فقط (rowid = items.id) بنص مُطبَّع، وفهارس
+    # بادئات بأطوال FTS_PREFIX للبحث أثناء الكتابة
+    "items_fts": ("TABLE", f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(
+            name, caption, tokenize='unicode61', prefix='{FTS_PREFIX}'
+        )"""),
+    # تحافظ على items_fts عند الرفع والتعديل والحذف للسلة والاسترجاع والحذف النهائي
+    "items_fts_ai": ("TRIGGER", """
+        CREATE TRIGGER IF NOT EXISTS items_fts_ai AFTER INSERT ON items WHEN new.status='active' BEGIN
+            INSERT INTO items_fts(rowid, name, caption) VALUES (new.id, ar_norm(new.name), ar_norm(new.caption));
+        END"""),
+    "items_fts_au": ("TRIGGER", """
+        CREATE TRIGGER IF NOT EXISTS items_fts_au AFTER UPDATE OF name, caption, status ON items BEGIN
+            DELETE FROM items_fts WHERE rowid=old.id;
+            INSERT INTO items_fts(rowid, name, caption)
+                SELECT new.id, ar_norm(new.name), ar_norm(new.caption) WHERE new.status='active';
+        END"""),
+    "items_fts_ad": ("TRIGGER", """
+        CREATE TRIGGER IF NOT EXISTS items_fts_ad AFTER DELETE ON items BEGIN
+            DELETE FROM items_fts WHERE rowid=old.id;
+        END"""),
+    # أجيال الكتابة لذاكرة الصفحات (catalog_gen): كل ما يغيّر قائمة أو بحثًا يلمس فئته
+    "items_gen_ai": ("TRIGGER", """
+        CREATE TRIGGER IF NOT EXISTS items_gen_ai AFTER INSERT ON items BEGIN
+            SELECT catalog_touch(new.type);
+        END"""),
+    "items_gen_au": ("TRIGGER", """
+        CREATE TRIGGER IF NOT EXISTS items_gen_au AFTER UPDATE OF type, name, caption, file_id, status, deleted_at ON items BEGIN
+            SELECT catalog_touch(old.type), catalog_touch(new.type);
+        END"""),
+    "items_gen_ad": ("TRIGGER", """
+        CREATE TRIGGER IF NOT EXISTS items_gen_ad AFTER DELETE ON items BEGIN
+            SELECT catalog_touch(old.type);
+        END"""),
+    # عدادات الكتالوج: تُحدَّث عند كل إدراج/نقل/حذف، فالإحصاءات قراءة صفوف قليلة بدل
+    # COUNT(*) على items. counters_reconcile تعيد بناءها عند الانحراف.
+    "items_cnt2_ai": ("TRIGGER", """
+        CREATE TRIGGER IF NOT EXISTS items_cnt2_ai AFTER INSERT ON items BEGIN
+            INSERT INTO item_counts(type, status, n) VALUES (COALESCE(new.type, ''), COALESCE(new.status, ''), 1)
+                ON CONFLICT(type, status) DO UPDATE SET n = n + 1;
+            INSERT INTO uploader_counts(uploader_id, status, n, bytes)
+                VALUES (COALESCE(new.uploader_id, 0), COALESCE(new.status, ''), 1, COALESCE(new.file_size, 0))
+                ON CONFLICT(uploader_id, status) DO UPDATE SET n = n + 1, bytes = bytes + excluded.bytes;
+        END"""),
+    "items_cnt2_ad": ("TRIGGER", """
+        CREATE TRIGGER IF NOT EXISTS items_cnt2_ad AFTER DELETE ON items BEGIN
+            UPDATE item_counts SET n = n - 1 WHERE type=COALESCE(old.type, '') AND status=COALESCE(old.status, '');
+            UPDATE uploader_counts SET n = n - 1, bytes = bytes - COALESCE(old.file_size, 0)
+                WHERE uploader_id=COALESCE(old.uploader_id, 0) AND status=COALESCE(old.status, '');
+        END"""),
+    "items_cnt2_au": ("TRIGGER", """
+        CREATE TRIGGER IF NOT EXISTS items_cnt2_au AFTER UPDATE OF type, status, uploader_id, file_size ON items
+        WHEN old.type IS NOT new.type OR old.status IS NOT new.status OR old.uploader_id IS NOT new.uploader_id
+          OR old.file_size IS NOT new.file_size BEGIN
+            UPDATE item_counts SET n = n - 1 WHERE type=COALESCE(old.type, '') AND status=COALESCE(old.status, '');
+            UPDATE uploader_counts SET n = n - 1, bytes = bytes - COALESCE(old.file_size, 0)
+                WHERE uploader_id=COALESCE(old.uploader_id, 0) AND status=COALESCE(old.status, '');
+            INSERT INTO item_counts(type, status, n) VALUES (COALESCE(new.type, ''), COALESCE(new.status, ''), 1)
+                ON CONFLICT(type, status) DO UPDATE SET n = n + 1;
+            INSERT INTO uploader_counts(uploader_id, status, n, bytes)
+                VALUES (COALESCE(new.uploader_id, 0), COALESCE(new.status, ''), 1, COALESCE(new.file_size, 0))
+                ON CONFLICT(uploader_id, status) DO UPDATE SET n = n + 1, bytes = bytes + excluded.bytes;
+        END"""),
+}
+
+# كائنات أنشأها ترحيل قديم ثم استبدلها لاحق بنسخة باسم جديد: تبقى هنا ليعمل الترحيل
+# القديم كما طُبّق، ولا يعيدها ensure_objects بل يحذفها إن بقيت
+RETIRED_OBJECTS = {
+    # حلّت محلها items_cnt2_* مع bytes في الترحيل 4
+    "items_cnt_ai": ("TRIGGER", """
+        CREATE TRIGGER IF NOT EXISTS items_cnt_ai AFTER INSERT ON items BEGIN
+            INSERT INTO item_counts(type, status, n) VALUES (COALESCE(new.type, ''), COALESCE(new.status, ''), 1)
+                ON CONFLICT(type, status) DO UPDATE SET n = n + 1;
+            INSERT INTO uploader_counts(uploader_id, status, n) VALUES (COALESCE(new.uploader_id, 0), COALESCE(new.status, ''), 1)
+                ON CONFLICT(uploader_id, status) DO UPDATE SET n = n + 1;
+        END"""),
+    "items_cnt_ad": ("TRIGGER", """
+        CREATE TRIGGER IF NOT EXISTS items_cnt_ad AFTER DELETE ON items BEGIN
+            UPDATE item_counts SET n = n - 1 WHERE type=COALESCE(old.type, '') AND status=COALESCE(old.status, '');
+            UPDATE uploader_counts SET n = n - 1 WHERE uploader_id=COALESCE(old.uploader_id, 0) AND status=COALESCE(old.status, '');
+        END"""),
+    "items_cnt_au": ("TRIGGER", """
+        CREATE TRIGGER IF NOT EXISTS items_cnt_au AFTER UPDATE OF type, status, uploader_id ON items
+        WHEN old.type IS NOT new.type OR old.status IS NOT new.status OR old.uploader_id IS NOT new.uploader_id BEGIN
+            UPDATE item_counts SET n = n - 1 WHERE type=COALESCE(old.type, '') AND status=COALESCE(old.status, '');
+            UPDATE uploader_counts SET n = n - 1 WHERE uploader_id=COALESCE(old.uploader_id, 0) AND status=COALESCE(old.status, '');
+            INSERT INTO item_counts(type, status, n) VALUES (COALESCE(new.type, ''), COALESCE(new.status, ''), 1)
+                ON CONFLICT(type, status) DO UPDATE SET n = n + 1;
+            INSERT INTO uploader_counts(uploader_id, status, n) VALUES (COALESCE(new.uploader_id, 0), COALESCE(new.status, ''), 1)
+                ON CONFLICT(uploader_id, status) DO UPDATE SET n = n + 1;
+        END"""),
+}
+
+def create_objects(con: sqlite3.Connection, names) -> list:
+    # ينشئ الناقص من الكائنات المسماة؛ يعيد ما أُنشئ
+    existing = {r[0] for r in con.execute("SELECT name FROM sqlite_master")}
+    created = [name for name in names if name not in existing]
+    for name in created:
+        con.execute((SCHEMA_OBJECTS.get(name) or RETIRED_OBJECTS[name])[1])
+    if "items_fts" in created:
+        con.execute(FTS_RANK_SQL)
         con.execute("""
-        CREATE TABLE IF NOT EXISTS items (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            type TEXT,                      -- file | image | video | audio | app
-            file_id TEXT NOT NULL,
-            thumb_id TEXT,
-            name TEXT,
-            caption TEXT,
-            uploader_id INTEGER,
-            status TEXT DEFAULT 'active',   -- active | trashed
-            channel_msg_id INTEGER,
-            created_at TEXT,
-            deleted_at TEXT
-        )
+            INSERT INTO items_fts(rowid, name, caption)
+            SELECT id, ar_norm(name), ar_norm(caption) FROM items WHERE status='active'
         """)
-        con.execute("CREATE INDEX IF NOT EXISTS idx_items_type_status ON items(type, status)")
-        con.execute("CREATE INDEX IF NOT EXISTS idx_items_created ON items(created_at DESC)")
+    return created
+
+def _m1_baseline(con: sqlite3.Connection):
+    # المخطط كما كانت تنشئه db_init قبل الترحيلات؛ كل خطوة تتحقق مما هو موجود
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        full_name TEXT,
+        is_registered INTEGER DEFAULT 0,
+        is_mod INTEGER DEFAULT 0,
+        created_at TEXT
+    )
+    """)
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS items (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        type TEXT,                      -- file | image | video | audio | app
+        file_id TEXT NOT NULL,
+        thumb_id TEXT,
+        name TEXT,
+        caption TEXT,
+        uploader_id INTEGER,
+        status TEXT DEFAULT 'active',   -- active | trashed
+        channel_msg_id INTEGER,
+        created_at TEXT,
+        deleted_at TEXT,
+        file_unique_id TEXT             -- مفتاح المحتوى من تيليجرام لمنع التكرار
+    )
+    """)
+    if "file_unique_id" not in {r[1] for r in con.execute("PRAGMA table_info(items)")}:
+        con.execute("ALTER TABLE items ADD COLUMN file_unique_id TEXT")
+    con.execute("DROP INDEX IF EXISTS idx_items_type_status")
+    # طابور النسخ للقناة: صف لكل إرسال معلّق؛ next_at=NULL يعني متوقفًا بعد استنفاد المحاولات
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        item_id INTEGER,
+        kind TEXT,                      -- photo | video | audio | document | media_group | delete
+        payload TEXT,                   -- JSON
+        attempts INTEGER DEFAULT 0,
+        next_at REAL,
+        created_at REAL,
+        last_error TEXT
+    )
+    """)
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS fsm (
+        chat TEXT,
+        user TEXT,
+        state TEXT,
+        data TEXT,                      -- JSON
+        bucket TEXT,                    -- JSON
+        updated_at REAL,
+        PRIMARY KEY (chat, user)
+    ) WITHOUT ROWID
+    """)
+    # الاستيراد الجماعي: آخر سطر مُلتزم لكل ملف (الاسم:الحجم) ليُستأنف المنقطع من حيث توقف
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS import_jobs (
+        source TEXT PRIMARY KEY,
+        line INTEGER NOT NULL DEFAULT 0,
+        deferred TEXT,                  -- JSON: الجداول التي أُجّلت فهارسها
+        done INTEGER DEFAULT 0,
+        started_at TEXT,
+        updated_at TEXT
+    )
+    """)
+    counts_exist = con.execute("SELECT 1 FROM sqlite_master WHERE name='item_counts'").fetchone()
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS item_counts (
+        type TEXT,
+        status TEXT,
+        n INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (type, status)
+    ) WITHOUT ROWID
+    """)
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS uploader_counts (
+        uploader_id INTEGER,
+        status TEXT,
+        n INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (uploader_id, status)
+    ) WITHOUT ROWID
+    """)
+    # قواعد أقدم قد تحمل items_fts بفهارس بادئات أقصر: يُعاد بناؤه
+    fts_sql = con.execute("SELECT sql FROM sqlite_master WHERE name='items_fts'").fetchone()
+    if fts_sql is not None and f"prefix='{FTS_PREFIX}'" not in fts_sql[0]:
+        con.execute("DROP TABLE items_fts")
+    create_objects(con, ["idx_items_file_unique", "idx_items_type_status_created", "idx_items_created",
+                         "idx_items_status_deleted", "idx_outbox_next", "idx_fsm_updated",
+                         "items_fts", "items_fts_ai", "items_fts_au", "items_fts_ad",
+                         "items_cnt_ai", "items_cnt_ad", "items_cnt_au"])
+    if not counts_exist:
+        counters_reconcile(con)
+
+def _m2_covering_indexes(con: sqlite3.Connection):
+    create_objects(con, ["idx_users_page", "idx_outbox_item", "idx_items_unique_pending"])
+    # idx_users_page يغني عنه
+    con.execute("DROP INDEX IF EXISTS idx_users_created")
+    con.execute(FTS_RANK_SQL)
+
+def _m3_catalog_generations(con: sqlite3.Connection):
+    create_objects(con, ["items_gen_ai", "items_gen_au", "items_gen_ad"])
+
+def _m4_uploader_quota(con: sqlite3.Connection):
+    # حجم كل عنصر وبايتات كل رافع لحصص الرفع؛ items_cnt2_* تحل محل مشغّلات العدادات
+    # القديمة في المعاملة نفسها، فلا يفوت العدادين تغيير ولا يُحسب مرتين
+    if "file_size" not in {r[1] for r in con.execute("PRAGMA table_info(items)")}:
+        con.execute("ALTER TABLE items ADD COLUMN file_size INTEGER")
+    if "bytes" not in {r[1] for r in con.execute("PRAGMA table_info(uploader_counts)")}:
+        con.execute("ALTER TABLE uploader_counts ADD COLUMN bytes INTEGER NOT NULL DEFAULT 0")
+    for name in ("items_cnt_ai", "items_cnt_ad", "items_cnt_au"):
+        con.execute(f"DROP TRIGGER IF EXISTS {name}")
+    create_objects(con, ["items_cnt2_ai", "items_cnt2_ad", "items_cnt2_au", "idx_items_uploader"])
+    counters_reconcile(con)
+
+def _m5_broadcasts(con: sqlite3.Connection):
+    # بث المالك: صف لكل بث، ونقطة استئنافه تُحدَّث أثناء الإرسال (قسم البث الجماعي)
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        from_chat INTEGER,
+        message_id INTEGER,             -- الرسالة المنسوخة للمستلمين
+        status TEXT,                    -- running | done | cancelled
+        last_user INTEGER DEFAULT 0,    -- كل مستلم حتى هذا المعرّف عولج
+        total INTEGER,
+        sent INTEGER DEFAULT 0,
+        blocked INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        progress_chat INTEGER,          -- رسالة التقدم لدى المالك
+        progress_msg INTEGER,
+        created_at TEXT,
+        updated_at TEXT
+    )
+    """)
+
+# الصفوف السابقة للترحيل 6 بلا media_kind، ومصدره الوحيد لها file_id نفسه: أول 4 بايت
+# بعد فك base64 وضغط الأصفار. صيغة غير موثقة، فتُقرأ مرة واحدة هنا (وللنسخ المستوردة
+# من تصدير قديم)، وما تعذّر فهمه يُرسل وثيقة
+_FILE_ID_KINDS = {2: "photo", 4: "video", 9: "audio"}
+
+def legacy_file_kind(file_id: str) -> str:
+    try:
+        raw = base64.urlsafe_b64decode(file_id + "=" * (-len(file_id) % 4))
+    except ValueError:
+        return "document"
+    head, i = bytearray(), 0
+    while len(head) < 4 and i < len(raw):
+        if raw[i] == 0 and i + 1 < len(raw):
+            head += b"\0" * raw[i + 1]
+            i += 2
+        else:
+            head.append(raw[i])
+            i += 1
+    type_id = int.from_bytes(head[:4], "little") & ~(3 << 24)    # بدون أعلام المرجع والموقع
+    return _FILE_ID_KINDS.get(type_id, "document")
+
+def media_kind_backfill(con: sqlite3.Connection, table: str = "items") -> int:
+    con.create_function("legacy_file_kind", 1, legacy_file_kind, deterministic=True)
+    return con.execute(f"UPDATE {table} SET media_kind = legacy_file_kind(file_id) WHERE media_kind IS NULL").rowcount
+
+def _m6_media_kind(con: sqlite3.Connection):
+    # نوع الإرسال (photo/video/audio/document) يُخزَّن عند الرفع لنتائج البحث المضمّن
+    if "media_kind" not in {r[1] for r in con.execute("PRAGMA table_info(items)")}:
+        con.execute("ALTER TABLE items ADD COLUMN media_kind TEXT")
+    media_kind_backfill(con)
+
+def _m7_checkpoints(con: sqlite3.Connection):
+    # نقطة استئناف المهام الطويلة التي تمر على items بمؤشر id (مثل /dedup)
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS checkpoints (
+        name TEXT PRIMARY KEY,
+        last_id INTEGER NOT NULL DEFAULT 0,
+        updated_at TEXT
+    )
+    """)
+
+MIGRATIONS = [   # (النسخة، الوصف، الدالة) بترتيب التطبيق؛ لا يُعدَّل ترحيل طُبّق، بل يُضاف غيره
+    (1, "baseline", _m1_baseline),
+    (2, "covering indexes for hot queries", _m2_covering_indexes),
+    (3, "catalog write-generation triggers", _m3_catalog_generations),
+    (4, "uploader index, file sizes and byte counters", _m4_uploader_quota),
+    (5, "broadcasts", _m5_broadcasts),
+    (6, "stored media kind", _m6_media_kind),
+    (7, "job checkpoints", _m7_checkpoints),
+]
+
+def schema_version(con: sqlite3.Connection) -> int:
+    return con.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+def migrate(con: sqlite3.Connection) -> list:
+    # con بلا معاملات ضمنية (isolation_level=None)؛ يعيد النسخ المطبقة الآن
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        name TEXT,
+        applied_at TEXT,
+        seconds REAL
+    )
+    """)
+    applied = []
+    for version, name, fn in MIGRATIONS:
+        if version <= schema_version(con):
+            continue
+        t0 = time.perf_counter()
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            if version <= schema_version(con):    # طبّقه عامل آخر أثناء انتظار القفل
+                con.execute("ROLLBACK")
+                continue
+            fn(con)
+            con.execute("INSERT INTO schema_version(version, name, applied_at, seconds) VALUES (?,?,?,?)",
+                        (version, name, datetime.utcnow().isoformat(timespec="seconds"), time.perf_counter() - t0))
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+        con.execute("COMMIT")
+        logging.info("schema: طُبّق الترحيل %d (%s) في %.2fث", version, name, time.perf_counter() - t0)
+        applied.append(version)
+    return applied
+
+def ensure_objects(con: sqlite3.Connection) -> list:
+    # يعيد ما حُذف من كائنات النسخة الحالية (مثل استيراد انقطع بعد تأجيل فهارسه)
+    existing = {r[0] for r in con.execute("SELECT name FROM sqlite_master")}
+    retired = [name for name in RETIRED_OBJECTS if name in existing]
+    if not retired and all(name in existing for name in SCHEMA_OBJECTS):
+        return []
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        for name in retired:
+            con.execute(f"DROP {RETIRED_OBJECTS[name][0]} IF EXISTS {name}")
+        created = create_objects(con, SCHEMA_OBJECTS)
+    except BaseException:
+        con.execute("ROLLBACK")
+        raise
+    con.execute("COMMIT")
+    if created:
+        logging.warning("schema: أُعيد إنشاء %s", ", ".join(created))
+    return created
+
+# الأرشيف ملف مستقل قد يُنقل أو يُحذف وحده، فمخططه لا يدخل schema_version بل يُنشأ
+# عند كل بدء إن نقص. الجدول بأعمدة items نفسها، وعدّاده بالمشغّلات كعدادات الكتالوج،
+# ومشغّلا الأجيال يبطلان صفحات السلة المخزّنة عند حذف المؤرشف أو استرجاعه.
+ARCHIVE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS archive.items (
+        id INTEGER PRIMARY KEY,
+        type TEXT,
+        file_id TEXT NOT NULL,
+        thumb_id TEXT,
+        name TEXT,
+        caption TEXT,
+        uploader_id INTEGER,
+        status TEXT,
+        channel_msg_id INTEGER,
+        created_at TEXT,
+        deleted_at TEXT,
+        file_unique_id TEXT,
+        archived_at TEXT,
+        file_size INTEGER,
+        media_kind TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS archive.idx_archive_deleted ON items(deleted_at)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_archive_unique ON items(file_unique_id) WHERE file_unique_id IS NOT NULL",
+    "CREATE TABLE IF NOT EXISTS archive.counts (name TEXT PRIMARY KEY, n INTEGER NOT NULL DEFAULT 0)",
+    "INSERT OR IGNORE INTO archive.counts(name, n) SELECT 'items', COUNT(*) FROM archive.items",
+    # عدّاد لكل نوع ('type:<النوع>') ليظهر المؤرشف في سطور الأقسام بالإحصاءات دون مسح الأرشيف
+    "INSERT OR IGNORE INTO archive.counts(name, n) SELECT 'type:' || COALESCE(type, ''), COUNT(*) FROM archive.items GROUP BY 1",
+    """
+    CREATE TRIGGER IF NOT EXISTS archive.archive_ai AFTER INSERT ON items BEGIN
+        UPDATE counts SET n = n + 1 WHERE name='items';
+        SELECT catalog_touch(new.type);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS archive.archive_ad AFTER DELETE ON items BEGIN
+        UPDATE counts SET n = n - 1 WHERE name='items';
+        SELECT catalog_touch(old.type);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS archive.archive_type_ai AFTER INSERT ON items BEGIN
+        INSERT INTO counts(name, n) VALUES ('type:' || COALESCE(new.type, ''), 1)
+        ON CONFLICT(name) DO UPDATE SET n = n + 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS archive.archive_type_ad AFTER DELETE ON items BEGIN
+        UPDATE counts SET n = n - 1 WHERE name = 'type:' || COALESCE(old.type, '');
+    END
+    """,
+]
+
+def db_init():
+    with closing(db_connect()) as con:
+        con.isolation_level = None
+        migrate(con)
+        ensure_objects(con)
+        for ddl in ARCHIVE_SCHEMA:
+            con.execute(ddl)
+        # أرشيف أُنشئ قبل عمود file_size (الترحيل 4)
+        columns = {r[1] for r in con.execute("PRAGMA archive.table_info(items)")}
+        if "file_size" not in columns:
+            con.execute("ALTER TABLE archive.items ADD COLUMN file_size INTEGER")
+        # وقبل media_kind (الترحيل 6)
+        if "media_kind" not in columns:
+            con.execute("ALTER TABLE archive.items ADD COLUMN media_kind TEXT")
+            media_kind_backfill(con, "archive.items")
+
+# (الجدول، عمود المفتاح، تعبيره في items، عمود القيمة -> تجميعه في items)
+COUNTER_TABLES = [
+    ("item_counts", "type", "COALESCE(type, '')", {"n": "COUNT(*)"}),
+    ("uploader_counts", "uploader_id", "COALESCE(uploader_id, 0)", {"n": "COUNT(*)", "bytes": "COALESCE(SUM(file_size), 0)"}),
+]
+
+def counters_reconcile(con: sqlite3.Connection) -> int:
+    # يقارن العدادات بالعدّ الفعلي ويعيد بناء أي جدول منحرف؛ يعيد عدد المفاتيح المختلفة.
+    # مسح كامل لـ items، لذا يُشغَّل نادرًا وداخل معاملة الكاتب حتى لا تتغير البيانات أثناءه.
+    # عمود قيمة لم يضفه ترحيله بعد (bytes قبل الترحيل 4) يُتخطى، فيعمل من أي ترحيل.
+    drift = 0
+    for table, key, key_expr, aggregates in COUNTER_TABLES:
+        present = {r[1] for r in con.execute(f"PRAGMA table_info({table})")}
+        values = [c for c in aggregates if c in present]
+        cols = ", ".join(values)
+        expected_sql = (f"SELECT {key_expr}, COALESCE(status, ''), {', '.join(aggregates[c] for c in values)} "
+                        f"FROM items GROUP BY 1, 2")
+        expected = {(k, st): tuple(v) for k, st, *v in con.execute(expected_sql)}
+        actual = {(k, st): tuple(v) for k, st, *v in con.execute(f"SELECT {key}, status, {cols} FROM {table} WHERE n != 0")}
+        diff = {k for k in expected.keys() | actual.keys() if expected.get(k) != actual.get(k)}
+        if diff:
+            drift += len(diff)
+            con.execute(f"DELETE FROM {table}")
+            con.executemany(f"INSERT INTO {table}({key}, status, {cols}) VALUES ({', '.join('?' * (len(values) + 2))})",
+                            [(k, st) + v for (k, st), v in expected.items()])
+    # عدادات الأرشيف؛ جدولها ينشئه ARCHIVE_SCHEMA بعد الترحيلات، فقد لا يوجد بعد
+    if con.execute("SELECT 1 FROM archive.sqlite_master WHERE name='counts'").fetchone():
+        expected = dict(con.execute("SELECT 'type:' || COALESCE(type, ''), COUNT(*) FROM archive.items GROUP BY 1"))
+        expected["items"] = sum(expected.values())
+        actual = dict(con.execute("SELECT name, n FROM archive.counts WHERE n != 0 OR name='items'"))
+        diff = {k for k in expected.keys() | actual.keys() if expected.get(k) != actual.get(k)}
+        if diff:
+            drift += len(diff)
+            con.execute("DELETE FROM archive.counts")
+            con.executemany("INSERT INTO archive.counts(name, n) VALUES (?, ?)", expected.items())
+    return drift
+
 db_init()
 
+# الاستعلامات الساخنة مسجلة بأسماء ليفحص check-plans خطة كل منها (قسم فحص الخطط)
+HOT_SQL: Dict[str, str] = {}
+
+def hot(name: str, sql: str) -> str:
+    HOT_SQL[name] = sql
+    return sql
+
+# ================== تخزين حالات FSM في SQLite ==================
+# الحالات تبقى بعد إعادة التشغيل وتُشارك عبر ملف القاعدة نفسه. القراءة والكتابة
+# من نسخة في الذاكرة، والتغييرات تُكتب للقرص دفعةً كل FSM_FLUSH_INTERVAL
+# (write-behind) بدل commit عند كل update_data. الحالات المهجورة أقدم من
+# FSM_TTL تُحذف، والمدخلات الخاملة تُخرج من الذاكرة.
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "2"))
+FSM_TTL = float(os.getenv("FSM_TTL", str(24 * 3600)))
+FSM_CACHE_IDLE = 600
+FSM_SWEEP_INTERVAL = 600
+
+FSM_LOAD_SQL = hot("fsm load", "SELECT state, data, bucket, updated_at FROM fsm WHERE chat=? AND user=?")
+FSM_SWEEP_SQL = hot("fsm sweep", "DELETE FROM fsm WHERE updated_at < ?")
+
+class SQLiteStorage(BaseStorage):
+    def __init__(self, flush_interval: float, ttl: float):
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self._entries: dict = {}   # (chat, user) -> {"state", "data", "bucket", "updated", "seen"}
+        self._dirty: set = set()
+        self._task: Optional[asyncio.Task] = None
+        self._last_sweep = time.monotonic()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _entry(self, chat, user) -> Tuple[tuple, dict]:
+        chat, user = self.check_address(chat=chat, user=user)
+        key = (str(chat), str(user))
+        entry = self._entries.get(key)
+        if entry is None:
+            row = await db.fetchone(FSM_LOAD_SQL, key)
+            loaded = {"state": row[0], "data": json.loads(row[1]), "bucket": json.loads(row[2]), "updated": row[3]} if row \
+                else {"state": None, "data": {}, "bucket": {}, "updated": 0.0}
+            entry = self._entries.setdefault(key, loaded)
+        entry["seen"] = time.monotonic()
+        if (entry["state"] is not None or entry["data"]) and entry["updated"] < time.time() - self.ttl:
+            # حالة مهجورة: تُنسى كأن المستخدم أنهاها
+            entry["state"], entry["data"] = None, {}
+            self._touch(key, entry)
+        return key, entry
+
+    def _touch(self, key: tuple, entry: dict):
+        entry["updated"] = time.time()
+        self._dirty.add(key)
+
+    async def get_state(self, *, chat=None, user=None, default=None) -> Optional[str]:
+        _, entry = await self._entry(chat, user)
+        return entry["state"] if entry["state"] is not None else self.resolve_state(default)
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        key, entry = await self._entry(chat, user)
+        entry["state"] = self.resolve_state(state)
+        self._touch(key, entry)
+
+    async def get_data(self, *, chat=None, user=None, default=None) -> dict:
+        _, entry = await self._entry(chat, user)
+        return copy.deepcopy(entry["data"]) if entry["data"] or default is None else copy.deepcopy(default)
+
+    async def set_data(self, *, chat=None, user=None, data: dict = None):
+        key, entry = await self._entry(chat, user)
+        entry["data"] = copy.deepcopy(data or {})
+        self._touch(key, entry)
+
+    async def update_data(self, *, chat=None, user=None, data: dict = None, **kwargs):
+        key, entry = await self._entry(chat, user)
+        entry["data"].update(copy.deepcopy(data or {}), **kwargs)
+        self._touch(key, entry)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default=None) -> dict:
+        _, entry = await self._entry(chat, user)
+        return copy.deepcopy(entry["bucket"]) if entry["bucket"] or default is None else copy.deepcopy(default)
+
+    async def set_bucket(self, *, chat=None, user=None, bucket: dict = None):
+        key, entry = await self._entry(chat, user)
+        entry["bucket"] = copy.deepcopy(bucket or {})
+        self._touch(key, entry)
+
+    async def update_bucket(self, *, chat=None, user=None, bucket: dict = None, **kwargs):
+        key, entry = await self._entry(chat, user)
+        entry["bucket"].update(copy.deepcopy(bucket or {}), **kwargs)
+        self._touch(key, entry)
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        keys, self._dirty = self._dirty, set()
+        upserts, deletes = [], []
+        for key in keys:
+            e = self._entries.get(key)
+            if e is None:
+                continue
+            if e["state"] is None and not e["data"] and not e["bucket"]:
+                deletes.append(key)
+            else:
+                upserts.append(key + (e["state"], json.dumps(e["data"]), json.dumps(e["bucket"]), e["updated"]))
+        def write(con):
+            con.executemany("""
+                INSERT INTO fsm(chat, user, state, data, bucket, updated_at) VALUES(?,?,?,?,?,?)
+                ON CONFLICT(chat, user) DO UPDATE SET state=excluded.state, data=excluded.data,
+                    bucket=excluded.bucket, updated_at=excluded.updated_at
+            """, upserts)
+            con.executemany("DELETE FROM fsm WHERE chat=? AND user=?", deletes)
+        try:
+            await db.write(write)
+        except Exception:
+            self._dirty |= keys
+            raise
+
+    async def _sweep(self):
+        cutoff = time.monotonic() - FSM_CACHE_IDLE
+        for key in [k for k, e in self._entries.items() if e["seen"] < cutoff and k not in self._dirty]:
+            del self._entries[key]
+        if time.monotonic() - self._last_sweep >= FSM_SWEEP_INTERVAL:
+            self._last_sweep = time.monotonic()
+            await db.execute(FSM_SWEEP_SQL, (time.time() - self.ttl,))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                await self._sweep()
+            except Exception:
+                logging.exception("fsm: فشل حفظ الحالات")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await self.flush()
+
+    async def wait_closed(self):
+        pass
+
+dp = Dispatcher(bot, storage=SQLiteStorage(FSM_FLUSH_INTERVAL, FSM_TTL))
+
+# مهمة دورية تطابق العدادات مع items وتصلحها إن انحرفت (كتابة خارج المشغّلات أو تعديل يدوي)
+COUNTS_RECONCILE_INTERVAL = float(os.getenv("COUNTS_RECONCILE_INTERVAL", str(6 * 3600)))
+
+async def counters_job():
+    while True:
+        await asyncio.sleep(COUNTS_RECONCILE_INTERVAL)
+        try:
+            drift = await db.write(counters_reconcile)
+            if drift:
+                logging.warning("counters: أُعيد بناء العدادات، %d مفتاح منحرف", drift)
+        except Exception:
+            logging.exception("counters: فشلت المطابقة")
+
 # ================== الأدوات المساعدة ==================
 CAT_TYPES = ["file", "image", "video", "audio", "app"]
 
@@ -66,28 +993,130 @@ def now_str():
 def user_is_owner(uid: int) -> bool:
     return uid == OWNER_ID
 
-def user_is_mod(uid: int) -> bool:
-    with closing con:
-        row = con.execute("SELECT is_mod FROM users WHERE user_id=?", (uid,)).fetchone()
-    return bool(row and row[0]) or user_is_owner(uid)
-
-def ensure_user(u: types.User):
-    with closing(db_connect()) as con, con:
-        exists = con.execute("SELECT 1 FROM users WHERE user_id=?", (u.id,)).fetchone()
-        if not exists:
-            con.execute(
-                "INSERT INTO users(user_id, full_name, is_registered, is_mod, created_at) VALUES(?,?,?,?,?)",
-                (u.id, u.full_name, 0, 0, now_str())
-            )
-
-def register_user(uid: int):
-    with closing(db_connect()) as con, con:
-        con.execute("UPDATE users SET is_registered=1 WHERE user_id=?", (uid,))
-
-def user_is_registered(uid: int) -> bool:
-    with closing(db_connect()) as con:
-        row = con.execute("SELECT is_registered FROM users WHERE user_id=?", (uid,)).fetchone()
-    return bool(row and row[0])
+# ذاكرة مؤقتة (LRU + TTL). user_cache لحالة المستخدم: (is_registered, is_mod) أو None
+# إن لم يوجد، وتُبطَل عند كل كتابة على users حتى لا تُقرأ صلاحية قديمة.
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "300"))
+
+class LRUCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[object, Tuple[float, object]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return _MISSING
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        ratio = (self.hits / total * 100) if total else 0.0
+        return f"hits={self.hits} misses={self.misses} ({ratio:.1f}%) size={len(self._data)}"
+
+_MISSING = object()
+user_cache = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+# في وضع العمال المتعددين (قسم العمال أدناه) لكل عملية ذاكرتها المؤقتة، فما يُبطَل
+# محليًا يُبلَّغ لبقية العمال عبر المشرف ويُطبَّق عندهم NOTIFY_HANDLERS[kind](key).
+WORKER_INDEX: Optional[int] = None        # رقم العامل؛ None = عملية واحدة
+_worker_bus = None                        # طابور العامل إلى المشرف
+NOTIFY_HANDLERS: Dict[str, Callable] = {"user": user_cache.invalidate}
+
+def notify_workers(kind: str, key=None):
+    if _worker_bus is not None:
+        _worker_bus.put(("notify", kind, key, WORKER_INDEX))
+
+# ذاكرة الصفحات: صفحات الفئات والسلة المعروضة (نص + أزرار) ونتائج البحث، بمفتاح يضم
+# جيل الكتابة لفئتها. مشغّلات items_gen_* تجمع الفئات التي لمستها كل معاملة، وكاتب
+# Database يرفع أجيالها بعد COMMIT (و"*" معها لما يشمل كل الفئات: السلة والبحث العام)،
+# فكل كتابة (رفع، تعديل، حذف للسلة، استرجاع، حذف نهائي، دمج) تُبطل ما يخصها دون تتبع
+# مفاتيح. المدخلات القديمة لا تُقرأ بعدها ويطردها LRU. PAGE_CACHE_TTL حد أعلى لما
+# يكتبه خارج الكاتب (استيراد سطر الأوامر من عملية أخرى).
+PAGE_CACHE_SIZE = int(os.getenv("PAGE_CACHE_SIZE", "2000"))
+PAGE_CACHE_TTL = float(os.getenv("PAGE_CACHE_TTL", "600"))
+
+class CatalogGenerations:
+    def __init__(self):
+        self._lock = threading.Lock()   # يرفعها خيط الكاتب ومعالج إشعارات العمال
+        self._gen: Dict[str, int] = {}
+
+    def get(self, cat: str = "*") -> int:
+        return self._gen.get(cat, 0)
+
+    def bump(self, cats):
+        with self._lock:
+            for c in set(cats) | {"*"}:
+                self._gen[c] = self._gen.get(c, 0) + 1
+
+catalog_gen = CatalogGenerations()
+page_cache = LRUCache(PAGE_CACHE_SIZE, PAGE_CACHE_TTL)
+
+def catalog_committed(cats: set):
+    # من خيط الكاتب بعد COMMIT
+    catalog_gen.bump(cats)
+    notify_workers("catalog", sorted(c for c in cats if c is not None))
+
+db.on_commit = catalog_committed
+NOTIFY_HANDLERS["catalog"] = catalog_gen.bump
+
+USER_STATE_SQL = hot("user state", "SELECT is_registered, is_mod FROM users WHERE user_id=?")
+
+def _read_user_state(con, uid: int) -> Optional[Tuple[bool, bool]]:
+    row = con.execute(USER_STATE_SQL, (uid,)).fetchone()
+    return (bool(row[0]), bool(row[1])) if row else None
+
+async def user_state(uid: int) -> Optional[Tuple[bool, bool]]:
+    state = user_cache.get(uid)
+    if state is _MISSING:
+        state = await db.read(lambda con: _read_user_state(con, uid))
+        user_cache.put(uid, state)
+    return state
+
+async def user_is_mod(uid: int) -> bool:
+    if user_is_owner(uid):
+        return True
+    state = await user_state(uid)
+    return bool(state and state[1])
+
+async def ensure_user(u: types.User):
+    # من الذاكرة أولاً حتى لا يمر كل تحديث عبر طابور الكتابة
+    if await user_state(u.id) is not None:
+        return
+    def insert(con):
+        con.execute(
+            "INSERT OR IGNORE INTO users(user_id, full_name, is_registered, is_mod, created_at) VALUES(?,?,?,?,?)",
+            (u.id, u.full_name, 0, 0, now_str())
+        )
+        return _read_user_state(con, u.id)
+    user_cache.put(u.id, await db.write(insert))
+
+async def register_user(uid: int):
+    await db.execute("UPDATE users SET is_registered=1 WHERE user_id=?", (uid,))
+    user_cache.invalidate(uid)
+    notify_workers("user", uid)
+
+async def user_is_registered(uid: int) -> bool:
+    state = await user_state(uid)
+    return bool(state and state[0])
 
 def infer_doc_type(doc: types.Document) -> str:
     # apps/برامج: ملفات EXE, APK, DMG, MSI, etc.
@@ -109,56 +1138,656 @@ def infer_doc_type(doc: types.Document) -> str:
         return "app"
     return "file"
 
+# ================== طبقة الردود ==================
+# respond يجيب الزر ويعدّل رسالته بالتوازي (رحلة واحدة بدل اثنتين). آخر نص وأزرار
+# أُرسلت لكل رسالة تُحفظ بصمتها، فالتعديل المطابق (إعادة فتح القائمة نفسها) لا يُرسل
+# أصلًا بدل أن يرده تيليجرام بـ MessageNotModified. أي تعديل لرسالة سبق عرضها بـ respond
+# يمر عبر edit_message حتى تبقى البصمة صحيحة. الردود اللاحقة غير العاجلة (تأكيدات
+# الرفع) تُجمع لكل محادثة FOLLOWUP_DELAY ثانية وتُرسل رسالة واحدة، والمكرر منها سطر
+# واحد بعدّاد.
+RENDERED_CACHE_SIZE = int(os.getenv("RENDERED_CACHE_SIZE", "20000"))
+RENDERED_CACHE_TTL = 48 * 3600     # تيليجرام لا يسمح بتعديل الرسائل الأقدم
+FOLLOWUP_DELAY = float(os.getenv("FOLLOWUP_DELAY", "0.7"))
+rendered_cache = LRUCache(RENDERED_CACHE_SIZE, RENDERED_CACHE_TTL)
+
+def render_digest(text: str, reply_markup) -> int:
+    return hash((text, reply_markup.as_json() if reply_markup is not None else None))
+
+async def edit_message(message: types.Message, text: str, reply_markup=None):
+    await edit_message_at(message.chat.id, message.message_id, text, reply_markup)
+
+async def edit_message_at(chat_id: int, message_id: int, text: str, reply_markup=None):
+    # لتعديل رسالة لا يُحمل كائنها (مهام الخلفية بعد إعادة التشغيل)؛ الذاكرة نفسها
+    key = (chat_id, message_id)
+    digest = render_digest(text, reply_markup)
+    if rendered_cache.get(key) == digest:
+        metrics.inc("bot_edits_skipped_total", "same")
+        return
+    try:
+        await bot.edit_message_text(text, chat_id, message_id, reply_markup=reply_markup)
+    except MessageNotModified:
+        metrics.inc("bot_edits_skipped_total", "not_modified")
+    except Exception:
+        rendered_cache.invalidate(key)
+        raise
+    rendered_cache.put(key, digest)
+
+async def respond(call: CallbackQuery, text: str, reply_markup=None, note: Optional[str] = None,
+                  show_alert: bool = False):
+    await asyncio.gather(call.answer(note, show_alert=show_alert), edit_message(call.message, text, reply_markup))
+
+class FollowupBatcher:
+    def __init__(self):
+        self._pending: Dict[int, dict] = {}   # chat_id -> {"lines": {text: n}, "markup"}
+
+    def add(self, chat_id: int, text: str, reply_markup=None):
+        entry = self._pending.get(chat_id)
+        if entry is None:
+            entry = self._pending[chat_id] = {"lines": {}, "markup": None}
+            asyncio.get_running_loop().call_later(FOLLOWUP_DELAY, lambda: asyncio.ensure_future(self.flush(chat_id)))
+        entry["lines"][text] = entry["lines"].get(text, 0) + 1
+        if reply_markup is not None:
+            entry["markup"] = reply_markup
+
+    async def flush(self, chat_id: int):
+        entry = self._pending.pop(chat_id, None)
+        if entry is None:
+            return
+        lines = [text if n == 1 else f"{text} (×{n})" for text, n in entry["lines"].items()]
+        chunks, size = [[]], 0
+        for line in lines:
+            if size + len(line) > 4000 and chunks[-1]:
+                chunks.append([])
+                size = 0
+            chunks[-1].append(line)
+            size += len(line) + 1
+        try:
+            for i, chunk in enumerate(chunks):
+                await bot.send_message(chat_id, "\n".join(chunk),
+                                       reply_markup=entry["markup"] if i == len(chunks) - 1 else None)
+        except Exception:
+            logging.exception("followup: تعذّر الإرسال إلى %s", chat_id)
+
+    async def flush_all(self):
+        for chat_id in list(self._pending):
+            await self.flush(chat_id)
+
+followups = FollowupBatcher()
+
+# ================== موجّه الأزرار (callback router) ==================
+# معالج واحد لكل الأزرار: تُحلَّل callback_data مرة واحدة إلى (معالج، معاملات
+# مُنمّطة) ثم يُستدعى المعالج مباشرة عبر قاموس بدل تقييم مرشّحات lambda بالتتابع.
+# الصيغة المضغوطة v1: "<الإصدار><رمز الإجراء>:<معامل>:..." والأعداد بأساس 36،
+# مثل "1iv:2s" بدل "item:view:100". الصيغة القديمة (v0) "item:view:100" تبقى
+# مقبولة لأزرار الرسائل المرسلة قبل التحديث.
+CB_VERSION = "1"
+CALLBACK_DATA_MAX = 64   # حد تيليجرام بالبايت
+
+_B36 = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+def b36(n: int) -> str:
+    out = ""
+    while True:
+        n, r = divmod(n, 36)
+        out = _B36[r] + out
+        if not n:
+            return out
+
+def callback(data: str) -> str:
+    # يبقى مع python -O: الزر الأطول يرفضه تيليجرام عند الإرسال بخطأ لا يدل على سببه
+    if len(data.encode()) > CALLBACK_DATA_MAX:
+        raise ValueError(f"بيانات الزر تتجاوز {CALLBACK_DATA_MAX} بايت: {data}")
+    return data
+
+def page_arg(text: str, base: int) -> int:
+    return 1 if text == "recent" else int(text, base)
+
+class CallbackRouter:
+    def __init__(self):
+        self._by_code: dict = {}   # "iv" -> route
+        self._by_name: dict = {}   # "item:view" -> route (v0)
+        self._codes: dict = {}     # "item:view" -> "iv"
+        self._names: dict = {}     # "iv" -> "item:view"
+
+    def route(self, name: str, code: Optional[str], *arg_types, rest: bool = False):
+        # rest=True: ما يتبقى من الأجزاء يُمرَّر كقائمة (مثل مؤشر الترقيم)
+        def deco(fn):
+            wants_state = "state" in inspect.signature(fn).parameters
+            self._by_name[name] = (fn, self._converters(arg_types, 10), len(arg_types), rest, wants_state)
+            if code is not None:
+                self._by_code[code] = (fn, self._converters(arg_types, 36), len(arg_types), rest, wants_state)
+                self._codes[name] = code
+                self._names[code] = name
+            return fn
+        return deco
+
+    @staticmethod
+    def _converters(arg_types: tuple, base: int) -> tuple:
+        # تُجهَّز دوال التحويل مرة واحدة عند التسجيل لا عند كل نقرة
+        return tuple((lambda p: int(p, base)) if t is int else None if t is str else (lambda p, t=t: t(p, base))
+                     for t in arg_types)
+
+    def cb(self, name: str, *args) -> str:
+        data = CB_VERSION + self._codes[name]
+        for a in args:
+            data += ":" + (b36(a) if isinstance(a, int) else str(a))
+        return callback(data)
+
+    def parse(self, data: str):
+        parts = data.split(":")
+        if data[:1] == CB_VERSION:
+            route = self._by_code.get(parts[0][1:])
+            del parts[0]
+        else:
+            route = None
+            for n in (3, 2, 1):
+                route = self._by_name.get(":".join(parts[:n]))
+                if route is not None:
+                    del parts[:n]
+                    break
+        if route is None:
+            return None
+        fn, converters, nargs, rest, wants_state = route
+        if len(parts) < nargs or (len(parts) > nargs and not rest):
+            return None
+        try:
+            args = [p if conv is None else conv(p) for conv, p in zip(converters, parts)]
+        except ValueError:
+            return None
+        if rest:
+            args.append(parts[nargs:])
+        return fn, args, wants_state
+
+    def name(self, data: str) -> str:
+        # اسم المسار (cat:list، item:view...) للقياس دون تحويل الوسائط
+        parts = data.split(":")
+        if data[:1] == CB_VERSION:
+            return self._names.get(parts[0][1:], "unknown")
+        for n in (3, 2, 1):
+            name = ":".join(parts[:n])
+            if name in self._by_name:
+                return name
+        return "unknown"
+
+router = CallbackRouter()
+cb = router.cb
+
+@dp.callback_query_handler()
+async def on_callback(call: CallbackQuery, state: FSMContext):
+    parsed = router.parse(call.data or "")
+    if parsed is None:
+        return await call.answer("هذا الزر قديم أو غير صالح.")
+    fn, args, wants_state = parsed
+    if wants_state:
+        return await fn(call, *args, state=state)
+    return await fn(call, *args)
+
+class MetricsMiddleware(BaseMiddleware):
+    # زمن كل تحديث من قبل المرشّحات حتى انتهاء المعالج، بوسم مسار الزر أو اسم معالج الرسالة،
+    # وعدد طلبات Bot API ورحلاتها المتتابعة فيه
+    @staticmethod
+    def start(data: dict):
+        data["_t0"] = time.perf_counter()
+        data["_trips"] = [0, 0, 0]
+        _api_trips.set(data["_trips"])
+
+    @staticmethod
+    def finish(label: str, data: dict):
+        metrics.observe("bot_handler_seconds", label, time.perf_counter() - data["_t0"])
+        prof = _profile.get()
+        if prof is not None:
+            prof.label = label
+        metrics.inc("bot_api_round_trips_total", label, data["_trips"][1])
+        metrics.inc("bot_api_calls_total", label, data["_trips"][2])
+
+    async def on_pre_process_callback_query(self, call: CallbackQuery, data: dict):
+        self.start(data)
+
+    async def on_post_process_callback_query(self, call: CallbackQuery, results, data: dict):
+        self.finish(router.name(call.data or ""), data)
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        self.start(data)
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        data["_handler"] = "msg:" + current_handler.get().__name__
+
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        self.finish(data.get("_handler", "msg:unhandled"), data)
+
+    async def on_pre_process_inline_query(self, query: types.InlineQuery, data: dict):
+        self.start(data)
+
+    async def on_post_process_inline_query(self, query: types.InlineQuery, results, data: dict):
+        self.finish("inline", data)
+
+dp.middleware.setup(MetricsMiddleware())
+
+# ================== تحليل التحديثات البطيئة ==================
+# وضع اختياري: PROFILE_SAMPLE نسبة التحديثات المُحلَّلة (0 = معطّل). للتحديث المختار:
+# خيط جانبي يأخذ عينة كل PROFILE_INTERVAL_MS من مكدّس مهمته، فإن كانت تعمل فمكدّس
+# خيط الحلقة، وإلا سلسلة await التي تنتظر عندها (قاعدة، Bot API…) بوسم [await]؛ لا
+# تتبّع لكل استدعاء فالكلفة عينة كل بضع ملّي ثوان وفقط أثناء تحديث مُحلَّل. وتُجمع
+# عبارات SQL التي نفذها وأزمنتها (_sql_trace). ما تجاوز SLOW_UPDATE_MS يُحفظ بملفه
+# مع EXPLAIN QUERY PLAN لأثقل عباراته في حلقة من PROFILE_KEEP ملفًا في PROFILE_DIR
+# (الأقدم يُستبدل)، ويجمع أمر المالك /slow الأبطأ منها في تقرير يُرسل مستندًا.
+PROFILE_SAMPLE = float(os.getenv("PROFILE_SAMPLE", "0"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000
+SLOW_UPDATE_MS = float(os.getenv("SLOW_UPDATE_MS", "500"))
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "200"))
+PROFILE_DIR = os.getenv("PROFILE_DIR") or os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "slow")
+PROFILE_STACK_DEPTH = 24
+PROFILE_TOP_SQL = 10
+PROFILE_TOP_STACKS = 15
+
+_profile: contextvars.ContextVar = contextvars.ContextVar("profile", default=None)
+
+class UpdateProfile:
+    __slots__ = ("task", "label", "kind", "started", "samples", "sql", "closed")
+
+    def __init__(self, task: asyncio.Task, kind: str, label: str):
+        self.task = task
+        self.kind = kind
+        self.label = label
+        self.started = time.perf_counter()
+        self.samples: Dict[tuple, int] = {}
+        self.sql: list = []
+        self.closed = False
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}"
+
+class StackSampler:
+    # خيط واحد يأخذ عينات كل التحديثات المُحلَّلة الجارية، وينام حين لا يوجد منها
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.active: Dict[asyncio.Task, UpdateProfile] = {}
+        self._wake = threading.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def add(self, prof: UpdateProfile):
+        if self._thread is None:
+            self._loop = asyncio.get_running_loop()
+            self._loop_thread = threading.get_ident()
+            self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+            self._thread.start()
+        self.active[prof.task] = prof
+        self._wake.set()
+
+    def remove(self, prof: UpdateProfile):
+        self.active.pop(prof.task, None)
+
+    def _run(self):
+        while True:
+            if not self.active:
+                self._wake.clear()
+                self._wake.wait()
+            time.sleep(self.interval)
+            running = asyncio.current_task(self._loop)
+            for task, prof in list(self.active.items()):
+                stack = self._thread_stack() if task is running else self._await_stack(task)
+                prof.samples[stack] = prof.samples.get(stack, 0) + 1
+
+    def _thread_stack(self) -> tuple:
+        frame = sys._current_frames().get(self._loop_thread)
+        names = []
+        while frame is not None and len(names) < PROFILE_STACK_DEPTH:
+            names.append(_frame_name(frame))
+            frame = frame.f_back
+        return tuple(reversed(names))
+
+    @staticmethod
+    def _await_stack(task: asyncio.Task) -> tuple:
+        names, coro = ["[await]"], task.get_coro()
+        while coro is not None and len(names) < PROFILE_STACK_DEPTH:
+            frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+            if frame is not None:
+                names.append(_frame_name(frame))
+            coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+        return tuple(names)
+
+sampler = StackSampler(PROFILE_INTERVAL)
+
+def update_kind(update: types.Update) -> Tuple[str, str]:
+    # (النوع، وسم مبدئي) قبل أن يحدده MetricsMiddleware باسم المعالج؛ بلا نصوص المستخدمين
+    if update.callback_query:
+        return "callback", router.name(update.callback_query.data or "")
+    if update.message:
+        return "message", "msg:" + update.message.content_type
+    if update.inline_query:
+        return "inline", "inline"
+    return "other", "update"
+
+class ProfileMiddleware(BaseMiddleware):
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        if random.random() >= PROFILE_SAMPLE:
+            return
+        prof = UpdateProfile(asyncio.current_task(), *update_kind(update))
+        data["_profile"] = prof
+        _profile.set(prof)
+        _sql_trace.set(prof)
+        sampler.add(prof)
+
+    async def on_post_process_update(self, update: types.Update, results, data: dict):
+        prof = data.get("_profile")
+        if prof is None:
+            return
+        sampler.remove(prof)
+        prof.closed = True
+        _profile.set(None)
+        _sql_trace.set(None)
+        ms = (time.perf_counter() - prof.started) * 1000
+        if ms >= SLOW_UPDATE_MS:
+            asyncio.ensure_future(save_slow_update(prof, ms))
+
+if PROFILE_SAMPLE > 0:
+    dp.middleware.setup(ProfileMiddleware())
+
+def slow_sql_summary(sql: list) -> list:
+    # العبارات المتمايزة مرتبة بالوقت الإجمالي
+    agg: Dict[str, list] = {}
+    for stmt, seconds in sql:
+        entry = agg.setdefault(stmt, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+    rows = sorted(agg.items(), key=lambda kv: kv[1][1], reverse=True)
+    return [{"sql": " ".join(stmt.split()), "count": n, "ms": round(total * 1000, 3)} for stmt, (n, total) in rows]
+
+def slow_explain(con: sqlite3.Connection, summary: list):
+    for entry in summary[:PROFILE_TOP_SQL]:
+        verb = entry["sql"].split(None, 1)[0].upper() if entry["sql"] else ""
+        if verb not in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "REPLACE"):
+            continue
+        try:
+            entry["plan"] = explain(con, entry["sql"])
+        except sqlite3.Error as e:
+            entry["plan"] = [f"EXPLAIN failed: {e}"]
+
+_slow_seq = 0
+_slow_lock = threading.Lock()   # الحفظ في خيوط المنفّذ، وقد يتزامن حفظان
+
+def slow_slot_write(record: dict):
+    # الحلقة: ملف لكل خانة، ورقم التسلسل في السجل يحدد الأحدث. كل عامل بخاناته
+    global _slow_seq
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with _slow_lock:
+        if _slow_seq == 0:
+            _slow_seq = max((r["seq"] for r in slow_read_all() if r.get("worker") == record["worker"]), default=0)
+        _slow_seq += 1
+        record["seq"] = _slow_seq
+        path = os.path.join(PROFILE_DIR, f"slow-{record['worker']}-{_slow_seq % PROFILE_KEEP:04d}.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(record, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+def slow_read_all() -> list:
+    records = []
+    if not os.path.isdir(PROFILE_DIR):
+        return records
+    for name in os.listdir(PROFILE_DIR):
+        if name.startswith("slow-") and name.endswith(".json"):
+            try:
+                with open(os.path.join(PROFILE_DIR, name), encoding="utf-8") as f:
+                    records.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+    return records
+
+async def save_slow_update(prof: UpdateProfile, ms: float):
+    try:
+        summary = slow_sql_summary(prof.sql)
+        await db.read(lambda con: slow_explain(con, summary))
+        total = sum(prof.samples.values())
+        stacks = sorted(prof.samples.items(), key=lambda kv: kv[1], reverse=True)[:PROFILE_TOP_STACKS]
+        record = {
+            "ts": now_str(), "worker": WORKER_INDEX or 0, "kind": prof.kind, "label": prof.label,
+            "ms": round(ms, 1), "sql_ms": round(sum(s for _, s in prof.sql) * 1000, 1),
+            "samples": total, "interval_ms": PROFILE_INTERVAL * 1000,
+            "stacks": [{"n": n, "stack": list(stack)} for stack, n in stacks], "sql": summary,
+        }
+        await _run_in_thread(slow_slot_write, record)
+        logging.info("profile: تحديث بطيء %s في %.0fms حُفظ", prof.label, ms)
+    except Exception:
+        logging.exception("profile: تعذّر حفظ التحديث البطيء")
+
+def slow_report(records: list) -> str:
+    out = [f"Slowest {len(records)} profiled updates (threshold {SLOW_UPDATE_MS:.0f}ms, sample {PROFILE_SAMPLE:g})", ""]
+    for i, r in enumerate(records, 1):
+        out.append(f"#{i} {r['label']} — {r['ms']:.0f}ms (SQL {r['sql_ms']:.0f}ms) at {r['ts']} worker {r['worker']}")
+        out.append(f"  profile: {r['samples']} samples every {r['interval_ms']:g}ms")
+        for st in r["stacks"]:
+            share = st["n"] * 100 / r["samples"] if r["samples"] else 0
+            out.append(f"  {share:5.1f}%  " + " > ".join(st["stack"][-8:]))
+        out.append("  sql:")
+        for q in r["sql"]:
+            out.append(f"    {q['count']:3d}× {q['ms']:9.2f}ms  {q['sql'][:300]}")
+            out += [f"                       {d}" for d in q.get("plan", [])]
+        out.append("")
+    return "\n".join(out)
+
+@dp.message_handler(commands=['slow'])
+async def cmd_slow(message: types.Message):
+    # /slow [N]: تقرير بأبطأ N تحديثًا محفوظًا
+    if not user_is_owner(message.from_user.id):
+        return await message.answer("🚫 هذا الأمر للمالك فقط.")
+    arg = message.get_args().strip()
+    top = int(arg) if arg.isdigit() else 10
+    records = sorted(await _run_in_thread(slow_read_all), key=lambda r: r["ms"], reverse=True)[:max(1, top)]
+    if not records:
+        state = f"PROFILE_SAMPLE={PROFILE_SAMPLE:g}" if PROFILE_SAMPLE > 0 else "التحليل معطّل (PROFILE_SAMPLE=0)"
+        return await message.answer(f"لا تحديثات بطيئة محفوظة. {state}")
+    doc = types.InputFile(io.BytesIO(slow_report(records).encode("utf-8")),
+                          filename=f"slow-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.txt")
+    await message.answer_document(doc, caption=f"⏱️ أبطأ {len(records)} تحديثًا (أبطؤها {records[0]['ms']:.0f}ms)")
+
+
+async def metrics_serve() -> web.AppRunner:
+    async def handle(request):
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    # كل عامل على منفذه: METRICS_PORT + رقمه
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT + (WORKER_INDEX or 0)).start()
+    return runner
+
+# القوائم الثابتة تُبنى مرة (تُحمّى في on_startup) وتُشارك بين الرسائل، فلا تُعدَّل بعد الإرجاع
+@lru_cache(maxsize=None)
 def send_main_menu(is_owner: bool = False) -> InlineKeyboardMarkup:
     kb = [
-        [InlineKeyboardButton("📁 ملفات", callback_data="cat:open:file"),
-         InlineKeyboardButton("🖼️ صور", callback_data="cat:open:image")],
-        [InlineKeyboardButton("🎥 فيديوهات", callback_data="cat:open:video"),
-         InlineKeyboardButton("🎵 صوتيات", callback_data="cat:open:audio")],
-        [InlineKeyboardButton("💻 تطبيقات / برامج", callback_data="cat:open:app")],
-        [InlineKeyboardButton("🔎 بحث", callback_data="search:open"),
-         InlineKeyboardButton("🗑️ سلة المحذوفات", callback_data="trash:list:1")],
-        [InlineKeyboardButton("👤 حسابي", callback_data="user:profile")]
+        [InlineKeyboardButton("📁 ملفات", callback_data=cb("cat:open", "file")),
+         InlineKeyboardButton("🖼️ صور", callback_data=cb("cat:open", "image"))],
+        [InlineKeyboardButton("🎥 فيديوهات", callback_data=cb("cat:open", "video")),
+         InlineKeyboardButton("🎵 صوتيات", callback_data=cb("cat:open", "audio"))],
+        [InlineKeyboardButton("💻 تطبيقات / برامج", callback_data=cb("cat:open", "app"))],
+        [InlineKeyboardButton("🔎 بحث", callback_data=cb("search:open")),
+         InlineKeyboardButton("🗑️ سلة المحذوفات", callback_data=cb("trash:list", 1))],
+        [InlineKeyboardButton("👤 حسابي", callback_data=cb("user:profile")),
+         InlineKeyboardButton("📤 رفعاتي", callback_data=cb("user:uploads", 1))]
     ]
     if is_owner:
-        kb.append([InlineKeyboardButton("🛠️ إدارة الأزرار", callback_data="admin:open")])
+        kb.append([InlineKeyboardButton("🛠️ إدارة الأزرار", callback_data=cb("admin:open"))])
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
+@lru_cache(maxsize=32)   # cat_type من بيانات الزر؛ الحد يمنع النمو بقيم غريبة
 def category_menu(cat_type: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton("📂 عرض الملفات", callback_data=f"cat:list:{cat_type}:1")],
-        [InlineKeyboardButton("⬆️ رفع ملف جديد", callback_data=f"cat:upload:{cat_type}")],
-        [InlineKeyboardButton("🆕 المضافة مؤخرًا", callback_data=f"cat:list:{cat_type}:recent")],
-        [InlineKeyboardButton("🔎 بحث في الفئة", callback_data=f"search:cat:{cat_type}")],
-        [InlineKeyboardButton("🔙 رجوع", callback_data="main:open"),
-         InlineKeyboardButton("🏠 الرئيسية", callback_data="main:open")]
+        [InlineKeyboardButton("📂 عرض الملفات", callback_data=cb("cat:list", cat_type, 1))],
+        [InlineKeyboardButton("⬆️ رفع ملف جديد", callback_data=cb("cat:upload", cat_type))],
+        [InlineKeyboardButton("🆕 المضافة مؤخرًا", callback_data=cb("cat:list", cat_type, "recent"))],
+        [InlineKeyboardButton("🔎 بحث في الفئة", callback_data=cb("search:cat", cat_type))],
+        [InlineKeyboardButton("🔙 رجوع", callback_data=cb("main:open")),
+         InlineKeyboardButton("🏠 الرئيسية", callback_data=cb("main:open"))]
     ])
 
-def list_nav(cat_type: str, page: int, has_prev: bool, has_next: bool) -> InlineKeyboardMarkup:
+def list_nav(cat_type: str, page: int, prev_cur: Optional[str], next_cur: Optional[str]) -> InlineKeyboardMarkup:
     row = []
-    if has_prev:
-        row.append(InlineKeyboardButton("◀️ السابق", callback_data=f"nav:page:{cat_type}:{page-1}"))
-    if has_next:
-        row.append(InlineKeyboardButton("التالي ▶️", callback_data=f"nav:page:{cat_type}:{page+1}"))
+    if prev_cur:
+        row.append(InlineKeyboardButton("◀️ السابق", callback_data=cb("cat:list", cat_type, page - 1, prev_cur)))
+    if next_cur:
+        row.append(InlineKeyboardButton("التالي ▶️", callback_data=cb("cat:list", cat_type, page + 1, next_cur)))
     rows = []
     if row:
         rows.append(row)
-    rows.append([InlineKeyboardButton("🔙 رجوع", callback_data=f"cat:open:{cat_type}"),
-                 InlineKeyboardButton("🏠 الرئيسية", callback_data="main:open")])
+    rows.append([InlineKeyboardButton("🔙 رجوع", callback_data=cb("cat:open", cat_type)),
+                 InlineKeyboardButton("🏠 الرئيسية", callback_data=cb("main:open"))])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 def item_actions(item_id: int, in_trash: bool = False, owner_or_mod: bool = False) -> InlineKeyboardMarkup:
     kb = []
     if not in_trash:
-        kb.append([InlineKeyboardButton("✏️ تعديل", callback_data=f"item:edit:{item_id}"),
-                   InlineKeyboardButton("🗑️ حذف", callback_data=f"item:del:{item_id}")])
+        kb.append([InlineKeyboardButton("✏️ تعديل", callback_data=cb("item:edit", item_id)),
+                   InlineKeyboardButton("🗑️ حذف", callback_data=cb("item:del", item_id))])
     else:
-        kb.append([InlineKeyboardButton("♻️ استرجاع", callback_data=f"trash:restore:{item_id}")])
+        kb.append([InlineKeyboardButton("♻️ استرجاع", callback_data=cb("trash:restore", item_id))])
         if owner_or_mod:
-            kb.append([InlineKeyboardButton("❌ حذف نهائي", callback_data=f"trash:purge:{item_id}")])
-    kb.append([InlineKeyboardButton("🏠 الرئيسية", callback_data="main:open")])
+            kb.append([InlineKeyboardButton("❌ حذف نهائي", callback_data=cb("trash:purge", item_id))])
+    kb.append([InlineKeyboardButton("🏠 الرئيسية", callback_data=cb("main:open"))])
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
+class TokenBucket:
+    # دلو رموز: rate رمز/ثانية بسعة burst، مع إيقاف مؤقت عند RetryAfter
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.paused_until = 0.0
+
+    def try_take(self, n: float = 1.0) -> bool:
+        now = time.monotonic()
+        if now < self.paused_until:
+            return False
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+
+    async def take(self, n: float = 1.0):
+        while not self.try_take(n):
+            wait = max(self.paused_until - time.monotonic(), (n - self.tokens) / self.rate)
+            await asyncio.sleep(max(wait, 0.01))
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+# ================== تحديد المعدل (منع الإغراق) ==================
+# قبل أي معالج: دلو لكل مستخدم ودلو عام لكل صنف. "nav" للأزرار والأوامر (رخيصة)،
+# و"heavy" للرفع والبحث والرسائل النصية والبحث المضمّن (قاعدة أثقل ونشر في القناة).
+# نقرتان على الزر نفسه خلال THROTTLE_DEBOUNCE تُحسبان واحدة. المرفوض يُجاب من الذاكرة
+# فقط (call.answer / نتائج فارغة / تنبيه واحد لكل نافذة) ولا يلمس القاعدة. الألبوم يُحسب
+# رفعًا واحدًا: أول رسالة تقرر مصير المجموعة كلها فلا يُقبل نصفه. حالة المستخدمين في
+# LRU بحد THROTTLE_USERS؛ المطرود هو الأقدم خمولًا ودلوه كان سيمتلئ على أي حال.
+# في وضع العمال المتعددين يُقسم الحد العام على العمال (المستخدم نفسه دائمًا عند عامل واحد).
+THROTTLE = os.getenv("THROTTLE", "1") == "1"
+THROTTLE_NAV_RATE = float(os.getenv("THROTTLE_NAV_RATE", "3"))           # رمز/ثانية لكل مستخدم
+THROTTLE_NAV_BURST = float(os.getenv("THROTTLE_NAV_BURST", "12"))
+THROTTLE_HEAVY_RATE = float(os.getenv("THROTTLE_HEAVY_RATE", "1"))
+THROTTLE_HEAVY_BURST = float(os.getenv("THROTTLE_HEAVY_BURST", "20"))
+THROTTLE_GLOBAL_NAV = float(os.getenv("THROTTLE_GLOBAL_NAV", "300"))     # رمز/ثانية للبوت كله
+THROTTLE_GLOBAL_HEAVY = float(os.getenv("THROTTLE_GLOBAL_HEAVY", "30"))
+THROTTLE_DEBOUNCE = float(os.getenv("THROTTLE_DEBOUNCE", "0.7"))
+THROTTLE_USERS = int(os.getenv("THROTTLE_USERS", "20000"))
+THROTTLE_WARN_EVERY = 10.0   # تنبيه واحد على الأكثر لكل مستخدم في هذه المدة
+
+class _UserLimits:
+    __slots__ = ("buckets", "last_data", "last_at", "warned_at")
+
+    def __init__(self):
+        self.buckets = {"nav": TokenBucket(THROTTLE_NAV_RATE, THROTTLE_NAV_BURST),
+                        "heavy": TokenBucket(THROTTLE_HEAVY_RATE, THROTTLE_HEAVY_BURST)}
+        self.last_data = None
+        self.last_at = 0.0
+        self.warned_at = 0.0
+
+class ThrottleMiddleware(BaseMiddleware):
+    def __init__(self):
+        super().__init__()
+        workers = max(1, int(os.getenv("WORKERS", "1")))
+        self.global_buckets = {"nav": TokenBucket(THROTTLE_GLOBAL_NAV / workers, THROTTLE_GLOBAL_NAV / workers),
+                               "heavy": TokenBucket(THROTTLE_GLOBAL_HEAVY / workers, THROTTLE_GLOBAL_HEAVY / workers)}
+        self.users: "OrderedDict[int, _UserLimits]" = OrderedDict()
+        self.albums: "OrderedDict[str, Optional[str]]" = OrderedDict()   # media_group_id -> سبب الرفض أو None
+
+    def limits(self, uid: int) -> _UserLimits:
+        entry = self.users.get(uid)
+        if entry is None:
+            entry = self.users[uid] = _UserLimits()
+            if len(self.users) > THROTTLE_USERS:
+                self.users.popitem(last=False)
+        else:
+            self.users.move_to_end(uid)
+        return entry
+
+    def check(self, entry: _UserLimits, kind: str) -> Optional[str]:
+        # يعيد سبب الرفض أو None
+        if not entry.buckets[kind].try_take():
+            return "user"
+        if not self.global_buckets[kind].try_take():
+            return "global"
+        return None
+
+    def reject(self, kind: str, reason: str):
+        metrics.inc("bot_throttled_total", f"{kind}:{reason}")
+        raise CancelHandler()
+
+    def should_warn(self, entry: _UserLimits) -> bool:
+        now = time.monotonic()
+        if now - entry.warned_at < THROTTLE_WARN_EVERY:
+            return False
+        entry.warned_at = now
+        return True
+
+    async def on_pre_process_callback_query(self, call: CallbackQuery, data: dict):
+        if user_is_owner(call.from_user.id):
+            return
+        entry = self.limits(call.from_user.id)
+        now = time.monotonic()
+        if call.data == entry.last_data and now - entry.last_at < THROTTLE_DEBOUNCE:
+            await call.answer()
+            self.reject("nav", "debounce")
+        entry.last_data, entry.last_at = call.data, now
+        reason = self.check(entry, "nav")
+        if reason:
+            await call.answer("⏳ على مهلك، حاول بعد لحظة." if reason == "user" else "⏳ البوت مشغول، حاول بعد لحظة.")
+            self.reject("nav", reason)
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        if message.chat.type != types.ChatType.PRIVATE or user_is_owner(message.from_user.id):
+            return
+        entry = self.limits(message.from_user.id)
+        gid = message.media_group_id
+        if gid and gid in self.albums:
+            reason = self.albums[gid]
+        else:
+            reason = self.check(entry, "nav" if message.is_command() else "heavy")
+            if gid:
+                self.albums[gid] = reason
+                if len(self.albums) > THROTTLE_USERS:
+                    self.albums.popitem(last=False)
+        if reason:
+            if self.should_warn(entry):
+                await message.answer("⏳ رسائل كثيرة بسرعة، أُهمل بعضها. أعد إرسال ما لم يُحفظ بعد لحظات.")
+            self.reject("nav" if message.is_command() else "heavy", reason)
+
+    async def on_pre_process_inline_query(self, query: types.InlineQuery, data: dict):
+        if user_is_owner(query.from_user.id):
+            return
+        reason = self.check(self.limits(query.from_user.id), "heavy")
+        if reason:
+            await query.answer([], cache_time=1, is_personal=True)
+            self.reject("heavy", reason)
+
+if THROTTLE:
+    dp.middleware.setup(ThrottleMiddleware())
+
 # ================== حالات FSM ==================
 class UploadWait(StatesGroup):
     for_type = State()
@@ -171,152 +1800,198 @@ class EditWait(StatesGroup):
 # ================== أوامر البداية والتسجيل ==================
 @dp.message_handler(commands=['start'])
 async def cmd_start(message: types.Message):
-    ensure_user(message.from_user)
+    await ensure_user(message.from_user)
     text = "👋 أهلاً بك في بوت التخزين السحابي.\n"
     if user_is_owner(message.from_user.id):
         text += "أنت المالك. لديك صلاحيات كاملة."
     text += "\n\nاضغط لبدء الاستخدام:"
     btns = InlineKeyboardMarkup().add(
-        InlineKeyboardButton("✅ تسجيل حساب", callback_data="user:register")
+        InlineKeyboardButton("✅ تسجيل حساب", callback_data=cb("user:register"))
     )
-    btns.add(InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data="main:open"))
+    btns.add(InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data=cb("main:open")))
     await message.answer(text, reply_markup=btns)
 
-@dp.callback_query_handler(lambda c: c.data == "user:register")
+@router.route("user:register", "ur")
 async def cb_register(call: CallbackQuery):
-    ensure_user(call.from_user)
-    register_user(call.from_user.id)
-    await call.message.edit_text("✅ تم تسجيل حسابك بنجاح.\nاستخدم الأزرار للتنقل.", reply_markup=send_main_menu(user_is_owner(call.from_user.id)))
-    await call.answer("تم")
+    await ensure_user(call.from_user)
+    await register_user(call.from_user.id)
+    await respond(call, "✅ تم تسجيل حسابك بنجاح.\nاستخدم الأزرار للتنقل.", reply_markup=send_main_menu(user_is_owner(call.from_user.id)), note="تم")
 
-@dp.callback_query_handler(lambda c: c.data == "user:profile")
+@router.route("user:profile", "up")
 async def cb_profile(call: CallbackQuery):
-    ensure_user(call.from_user)
-    reg = user_is_registered(call.from_user.id)
-    role = "مالك" if user_is_owner(call.from_user.id) else ("مشرف" if user_is_mod(call.from_user.id) else "مستخدم")
+    await ensure_user(call.from_user)
+    reg = await user_is_registered(call.from_user.id)
+    role = "مالك" if user_is_owner(call.from_user.id) else ("مشرف" if await user_is_mod(call.from_user.id) else "مستخدم")
     txt = f"👤 حسابي\n\nالاسم: {call.from_user.full_name}\nالحالة: {'مسجل' if reg else 'غير مسجل'}\nالدور: {role}"
-    await call.message.edit_text(txt, reply_markup=send_main_menu(user_is_owner(call.from_user.id)))
-    await call.answer()
+    await respond(call, txt, reply_markup=send_main_menu(user_is_owner(call.from_user.id)))
 
 # ================== القائمة الرئيسية والفئات ==================
-@dp.callback_query_handler(lambda c: c.data == "main:open")
+@router.route("main:open", "mo")
 async def cb_main(call: CallbackQuery):
-    await call.message.edit_text("🏠 القائمة الرئيسية", reply_markup=send_main_menu(user_is_owner(call.from_user.id)))
-    await call.answer()
+    await respond(call, "🏠 القائمة الرئيسية", reply_markup=send_main_menu(user_is_owner(call.from_user.id)))
 
-@dp.callback_query_handler(lambda c: c.data.startswith("cat:open:"))
-async def cb_open_cat(call: CallbackQuery):
-    cat = call.data.split(":")[2]
+@router.route("cat:open", "co", str)
+async def cb_open_cat(call: CallbackQuery, cat: str):
     if cat not in CAT_TYPES:
         return await call.answer("فئة غير معروفة.", show_alert=True)
-    await call.message.edit_text(f"🔎 الفئة: {cat}", reply_markup=category_menu(cat))
-    await call.answer()
+    await respond(call, f"🔎 الفئة: {cat}", reply_markup=category_menu(cat))
 
 # ================== عرض القوائم مع ترقيم ==================
+# ترقيم بالمؤشر (keyset): زر التنقل يحمل مفتاح (الوقت، المعرّف) لحافة الصفحة
+# الحالية بدل OFFSET، فتكلفة أي صفحة ثابتة مهما كان عمقها.
+# صيغة المؤشر المضغوطة: "<n|p>:<epoch base36>:<id base36>"
 PAGE_SIZE = 6
+def encode_cursor(direction: str, ts: str, row_id: int) -> str:
+    ts36 = b36(int(datetime.fromisoformat(ts).replace(tzinfo=timezone.utc).timestamp()))
+    return f"{direction}:{ts36}:{b36(row_id)}"
 
-def fetch_items(cat_type: str, page: int) -> Tuple[list, bool, bool]:
-    offset = (page - 1) * PAGE_SIZE
-    with closing(db_connect()) as con:
-        rows = con.execute("""
-            SELECT id, name, caption, file_id, type FROM items
-            WHERE status='active' AND type=?
-            ORDER BY created_at DESC
-            LIMIT ? OFFSET ?
-        """, (cat_type, PAGE_SIZE + 1, offset)).fetchall()
-    has_next = len(rows) > PAGE_SIZE
-    items = rows[:PAGE_SIZE]
-    has_prev = page > 1
-    return items, has_prev, has_next
-
-@dp.callback_query_handler(lambda c: c.data.startswith("cat:list:"))
-async def cb_list_cat(call: CallbackQuery):
-    _, _, cat_type, page = call.data.split(":")
-    page = 1 if page == "recent" else int(page)
-    items, has_prev, has_next = fetch_items(cat_type, page)
+def decode_cursor(parts: list) -> Optional[Tuple[str, str, int]]:
+    # parts = ["n"|"p", ts36, id36] أو قائمة فارغة للصفحة الأولى
+    if len(parts) != 3 or parts[0] not in ("n", "p"):
+        return None
+    direction, ts36, id36 = parts
+    # المؤشر من بيانات الزر فقد يكون تالفًا أو مزوّرًا: يعود للصفحة الأولى
+    try:
+        ts = datetime.fromtimestamp(int(ts36, 36), timezone.utc).replace(tzinfo=None).isoformat(timespec='seconds')
+        row_id = int(id36, 36)
+    except (ValueError, OverflowError, OSError):
+        return None
+    if not 0 <= row_id < 1 << 63:   # خارج INTEGER في SQLite
+        return None
+    return direction, ts, row_id
+
+# (الأعمدة، الجدول، الشرط، عمود الوقت، عمود المعرّف) لكل قائمة مرقمة
+KeysetSpec = Tuple[str, str, str, str, str]
+
+def keyset_sql(spec: KeysetSpec, direction: Optional[str]) -> str:
+    # direction: None للصفحة الأولى، "n" التالية، "p" السابقة
+    cols, table, where, ts_col, id_col = spec
+    sql = f"SELECT {cols}, {ts_col}, {id_col} FROM {table} WHERE {where}"
+    forward = direction != "p"
+    if direction is not None:
+        # الوقت يُكتب دائمًا عبر now_str() فلا قيم NULL في الأعمدة المرتبة
+        sql += f" AND ({ts_col}, {id_col}) {'<' if forward else '>'} (?, ?)"
+    order = "DESC" if forward else "ASC"
+    return sql + f" ORDER BY {ts_col} {order}, {id_col} {order} LIMIT ?"
+
+def hot_keyset(name: str, spec: KeysetSpec) -> KeysetSpec:
+    for direction in (None, "n", "p"):
+        hot(f"{name} ({direction or 'first'})", keyset_sql(spec, direction))
+    return spec
+
+async def keyset_page(spec: KeysetSpec, params: tuple,
+                      cursor: Optional[Tuple[str, str, int]]) -> Tuple[list, Optional[str], Optional[str]]:
+    # يعيد (الصفوف، مؤشر السابق، مؤشر التالي)؛ المؤشر None يعني لا توجد صفحة.
+    forward = cursor is None or cursor[0] == "n"
+    args = params + (cursor[1:] if cursor is not None else ())
+    rows = await db.fetchall(keyset_sql(spec, cursor[0] if cursor else None), args + (PAGE_SIZE + 1,))
+    more = len(rows) > PAGE_SIZE
+    rows = rows[:PAGE_SIZE]
+    if not forward:
+        rows.reverse()
+    if not rows:
+        return [], None, None
+    has_prev = more if not forward else cursor is not None
+    has_next = more if forward else True
+    prev_cur = encode_cursor("p", rows[0][-2], rows[0][-1]) if has_prev else None
+    next_cur = encode_cursor("n", rows[-1][-2], rows[-1][-1]) if has_next else None
+    return [r[:-2] for r in rows], prev_cur, next_cur
+
+ITEMS_PAGE = hot_keyset("items page", ("id, name, caption, file_id, type", "items",
+                                       "type=? AND status='active'", "created_at", "id"))
+
+async def fetch_items(cat_type: str, cursor=None) -> Tuple[list, Optional[str], Optional[str]]:
+    return await keyset_page(ITEMS_PAGE, (cat_type,), cursor)
+
+@router.route("cat:list", "cl", str, page_arg, rest=True)
+@router.route("nav:page", None, str, page_arg, rest=True)   # أزرار v0 القديمة
+async def cb_list_cat(call: CallbackQuery, cat_type: str, page: int, cur: list):
+    key = ("cat", cat_type, page, tuple(cur), catalog_gen.get(cat_type))
+    rendered = page_cache.get(key)
+    if rendered is _MISSING:
+        rendered = await render_cat_page(cat_type, page, cur)
+        page_cache.put(key, rendered)
+    await respond(call, rendered[0], reply_markup=rendered[1])
+
+async def render_cat_page(cat_type: str, page: int, cur: list) -> Tuple[str, InlineKeyboardMarkup]:
+    items, prev_cur, next_cur = await fetch_items(cat_type, decode_cursor(cur))
     if not items:
-        await call.message.edit_text("لا توجد عناصر بعد في هذه الفئة.", reply_markup=category_menu(cat_type))
-        return await call.answer()
+        return "لا توجد عناصر بعد في هذه الفئة.", category_menu(cat_type)
     # نبني قائمة مختصرة بأزرار لعناصر فردية
     kb = InlineKeyboardMarkup(row_width=2)
     for it in items:
         it_id, name, caption, file_id, t = it
         title = name or (caption[:20] + "…") if caption else f"{t} #{it_id}"
-        kb.insert(InlineKeyboardButton(f"📦 {title}", callback_data=f"item:view:{it_id}"))
+        kb.insert(InlineKeyboardButton(f"📦 {title}", callback_data=cb("item:view", it_id)))
     # تنقل
-    nav = list_nav(cat_type, page, has_prev, has_next)
+    nav = list_nav(cat_type, page, prev_cur, next_cur)
     kb.inline_keyboard.extend(nav.inline_keyboard)
-    await call.message.edit_text(f"📂 عناصر الفئة: {cat_type} (صفحة {page})", reply_markup=kb)
-    await call.answer()
-
-@dp.callback_query_handler(lambda c: c.data.startswith("nav:page:"))
-async def cb_nav_page(call: CallbackQuery):
-    _, _, cat_type, page = call.data.split(":")
-    call.data = f"cat:list:{cat_type}:{page}"
-    return await cb_list_cat(call)
+    return f"📂 عناصر الفئة: {cat_type} (صفحة {page})", kb
 
 # ================== عرض عنصر وتحرير/حذف ==================
-def get_item(item_id: int):
-    with closing(db_connect()) as con:
-        return con.execute("SELECT id, type, file_id, thumb_id, name, caption, uploader_id, status, channel_msg_id FROM items WHERE id=?", (item_id,)).fetchone()
+GET_ITEM_SQL = hot("item by id", "SELECT id, type, file_id, thumb_id, name, caption, uploader_id, status, channel_msg_id FROM items WHERE id=?")
 
-@dp.callback_query_handler(lambda c: c.data.startswith("item:view:"))
-async def cb_item_view(call: CallbackQuery):
-    item_id = int(call.data.split(":")[2])
-    row = get_item(item_id)
+ARCHIVED_GET_SQL = hot("archived item by id", "SELECT id, type, file_id, thumb_id, name, caption, uploader_id, status, channel_msg_id FROM archive.items WHERE id=?")
+
+async def get_item(item_id: int):
+    # ما ليس في items قد يكون في السلة المؤرشفة
+    return await db.fetchone(GET_ITEM_SQL, (item_id,)) or await db.fetchone(ARCHIVED_GET_SQL, (item_id,))
+
+@router.route("item:view", "iv", int)
+async def cb_item_view(call: CallbackQuery, item_id: int):
+    row = await get_item(item_id)
     if not row:
         await call.answer("العنصر غير موجود.", show_alert=True)
         return
     id_, t, file_id, thumb, name, caption, uploader, status, _ = row
     txt = f"📦 عنصر #{id_}\nالنوع: {t}\nالاسم: {name or '-'}\nالوصف: {caption or '-'}\nالرافع: {uploader}"
     in_trash = (status == "trashed")
-    kb = item_actions(id_, in_trash=in_trash, owner_or_mod=user_is_mod(call.from_user.id))
-    await call.message.edit_text(txt, reply_markup=kb)
-    await call.answer()
-
-@dp.callback_query_handler(lambda c: c.data.startswith("item:del:"))
-async def cb_item_del(call: CallbackQuery):
-    item_id = int(call.data.split(":")[2])
-    row = get_item(item_id)
+    kb = item_actions(id_, in_trash=in_trash, owner_or_mod=await user_is_mod(call.from_user.id))
+    await respond(call, txt, reply_markup=kb)
+
+@router.route("item:del", "id", int)
+async def cb_item_del(call: CallbackQuery, item_id: int):
+    row = await get_item(item_id)
     if not row:
         return await call.answer("غير موجود.", show_alert=True)
     # لا نطلب صلاحية خاصة للحذف للسلة، لكن يمكن تخصيصها لاحقًا
-    with closing(db_connect()) as con, con:
-        con.execute("UPDATE items SET status='trashed', deleted_at=? WHERE id=?", (now_str(), item_id))
-    await call.message.edit_text("🗑️ تم نقل العنصر إلى سلة المحذوفات.", reply_markup=InlineKeyboardMarkup().add(
-        InlineKeyboardButton("اذهب للسلة", callback_data="trash:list:1"),
-    ).add(InlineKeyboardButton("🏠 الرئيسية", callback_data="main:open")))
-    await call.answer("تم الحذف")
-
-@dp.callback_query_handler(lambda c: c.data.startswith("item:edit:"))
-async def cb_item_edit(call: CallbackQuery, state: FSMContext):
-    item_id = int(call.data.split(":")[2])
+    await db.execute("UPDATE items SET status='trashed', deleted_at=? WHERE id=?", (now_str(), item_id))
+    await respond(call, "🗑️ تم نقل العنصر إلى سلة المحذوفات.", reply_markup=InlineKeyboardMarkup().add(
+        InlineKeyboardButton("اذهب للسلة", callback_data=cb("trash:list", 1)),
+    ).add(InlineKeyboardButton("🏠 الرئيسية", callback_data=cb("main:open"))), note="تم الحذف")
+
+@router.route("item:edit", "ie", int)
+async def cb_item_edit(call: CallbackQuery, item_id: int, state: FSMContext):
     await state.update_data(edit_id=item_id)
     kb = InlineKeyboardMarkup().add(
-        InlineKeyboardButton("✏️ تعديل الاسم", callback_data="edit:name"),
-    ).add(InlineKeyboardButton("📝 تعديل الوصف", callback_data="edit:caption")).add(
-        InlineKeyboardButton("🔙 رجوع", callback_data=f"item:view:{item_id}")
+        InlineKeyboardButton("✏️ تعديل الاسم", callback_data=cb("edit:name")),
+    ).add(InlineKeyboardButton("📝 تعديل الوصف", callback_data=cb("edit:caption"))).add(
+        InlineKeyboardButton("🔙 رجوع", callback_data=cb("item:view", item_id))
     )
-    await call.message.edit_text("اختر ما تريد تعديله:", reply_markup=kb)
-    await call.answer()
+    await respond(call, "اختر ما تريد تعديله:", reply_markup=kb)
 
-@dp.callback_query_handler(lambda c: c.data in ("edit:name", "edit:caption"))
-async def cb_edit_choice(call: CallbackQuery, state: FSMContext):
-    await state.update_data(choice=call.data.split(":")[1])
-    if call.data.endswith("name"):
+@router.route("edit:name", "en")
+async def cb_edit_name(call: CallbackQuery, state: FSMContext):
+    await cb_edit_choice(call, "name", state)
+
+@router.route("edit:caption", "ec")
+async def cb_edit_caption(call: CallbackQuery, state: FSMContext):
+    await cb_edit_choice(call, "caption", state)
+
+async def cb_edit_choice(call: CallbackQuery, choice: str, state: FSMContext):
+    await state.update_data(choice=choice)
+    if choice == "name":
         await EditWait.new_name.set()
-        await call.message.edit_text("أرسل الاسم الجديد الآن:")
+        await respond(call, "أرسل الاسم الجديد الآن:")
     else:
         await EditWait.new_caption.set()
-        await call.message.edit_text("أرسل الوصف الجديد الآن:")
-    await call.answer()
+        await respond(call, "أرسل الوصف الجديد الآن:")
 
 @dp.message_handler(state=EditWait.new_name, content_types=types.ContentType.TEXT)
 async def on_new_name(message: types.Message, state: FSMContext):
     data = await state.get_data()
     item_id = data["edit_id"]
-    with closing(db_connect()) as con, con:
-        con.execute("UPDATE items SET name=? WHERE id=?", (message.text.strip(), item_id))
+    await db.execute("UPDATE items SET name=? WHERE id=?", (message.text.strip(), item_id))
     await message.answer("✅ تم تحديث الاسم.", reply_markup=send_main_menu(user_is_owner(message.from_user.id)))
     await state.finish()
 
@@ -324,99 +1999,471 @@ async def on_new_name(message: types.Message, state: FSMContext):
 async def on_new_caption(message: types.Message, state: FSMContext):
     data = await state.get_data()
     item_id = data["edit_id"]
-    with closing(db_connect()) as con, con:
-        con.execute("UPDATE items SET caption=? WHERE id=?", (message.text.strip(), item_id))
+    await db.execute("UPDATE items SET caption=? WHERE id=?", (message.text.strip(), item_id))
     await message.answer("✅ تم تحديث الوصف.", reply_markup=send_main_menu(user_is_owner(message.from_user.id)))
     await state.finish()
 
 # ================== السلة: عرض/استرجاع/حذف نهائي ==================
-def fetch_trash(page: int) -> Tuple[list, bool, bool]:
-    offset = (page - 1) * PAGE_SIZE
-    with closing(db_connect()) as con:
-        rows = con.execute("""
-            SELECT id, name, caption, type FROM items
-            WHERE status='trashed'
-            ORDER BY deleted_at DESC
-            LIMIT ? OFFSET ?
-        """, (PAGE_SIZE + 1, offset)).fetchall()
-    has_next = len(rows) > PAGE_SIZE
-    items = rows[:PAGE_SIZE]
-    has_prev = page > 1
-    return items, has_prev, has_next
-
-@dp.callback_query_handler(lambda c: c.data.startswith("trash:list:"))
-async def cb_trash_list(call: CallbackQuery):
-    page = int(call.data.split(":")[2])
-    items, has_prev, has_next = fetch_trash(page)
+# السلة الحديثة في items والقديمة في archive.items (قسم أرشيف السلة). الدمج جدول مشتق
+# لا VIEW: كل فرع يقرأ فهرس deleted_at بالترتيب فيدمجهما SQLite دون فرز مؤقت، والنسخة
+# الموجودة في الطبقتين (نقل لم يكتمل) تُقرأ من items وحدها.
+TRASH_ALL = """(
+    SELECT id, name, caption, type, deleted_at FROM main.items WHERE status='trashed'
+    UNION ALL
+    SELECT id, name, caption, type, deleted_at FROM archive.items a
+    WHERE NOT EXISTS (SELECT 1 FROM main.items m WHERE m.id = a.id)
+)"""
+TRASH_PAGE = hot_keyset("trash page", ("id, name, caption, type", TRASH_ALL, "1", "deleted_at", "id"))
+
+async def fetch_trash(cursor=None) -> Tuple[list, Optional[str], Optional[str]]:
+    return await keyset_page(TRASH_PAGE, (), cursor)
+
+@router.route("trash:list", "tl", int, rest=True)
+async def cb_trash_list(call: CallbackQuery, page: int, cur: list):
+    is_mod = await user_is_mod(call.from_user.id)
+    key = ("trash", page, tuple(cur), is_mod, catalog_gen.get())
+    rendered = page_cache.get(key)
+    if rendered is _MISSING:
+        rendered = await render_trash_page(page, cur, is_mod)
+        page_cache.put(key, rendered)
+    await respond(call, rendered[0], reply_markup=rendered[1])
+
+async def render_trash_page(page: int, cur: list, is_mod: bool) -> Tuple[str, InlineKeyboardMarkup]:
+    items, prev_cur, next_cur = await fetch_trash(decode_cursor(cur))
     kb = InlineKeyboardMarkup(row_width=2)
     if not items:
-        kb.add(InlineKeyboardButton("🏠 الرئيسية", callback_data="main:open"))
-        return await call.message.edit_text("السلة فارغة.", reply_markup=kb)
+        kb.add(InlineKeyboardButton("🏠 الرئيسية", callback_data=cb("main:open")))
+        return "السلة فارغة.", kb
     for it in items:
         it_id, name, caption, t = it
         title = name or (caption[:20] + "…") if caption else f"{t} #{it_id}"
-        kb.insert(InlineKeyboardButton(f"🗑️ {title}", callback_data=f"item:view:{it_id}"))
+        kb.insert(InlineKeyboardButton(f"🗑️ {title}", callback_data=cb("item:view", it_id)))
     nav = []
-    if has_prev:
-        nav.append(InlineKeyboardButton("◀️ السابق", callback_data=f"trash:list:{page-1}"))
-    if has_next:
-        nav.append(InlineKeyboardButton("التالي ▶️", callback_data=f"trash:list:{page+1}"))
+    if prev_cur:
+        nav.append(InlineKeyboardButton("◀️ السابق", callback_data=cb("trash:list", page - 1, prev_cur)))
+    if next_cur:
+        nav.append(InlineKeyboardButton("التالي ▶️", callback_data=cb("trash:list", page + 1, next_cur)))
     if nav:
         kb.row(*nav)
     # أزرار المالك
-    if user_is_mod(call.from_user.id):
-        kb.row(InlineKeyboardButton("🧹 تفريغ الكل", callback_data="trash:purge_all:confirm"))
-    kb.add(InlineKeyboardButton("🏠 الرئيسية", callback_data="main:open"))
-    await call.message.edit_text(f"🗑️ سلة المحذوفات (صفحة {page})", reply_markup=kb)
-    await call.answer()
-
-@dp.callback_query_handler(lambda c: c.data.startswith("trash:restore:"))
-async def cb_trash_restore(call: CallbackQuery):
-    item_id = int(call.data.split(":")[2])
-    with closing(db_connect()) as con, con:
-        con.execute("UPDATE items SET status='active', deleted_at=NULL WHERE id=?", (item_id,))
-    await call.message.edit_text("♻️ تم استرجاع العنصر.", reply_markup=send_main_menu(user_is_owner(call.from_user.id)))
-    await call.answer("تم الاسترجاع")
+    if is_mod:
+        kb.row(InlineKeyboardButton("🧹 تفريغ الكل", callback_data=cb("trash:purge_all:confirm")))
+    kb.add(InlineKeyboardButton("🏠 الرئيسية", callback_data=cb("main:open")))
+    return f"🗑️ سلة المحذوفات (صفحة {page})", kb
+
+@router.route("trash:restore", "tr", int)
+async def cb_trash_restore(call: CallbackQuery, item_id: int):
+    try:
+        restored = await db.write(lambda con: restore_item(con, item_id))
+    except QuotaExceeded as e:
+        return await call.answer(str(e), show_alert=True)
+    if restored is None:
+        return await call.answer("غير موجود.", show_alert=True)
+    outbox.wake()
+    await respond(call, "♻️ تم استرجاع العنصر.", reply_markup=send_main_menu(user_is_owner(call.from_user.id)), note="تم الاسترجاع")
 
-@dp.callback_query_handler(lambda c: c.data.startswith("trash:purge:"))
-async def cb_trash_purge(call: CallbackQuery):
-    if not user_is_mod(call.from_user.id):
+@router.route("trash:purge", "tp", int)
+async def cb_trash_purge(call: CallbackQuery, item_id: int):
+    if not await user_is_mod(call.from_user.id):
         return await call.answer("صلاحية غير كافية.", show_alert=True)
-    item_id = int(call.data.split(":")[2])
-    with closing(db_connect()) as con, con:
-        con.execute("DELETE FROM items WHERE id=?", (item_id,))
-    await call.message.edit_text("❌ تم حذف العنصر نهائيًا.", reply_markup=send_main_menu(user_is_owner(call.from_user.id)))
-    await call.answer("تم الحذف النهائي")
+    await db.write(lambda con: purge_items(con, [item_id]))
+    outbox.wake()
+    await respond(call, "❌ تم حذف العنصر نهائيًا.", reply_markup=send_main_menu(user_is_owner(call.from_user.id)), note="تم الحذف النهائي")
 
-@dp.callback_query_handler(lambda c: c.data == "trash:purge_all:confirm")
+@router.route("trash:purge_all:confirm", "tc")
 async def cb_trash_purge_all(call: CallbackQuery):
-    if not user_is_mod(call.from_user.id):
+    if not await user_is_mod(call.from_user.id):
         return await call.answer("صلاحية غير كافية.", show_alert=True)
     kb = InlineKeyboardMarkup().add(
-        InlineKeyboardButton("⚠️ تأكيد التفريغ", callback_data="trash:purge_all:do")
-    ).add(InlineKeyboardButton("إلغاء", callback_data="trash:list:1"))
-    await call.message.edit_text("ستقوم بحذف جميع عناصر السلة نهائيًا. هل أنت متأكد؟", reply_markup=kb)
-    await call.answer()
+        InlineKeyboardButton("⚠️ تأكيد التفريغ", callback_data=cb("trash:purge_all:do"))
+    ).add(InlineKeyboardButton("إلغاء", callback_data=cb("trash:list", 1)))
+    await respond(call, "ستقوم بحذف جميع عناصر السلة نهائيًا. هل أنت متأكد؟", reply_markup=kb)
 
-@dp.callback_query_handler(lambda c: c.data == "trash:purge_all:do")
+TRASH_TOTAL_SQL = """
+    SELECT (SELECT COALESCE(SUM(n), 0) FROM item_counts WHERE status='trashed')
+         + (SELECT COALESCE(SUM(n), 0) FROM archive.counts WHERE name='items')
+"""
+
+@router.route("trash:purge_all:do", "td")
 async def cb_trash_purge_all_do(call: CallbackQuery):
-    if not user_is_mod(call.from_user.id):
+    if not await user_is_mod(call.from_user.id):
         return await call.answer("صلاحية غير كافية.", show_alert=True)
-    with closing(db_connect()) as con, con:
-        con.execute("DELETE FROM items WHERE status='trashed'")
-    await call.message.edit_text("🧹 تم تفريغ السلة نهائيًا.", reply_markup=send_main_menu(user_is_owner(call.from_user.id)))
-    await call.answer("تم")
+    task = dp.get("purge_task")
+    if task is not None and not task.done():
+        return await call.answer("التفريغ جارٍ بالفعل.", show_alert=True)
+    total = (await db.fetchone(TRASH_TOTAL_SQL))[0]
+    await respond(call, f"🧹 جارٍ تفريغ السلة ({total} عنصر)…", note="بدأ التفريغ")
+    message, is_owner = call.message, user_is_owner(call.from_user.id)
+    last_edit = time.monotonic()
+    async def progress(done: int):
+        nonlocal last_edit
+        if time.monotonic() - last_edit >= PURGE_PROGRESS_EVERY:
+            last_edit = time.monotonic()
+            try:
+                await edit_message(message, f"🧹 جارٍ تفريغ السلة: {done} من {total}…")
+            except Exception:
+                pass
+    async def run():
+        try:
+            done = await purge_trash(progress=progress)
+        except Exception:
+            logging.exception("purge: فشل تفريغ السلة")
+            return await edit_message(message, "⚠️ توقف التفريغ بسبب خطأ، ما حُذف قبله محفوظ. أعد المحاولة.",
+                                      reply_markup=send_main_menu(is_owner))
+        await edit_message(message, f"🧹 تم تفريغ السلة نهائيًا ({done} عنصر)، وتُحذف منشوراتها من القناة تدريجيًا.",
+                           reply_markup=send_main_menu(is_owner))
+    dp["purge_task"] = asyncio.ensure_future(run())
+
+# ================== طابور النسخ إلى القناة (outbox) ==================
+# الرفع يُكتب في items و outbox بمعاملة واحدة ويُؤكَّد للمستخدم فورًا، ثم يسلّم
+# عمال غير متزامنين الرسائل للقناة بمعدل محدود، مع إعادة محاولة وتراجع أُسّي
+# يحترم RetryAfter، ويملؤون channel_msg_id عند النجاح.
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "2"))
+CHANNEL_RATE_PER_MIN = float(os.getenv("CHANNEL_RATE_PER_MIN", "20"))
+CHANNEL_BURST = int(os.getenv("CHANNEL_BURST", "5"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+CHANNEL_DELETE_RATE = float(os.getenv("CHANNEL_DELETE_RATE", "5"))    # حذف منشورات القناة في الثانية
+OUTBOX_MAX_BACKOFF = 600
+OUTBOX_POLL = 2.0
+
+def outbox_enqueue(con, item_id: int, kind: str, payload: dict):
+    now = time.time()
+    con.execute("INSERT INTO outbox(item_id, kind, payload, attempts, next_at, created_at) VALUES(?,?,?,0,?,?)",
+                (item_id, kind, json.dumps(payload), now, now))
+
+def outbox_cancel(con, ids: list):
+    # يلغي النشر المعلّق لعناصر حُذفت: مهامها المفردة تُحذف، وتُزال من ألبومات لم تُنشر.
+    # مهمة الألبوم مسجلة بمعرّف أول عناصره فقط، فتُقرأ كل مهام الألبومات (الطابور صغير).
+    # وما كان قيد الإرسال يُحذف منشوره بعد نشره (ChannelOutbox._deliver)
+    gone = set(ids)
+    con.execute(PURGE_OUTBOX_SQL.format(marks=",".join("?" * len(ids))), ids)
+    for job_id, payload in con.execute("SELECT id, payload FROM outbox WHERE kind='media_group'").fetchall():
+        items = json.loads(payload)["items"]
+        left = [it for it in items if it["item_id"] not in gone]
+        if len(left) == len(items):
+            continue
+        if not left:
+            con.execute("DELETE FROM outbox WHERE id=?", (job_id,))
+        elif len(left) == 1:
+            # send_media_group يتطلب عنصرين على الأقل
+            it = left[0]
+            con.execute("UPDATE outbox SET item_id=?, kind=?, payload=? WHERE id=?",
+                        (it["item_id"], it["kind"], json.dumps({k: it[k] for k in ("file_id", "thumb_id", "caption")}), job_id))
+        else:
+            con.execute("UPDATE outbox SET item_id=?, payload=? WHERE id=?",
+                        (left[0]["item_id"], json.dumps({"items": left}), job_id))
+
+_INPUT_MEDIA = {"photo": types.InputMediaPhoto, "video": types.InputMediaVideo,
+                "audio": types.InputMediaAudio, "document": types.InputMediaDocument}
+
+def input_media(it: dict) -> types.InputMedia:
+    # المصغّرة كما في الإرسال المفرد؛ InputMediaPhoto بلا thumb
+    if it["kind"] == "photo":
+        return types.InputMediaPhoto(it["file_id"], caption=it["caption"])
+    return _INPUT_MEDIA[it["kind"]](it["file_id"], thumb=it["thumb_id"], caption=it["caption"])
+
+async def channel_send(kind: str, p: dict):
+    if kind == "media_group":
+        return await bot.send_media_group(CHANNEL_ID, [input_media(it) for it in p["items"]])
+    if kind == "photo":
+        return await bot.send_photo(CHANNEL_ID, photo=p["file_id"], caption=p["caption"])
+    if kind == "video":
+        return await bot.send_video(CHANNEL_ID, video=p["file_id"], caption=p["caption"], thumb=p["thumb_id"])
+    if kind == "audio":
+        return await bot.send_audio(CHANNEL_ID, audio=p["file_id"], caption=p["caption"], thumb=p["thumb_id"])
+    return await bot.send_document(CHANNEL_ID, document=p["file_id"], caption=p["caption"], thumb=p["thumb_id"])
+
+OUTBOX_DUE_SQL = hot("outbox due", """
+    SELECT id, item_id, kind, payload, attempts, created_at FROM outbox
+    WHERE next_at <= ? ORDER BY next_at LIMIT 100
+""")
+
+class ChannelOutbox:
+    def __init__(self, workers: int, bucket: TokenBucket, delete_bucket: TokenBucket):
+        self.workers = workers
+        self.bucket = bucket
+        self.delete_bucket = delete_bucket
+        self.delivered = 0
+        self.deleted = 0
+        self.failures = 0
+        self.last_lag = 0.0
+        self._queue: Optional[asyncio.Queue] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._inflight: set = set()
+        self._tasks: list = []
+
+    def start(self):
+        self._queue = asyncio.Queue(maxsize=self.workers * 2)
+        self._wake = asyncio.Event()
+        self._tasks = [asyncio.ensure_future(self._dispatch())]
+        self._tasks += [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    def wake(self):
+        if self._wake is not None:
+            self._wake.set()
+        else:
+            # الصندوق يعمل في العامل 0 فقط؛ يُستدعى لكتابات هذا العامل وحدها
+            notify_workers("outbox")
+
+    async def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _dispatch(self):
+        while True:
+            self._wake.clear()
+            rows = await db.fetchall(OUTBOX_DUE_SQL, (time.time(),))
+            for row in rows:
+                if row[0] not in self._inflight:
+                    self._inflight.add(row[0])
+                    await self._queue.put(row)
+            try:
+                await asyncio.wait_for(self._wake.wait(), OUTBOX_POLL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _worker(self):
+        while True:
+            row = await self._queue.get()
+            try:
+                await self._deliver(*row)
+            except Exception:
+                logging.exception("outbox: فشل غير متوقع للمهمة %s", row[0])
+            finally:
+                self._inflight.discard(row[0])
+
+    async def _deliver(self, job_id: int, item_id: int, kind: str, payload: str, attempts: int, created_at: float):
+        payload = json.loads(payload)
+        if kind == "delete":
+            return await self._delete(job_id, payload["message_id"], attempts)
+        targets = [it["item_id"] for it in payload["items"]] if kind == "media_group" else [item_id]
+        # الألبوم يُحتسب رسائل بعدد عناصره (بحد سعة الدلو)
+        await self.bucket.take(min(len(targets), self.bucket.capacity))
+        try:
+            sent = await channel_send(kind, payload)
+        except RetryAfter as e:
+            self.bucket.pause(e.timeout)
+            await db.execute("UPDATE outbox SET next_at=?, last_error=? WHERE id=?",
+                             (time.time() + e.timeout, f"RetryAfter {e.timeout}s", job_id))
+            return
+        except Exception as e:
+            self.failures += 1
+            attempts += 1
+            next_at = time.time() + min(OUTBOX_MAX_BACKOFF, 2 ** attempts) if attempts < OUTBOX_MAX_ATTEMPTS else None
+            logging.warning("outbox: فشل إرسال المهمة %s (محاولة %s): %s", job_id, attempts, e)
+            await db.execute("UPDATE outbox SET attempts=?, next_at=?, last_error=? WHERE id=?",
+                             (attempts, next_at, str(e)[:200], job_id))
+            return
+        sent = sent if isinstance(sent, list) else [sent]
+        def done(con):
+            orphans = 0
+            for m, target in zip(sent, targets):
+                if (not con.execute("UPDATE items SET channel_msg_id=? WHERE id=?", (m.message_id, target)).rowcount
+                        and not con.execute("UPDATE archive.items SET channel_msg_id=? WHERE id=?",
+                                            (m.message_id, target)).rowcount):
+                    # حُذف العنصر نهائيًا أثناء إرساله
+                    outbox_enqueue(con, None, "delete", {"message_id": m.message_id})
+                    orphans += 1
+            con.execute("DELETE FROM outbox WHERE id=?", (job_id,))
+            return orphans
+        if await db.write(done):
+            self.wake()
+        self.delivered += 1
+        self.last_lag = time.time() - created_at
+
+    async def _delete(self, job_id: int, message_id: int, attempts: int):
+        # حذف منشور من القناة بدلو مستقل (حد الحذف أوسع من حد النشر)
+        await self.delete_bucket.take()
+        try:
+            await bot.delete_message(CHANNEL_ID, message_id)
+        except (MessageToDeleteNotFound, MessageCantBeDeleted) as e:
+            # محذوف مسبقًا أو لا يمكن حذفه: إعادة المحاولة لن تفيد
+            logging.info("outbox: تعذّر حذف المنشور %s نهائيًا: %s", message_id, e)
+        except RetryAfter as e:
+            self.delete_bucket.pause(e.timeout)
+            await db.execute("UPDATE outbox SET next_at=?, last_error=? WHERE id=?",
+                             (time.time() + e.timeout, f"RetryAfter {e.timeout}s", job_id))
+            return
+        except Exception as e:
+            self.failures += 1
+            attempts += 1
+            next_at = time.time() + min(OUTBOX_MAX_BACKOFF, 2 ** attempts) if attempts < OUTBOX_MAX_ATTEMPTS else None
+            await db.execute("UPDATE outbox SET attempts=?, next_at=?, last_error=? WHERE id=?",
+                             (attempts, next_at, str(e)[:200], job_id))
+            return
+        await db.execute("DELETE FROM outbox WHERE id=?", (job_id,))
+        self.deleted += 1
+
+    async def stats(self) -> Tuple[int, int, int, Optional[float]]:
+        # (العمق، المستحق الآن، المتوقف، عمر أقدم صف بالثواني)
+        depth, due, dead, oldest = await db.fetchone(
+            "SELECT COUNT(*), COALESCE(SUM(next_at <= ?), 0), COALESCE(SUM(next_at IS NULL), 0), MIN(created_at) FROM outbox",
+            (time.time(),))
+        return depth, due, dead, (time.time() - oldest) if oldest else None
+
+outbox = ChannelOutbox(OUTBOX_WORKERS, TokenBucket(CHANNEL_RATE_PER_MIN / 60, CHANNEL_BURST),
+                       TokenBucket(CHANNEL_DELETE_RATE, CHANNEL_DELETE_RATE))
+# إشعار وارد يوقظ الصندوق محليًا فقط (لا يُعاد بثه فيدور بين العمال)
+NOTIFY_HANDLERS["outbox"] = lambda _key: outbox._wake and outbox._wake.set()
+
+# ================== الحذف النهائي المجزّأ ==================
+# الحذف النهائي يجري على دفعات من PURGE_BATCH عنصرًا، كل دفعة معاملة مستقلة
+# فلا يُحجز قفل الكتابة طويلًا وتمر كتابات المستخدمين بين الدفعات. في المعاملة
+# نفسها تُلغى مهام النشر المعلّقة للعناصر وتُضاف مهام "delete" لمنشوراتها في
+# القناة، فيحذفها عمال الطابور بمعدل CHANNEL_DELETE_RATE ولو أُعيد تشغيل البوت.
+# السلة تشمل المؤرشف (archive.items)، فيُحذف العنصر من الطبقتين بالمعرّف نفسه.
+# TRASH_RETENTION_DAYS > 0 يفعّل كنسًا دوريًا لما بقي في السلة أكثر من تلك المدة.
+PURGE_BATCH = int(os.getenv("PURGE_BATCH", "500"))
+PURGE_PROGRESS_EVERY = 2.0
+TRASH_RETENTION_DAYS = float(os.getenv("TRASH_RETENTION_DAYS", "0"))    # 0 = بلا كنس تلقائي
+TRASH_SWEEP_INTERVAL = float(os.getenv("TRASH_SWEEP_INTERVAL", "3600"))
+
+# قوالب {marks} تُسجَّل بعنصر واحد؛ الخطة نفسها لأي طول قائمة
+PURGE_POSTS_SQL = "SELECT channel_msg_id FROM {table} WHERE id IN ({marks}) AND channel_msg_id IS NOT NULL"
+PURGE_OUTBOX_SQL = "DELETE FROM outbox WHERE item_id IN ({marks}) AND kind != 'media_group'"
+PURGE_ITEMS_SQL = "DELETE FROM {table} WHERE id IN ({marks})"
+PURGE_BATCH_SQL = "SELECT id FROM {table} WHERE {where} ORDER BY deleted_at LIMIT ?"
+# (الجدول، شرط السلة) بترتيب الحذف. المؤرشف الذي له نسخة في items (استرجاع انقطع
+# قبل حذفه من الأرشيف) لا يُحذف من هنا حتى لا يُحذف العنصر النشط بمعرّفه.
+PURGE_SOURCES = [("items", "status='trashed'"),
+                 ("archive.items", "NOT EXISTS (SELECT 1 FROM main.items m WHERE m.id = archive.items.id)")]
+hot("purge outbox", PURGE_OUTBOX_SQL.format(marks="?"))
+for _table, _where in PURGE_SOURCES:
+    hot(f"purge posts ({_table})", PURGE_POSTS_SQL.format(table=_table, marks="?"))
+    hot(f"purge items ({_table})", PURGE_ITEMS_SQL.format(table=_table, marks="?"))
+    hot(f"purge batch ({_table})", PURGE_BATCH_SQL.format(table=_table, where=_where))
+    hot(f"purge batch ({_table}, older)", PURGE_BATCH_SQL.format(table=_table, where=_where + " AND deleted_at < ?"))
+
+def purge_items(con: sqlite3.Connection, ids: list) -> int:
+    marks = ",".join("?" * len(ids))
+    posts = {row[0] for table, _ in PURGE_SOURCES
+             for row in con.execute(PURGE_POSTS_SQL.format(table=table, marks=marks), ids)}
+    outbox_cancel(con, ids)
+    for message_id in posts:
+        outbox_enqueue(con, None, "delete", {"message_id": message_id})
+    return sum(con.execute(PURGE_ITEMS_SQL.format(table=table, marks=marks), ids).rowcount
+               for table, _ in PURGE_SOURCES)
+
+async def purge_trash(older_than: Optional[str] = None, progress: Optional[Callable] = None) -> int:
+    # older_than: deleted_at بصيغة now_str()؛ None = كل السلة
+    done = 0
+    for table, where in PURGE_SOURCES:
+        sql, params = PURGE_BATCH_SQL.format(table=table, where=where), ()
+        if older_than is not None:
+            sql, params = PURGE_BATCH_SQL.format(table=table, where=where + " AND deleted_at < ?"), (older_than,)
+        def batch(con):
+            ids = [r[0] for r in con.execute(sql, params + (PURGE_BATCH,))]
+            return purge_items(con, ids) if ids else 0
+        while True:
+            n = await db.write(batch)
+            if not n:
+                break
+            done += n
+            outbox.wake()
+            if progress is not None:
+                await progress(done)
+    return done
+
+async def trash_sweeper():
+    while True:
+        try:
+            cutoff = (datetime.utcnow() - timedelta(days=TRASH_RETENTION_DAYS)).isoformat(timespec="seconds")
+            n = await purge_trash(older_than=cutoff)
+            if n:
+                logging.info("trash: حُذف %d عنصر تجاوز %s يومًا في السلة", n, TRASH_RETENTION_DAYS)
+        except Exception:
+            logging.exception("trash: فشل الكنس الدوري")
+        await asyncio.sleep(TRASH_SWEEP_INTERVAL)
+
+# ================== أرشيف السلة (الطبقة الباردة) ==================
+# ما بقي في السلة أكثر من ARCHIVE_AFTER_DAYS يُنقل على دفعات إلى archive.items في ملف
+# مستقل (ARCHIVE_PATH)، فيبقى items وفهارسه للكتالوج النشط وسلة حديثة صغيرة. النقل
+# معاملتان لكل دفعة: نسخ إلى الأرشيف (متزامن FULL) ثم حذف من items ما ثبت نسخه، لأن
+# المعاملة على ملفين في WAL ليست ذرية بينهما عند انقطاع الكهرباء. أسوأ حالة بعد انقطاع
+# نسخة في الطبقتين، وTRASH_ALL يُظهر نسخة items وحدها، والدفعة التالية تكمل الحذف.
+# صفحات السلة تقرأ TRASH_ALL (الطبقتان مدموجتان بترتيب deleted_at من فهرسيهما)،
+# والعرض والاسترجاع والحذف النهائي ومنع التكرار تجد المؤرشف بمعرّفه أو file_unique_id.
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "30"))   # 0 = بلا أرشفة
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", "500"))
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "3600"))
+
+ITEM_COLUMNS = ("id, type, file_id, thumb_id, name, caption, uploader_id, status, channel_msg_id, created_at, deleted_at, "
+                "file_unique_id, file_size, media_kind")
+ARCHIVE_PICK_SQL = hot("archive pick", "SELECT id FROM main.items WHERE status='trashed' AND deleted_at < ? ORDER BY deleted_at LIMIT ?")
+ARCHIVE_COPY_SQL = f"""
+    INSERT OR REPLACE INTO archive.items({ITEM_COLUMNS}, archived_at)
+    SELECT {ITEM_COLUMNS}, ? FROM main.items WHERE id IN ({{marks}}) AND status='trashed'
+"""
+ARCHIVE_DROP_SQL = """
+    DELETE FROM main.items WHERE id IN ({marks}) AND status='trashed'
+    AND EXISTS (SELECT 1 FROM archive.items a WHERE a.id = main.items.id)
+"""
+ARCHIVED_ITEM_SQL = hot("archived item", f"SELECT {ITEM_COLUMNS} FROM archive.items WHERE id=?")
+ARCHIVED_DUPLICATE_SQL = hot("archived duplicate", "SELECT id FROM archive.items WHERE file_unique_id=?")
+hot("archive copy", ARCHIVE_COPY_SQL.format(marks="?"))
+hot("archive drop", ARCHIVE_DROP_SQL.format(marks="?"))
+
+async def archive_trash(older_than: str) -> int:
+    done = 0
+    while True:
+        def copy(con):
+            ids = [r[0] for r in con.execute(ARCHIVE_PICK_SQL, (older_than, ARCHIVE_BATCH))]
+            if ids:
+                con.execute(ARCHIVE_COPY_SQL.format(marks=",".join("?" * len(ids))), [now_str()] + ids)
+            return ids
+        ids = await db.write(copy)
+        if not ids:
+            return done
+        done += await db.write(lambda con: con.execute(ARCHIVE_DROP_SQL.format(marks=",".join("?" * len(ids))),
+                                                       ids).rowcount)
+
+async def archiver():
+    while True:
+        try:
+            cutoff = (datetime.utcnow() - timedelta(days=ARCHIVE_AFTER_DAYS)).isoformat(timespec="seconds")
+            n = await archive_trash(cutoff)
+            if n:
+                logging.info("archive: نُقل %d عنصر من السلة إلى الأرشيف", n)
+        except Exception:
+            logging.exception("archive: فشل النقل الدوري")
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+
+def unarchive(con: sqlite3.Connection, item_id: int) -> Optional[int]:
+    # يعيد العنصر المؤرشف نشطًا إلى items في معاملة الكاتب؛ يعيد معرّفه النشط، أو None.
+    # إن رُفع المحتوى نفسه بعد أرشفته فالموجود في items يبقى ويُحذف المؤرشف ومنشوره.
+    row = con.execute(ARCHIVED_ITEM_SQL, (item_id,)).fetchone()
+    if row is None:
+        return None
+    keep = claim_duplicate(con, row[11], archived=False)
+    if keep is None:
+        quota_guard(con, row[6], row[12])
+        con.execute(f"INSERT OR IGNORE INTO main.items({ITEM_COLUMNS}) VALUES ({', '.join('?' * 14)})",
+                    row[:7] + ("active", row[8], row[9], None, row[11], row[12], row[13]))
+        keep = item_id
+    elif row[8] is not None and row[8] != con.execute("SELECT channel_msg_id FROM items WHERE id=?", (keep,)).fetchone()[0]:
+        outbox_enqueue(con, None, "delete", {"message_id": row[8]})
+    con.execute("DELETE FROM archive.items WHERE id=?", (item_id,))
+    return keep
+
+def restore_item(con: sqlite3.Connection, item_id: int) -> Optional[int]:
+    row = con.execute("SELECT status, uploader_id, file_size FROM items WHERE id=?", (item_id,)).fetchone()
+    if row is None:
+        return unarchive(con, item_id)
+    if row[0] != "active":
+        quota_guard(con, row[1], row[2])
+        con.execute("UPDATE items SET status='active', deleted_at=NULL WHERE id=?", (item_id,))
+    return item_id
 
 # ================== رفع جديد (حسب الفئة) ==================
-@dp.callback_query_handler(lambda c: c.data.startswith("cat:upload:"))
-async def cb_upload_prompt(call: CallbackQuery, state: FSMContext):
-    cat = call.data.split(":")[2]
-    if not user_is_registered(call.from_user.id):
+@router.route("cat:upload", "cu", str)
+async def cb_upload_prompt(call: CallbackQuery, cat: str, state: FSMContext):
+    if not await user_is_registered(call.from_user.id):
         return await call.answer("سجّل أولاً: /start", show_alert=True)
     await state.update_data(upload_for=cat)
     await UploadWait.for_type.set()
-    await call.message.edit_text(f"أرسل الآن العنصر لرفعه ضمن فئة: {cat}\n(صورة/فيديو/ملف/صوت بحسب الفئة)")
-    await call.answer()
+    await respond(call, f"أرسل الآن العنصر لرفعه ضمن فئة: {cat}\n(صورة/فيديو/ملف/صوت بحسب الفئة)")
 
 async def store_to_channel_and_db(
     msg: types.Message,
@@ -424,60 +2471,284 @@ async def store_to_channel_and_db(
     file_id: str,
     thumb_id: Optional[str],
     name: Optional[str],
-    caption: Optional[str]
-):
-    # إرسال للقناة وفق النوع
-    sent = None
+    caption: Optional[str],
+    file_unique_id: Optional[str] = None
+) -> int:
+    kind = channel_kind(msg, cat)
+    def insert(con):
+        # فحص ثانٍ داخل معاملة الكاتب: رفعان متزامنان للملف نفسه ينتهيان بعنصر واحد
+        dup = claim_duplicate(con, file_unique_id)
+        if dup is not None:
+            return dup
+        # والحصة كذلك: الفحص المسبق على قارئ فقد تمر رفعات متوازية كلها قبل حفظ أي منها
+        quota_guard(con, msg.from_user.id, message_file_size(msg))
+        cur = con.execute(INSERT_ITEM_SQL, (cat, file_id, thumb_id, name, caption, msg.from_user.id, "active", None, now_str(),
+                                            file_unique_id, message_file_size(msg), kind))
+        outbox_enqueue(con, cur.lastrowid, kind, {"file_id": file_id, "thumb_id": thumb_id, "caption": caption})
+        return cur.lastrowid
+    item_id = await db.write(insert)
+    outbox.wake()
+    return item_id
+
+# ================== منع التكرار (file_unique_id) ==================
+# file_unique_id ثابت للمحتوى نفسه مهما أُعيد توجيهه، وfile_id يتغير. الملف المكرر
+# لا يُدرج ولا يُنشر في القناة مرة أخرى: يُربط المستخدم بالعنصر الموجود
+# (ومنشوره في القناة)، ويُسترجع إن كان في السلة.
+DUPLICATE_SQL = hot("duplicate lookup", "SELECT id, status, uploader_id, file_size FROM items WHERE file_unique_id=?")
+DEDUP_SCAN_SQL = hot("dedup scan", "SELECT id, file_id FROM items WHERE id > ? AND file_unique_id IS NULL ORDER BY id LIMIT 200")
+
+def claim_duplicate(con: sqlite3.Connection, file_unique_id: Optional[str], archived: bool = True) -> Optional[int]:
+    if not file_unique_id:
+        return None
+    row = con.execute(DUPLICATE_SQL, (file_unique_id,)).fetchone()
+    if row is None:
+        # ملف أُرشف بعد بقائه في السلة يعود إلى items كما يعود المحذوف
+        hit = con.execute(ARCHIVED_DUPLICATE_SQL, (file_unique_id,)).fetchone() if archived else None
+        return unarchive(con, hit[0]) if hit else None
+    if row[1] != "active":
+        quota_guard(con, row[2], row[3])
+        con.execute("UPDATE items SET status='active', deleted_at=NULL WHERE id=?", (row[0],))
+    return row[0]
+
+async def find_duplicate(file_unique_id: Optional[str]) -> Optional[int]:
+    # بحث O(1) في الفهرس الفريد على قارئ، فالحالة الشائعة (ملف جديد) لا تمر بالكاتب
+    if not file_unique_id:
+        return None
+    row = await db.fetchone(DUPLICATE_SQL, (file_unique_id,))
+    if row is None:
+        if await db.fetchone(ARCHIVED_DUPLICATE_SQL, (file_unique_id,)) is None:
+            return None
+        return await db.write(lambda con: claim_duplicate(con, file_unique_id))
+    if row[1] != "active":
+        return await db.write(lambda con: claim_duplicate(con, file_unique_id))
+    return row[0]
+
+async def is_known_file(file_unique_id: Optional[str]) -> bool:
+    # مثل find_duplicate لكن للقراءة فقط: لا يسترجع شيئًا
+    if not file_unique_id:
+        return False
+    return (await db.fetchone(DUPLICATE_SQL, (file_unique_id,)) is not None
+            or await db.fetchone(ARCHIVED_DUPLICATE_SQL, (file_unique_id,)) is not None)
+
+def reply_duplicate(message: types.Message, item_id: int):
+    kb = InlineKeyboardMarkup().add(InlineKeyboardButton("👁️ عرض العنصر", callback_data=cb("item:view", item_id)))
+    kb.add(InlineKeyboardButton("🏠 الرئيسية", callback_data=cb("main:open")))
+    followups.add(message.chat.id, f"♻️ هذا الملف موجود مسبقًا (#{item_id})، لم يُرفع مرة أخرى.", reply_markup=kb)
+
+def merge_duplicate(con: sqlite3.Connection, item_id: int, file_unique_id: str) -> Tuple[bool, Optional[int]]:
+    # يسجّل مفتاح المحتوى لعنصر قديم؛ إن وُجد عنصر بالمفتاح نفسه يُدمجان: يبقى الأقدم
+    # (روابطه أثبت) نشطًا إن كان أحدهما نشطًا، ويرث منشور القناة إن لم يكن له منشور.
+    # يعيد (هل دُمج، منشور القناة الزائد إن وُجد ليُحذف من القناة).
+    other = con.execute("SELECT id FROM items WHERE file_unique_id=?", (file_unique_id,)).fetchone()
+    if other is None:
+        con.execute("UPDATE items SET file_unique_id=? WHERE id=?", (file_unique_id, item_id))
+        return False, None
+    keep, drop = sorted((item_id, other[0]))
+    rows = {r[0]: r[1:] for r in con.execute(
+        "SELECT id, status, channel_msg_id FROM items WHERE id IN (?, ?)", (keep, drop))}
+    if len(rows) < 2:
+        return False, None
+    (keep_status, keep_msg), (drop_status, drop_msg) = rows[keep], rows[drop]
+    outbox_cancel(con, [drop])
+    con.execute("DELETE FROM items WHERE id=?", (drop,))
+    if keep_status != "active" and drop_status == "active":
+        con.execute("UPDATE items SET status='active', deleted_at=NULL WHERE id=?", (keep,))
+    con.execute("UPDATE items SET file_unique_id=?, channel_msg_id=COALESCE(channel_msg_id, ?) WHERE id=?",
+                (file_unique_id, drop_msg, keep))
+    if keep_msg is None and drop_msg is not None:
+        # المنشور الموروث يغني عن نسخ الباقي إلى القناة
+        outbox_cancel(con, [keep])
+    return True, (drop_msg if keep_msg is not None and drop_msg not in (None, keep_msg) else None)
+
+DEDUP_RATE = float(os.getenv("DEDUP_RATE", "10"))   # طلبات getFile في الثانية أثناء الدمج
+CHECKPOINT_SQL = hot("checkpoint", "SELECT last_id FROM checkpoints WHERE name=?")
+CHECKPOINT_SAVE_SQL = """
+    INSERT INTO checkpoints(name, last_id, updated_at) VALUES (?, ?, ?)
+    ON CONFLICT(name) DO UPDATE SET last_id=excluded.last_id, updated_at=excluded.updated_at
+"""
+
+async def dedup_backfill(progress: Callable, restart: bool = False) -> dict:
+    # العناصر المرفوعة قبل منع التكرار بلا file_unique_id: نجلبه عبر getFile بمعدل محدود
+    # ونمر عليها بمؤشر id فلا تتكرر الصفوف. آخر معرّف مفحوص يُحفظ بعد كل دفعة، فالتشغيل
+    # التالي يستأنف منه ولا يعيد طلب ما تُخطي (الأكبر من 20MB يبقى بلا مفتاح دائمًا)؛
+    # restart يبدأ من أول items (بعد استيراد عناصر قديمة مثلًا).
+    bucket = TokenBucket(DEDUP_RATE, DEDUP_RATE)
+    stats = {"checked": 0, "merged": 0, "skipped": 0}
+    row = None if restart else await db.fetchone(CHECKPOINT_SQL, ("dedup",))
+    last_id = row[0] if row else 0
+    while True:
+        rows = await db.fetchall(DEDUP_SCAN_SQL, (last_id,))
+        if not rows:
+            return stats
+        for item_id, file_id in rows:
+            last_id = item_id
+            while True:
+                await bucket.take()
+                try:
+                    unique_id = (await bot.get_file(file_id)).file_unique_id
+                    break
+                except RetryAfter as e:
+                    bucket.pause(e.timeout)
+                except Exception:
+                    # getFile يرفض الملفات الأكبر من 20MB؛ تبقى بلا مفتاح
+                    unique_id = None
+                    break
+            stats["checked"] += 1
+            if unique_id is None:
+                stats["skipped"] += 1
+                continue
+            merged, stale_msg = await db.write(lambda con: merge_duplicate(con, item_id, unique_id))
+            stats["merged"] += merged
+            if stale_msg is not None:
+                await outbox.bucket.take()
+                try:
+                    await bot.delete_message(CHANNEL_ID, stale_msg)
+                except Exception:
+                    logging.warning("dedup: تعذّر حذف المنشور المكرر %s من القناة", stale_msg)
+        await db.execute(CHECKPOINT_SAVE_SQL, ("dedup", last_id, now_str()))
+        await progress(stats)
+
+def channel_kind(msg: types.Message, cat: str) -> str:
+    # نوع الإرسال للقناة: الوسائط الأصلية بنوعها، وأي وثيقة أخرى كملف
     if cat == "image" and msg.photo:
-        sent = await bot.send_photo(CHANNEL_ID, photo=file_id, caption=caption)
-    elif cat == "video" and (getattr(msg, "video", None) or (msg.document and msg.document.mime_type and msg.document.mime_type.startswith("video/"))):
-        if getattr(msg, "video", None):
-            sent = await bot.send_video(CHANNEL_ID, video=file_id, caption=caption, thumb=thumb_id)
-        else:
-            sent = await bot.send_document(CHANNEL_ID, document=file_id, caption=caption, thumb=thumb_id)
-    elif cat == "audio" and (getattr(msg, "audio", None) or (msg.document and msg.document.mime_type and msg.document.mime_type.startswith("audio/"))):
-        if getattr(msg, "audio", None):
-            sent = await bot.send_audio(CHANNEL_ID, audio=file_id, caption=caption, thumb=thumb_id)
-        else:
-            sent = await bot.send_document(CHANNEL_ID, document=file_id, caption=caption, thumb=thumb_id)
-    else:
-        # file/app أو أي وثيقة
-        sent = await bot.send_document(CHANNEL_ID, document=file_id, caption=caption, thumb=thumb_id)
-    with closing(db_connect()) as con, con:
-        con.execute("""
-            INSERT INTO items(type, file_id, thumb_id, name, caption, uploader_id, status, channel_msg_id, created_at)
-            VALUES(?,?,?,?,?,?,?,?,?)
-        """, (cat, file_id, thumb_id, name, caption, msg.from_user.id, "active", sent.message_id if sent else None, now_str()))
+        return "photo"
+    if cat == "video" and getattr(msg, "video", None):
+        return "video"
+    if cat == "audio" and getattr(msg, "audio", None):
+        return "audio"
+    return "document"
 
-def detect_category_from_message(message: types.Message) -> Tuple[str, str, Optional[str], Optional[str]]:
-    # return (cat, file_id, thumb_id, name)
+INSERT_ITEM_SQL = """
+    INSERT INTO items(type, file_id, thumb_id, name, caption, uploader_id, status, channel_msg_id, created_at, file_unique_id, file_size,
+                      media_kind)
+    VALUES(?,?,?,?,?,?,?,?,?,?,?,?)
+"""
+
+def detect_category_from_message(message: types.Message) -> Tuple[str, str, Optional[str], Optional[str], str]:
+    # return (cat, file_id, thumb_id, name, file_unique_id)
     if message.photo:
-        return "image", message.photo[-1].file_id, None, None
+        return "image", message.photo[-1].file_id, None, None, message.photo[-1].file_unique_id
     if message.video:
         thumb = message.video.thumb.file_id if message.video.thumb else None
-        return "video", message.video.file_id, thumb, None
+        return "video", message.video.file_id, thumb, None, message.video.file_unique_id
     if message.audio:
         thumb = message.audio.thumb.file_id if message.audio.thumb else None
-        return "audio", message.audio.file_id, thumb, message.audio.file_name
+        return "audio", message.audio.file_id, thumb, message.audio.file_name, message.audio.file_unique_id
     if message.document:
         doc = message.document
         t = infer_doc_type(doc)
-        return t, doc.file_id, (doc.thumb.file_id if doc.thumb else None), doc.file_name
+        return t, doc.file_id, (doc.thumb.file_id if doc.thumb else None), doc.file_name, doc.file_unique_id
     raise ValueError("Unsupported content")
 
+def message_file_size(message: types.Message) -> int:
+    media = (message.photo[-1] if message.photo else None) or message.video or message.audio or message.document
+    return (media.file_size if media else None) or 0
+
+# ================== الألبومات (media_group_id) ==================
+# رسائل الألبوم الواحد تُجمع لنافذة قصيرة (تمتد مع كل جزء جديد)، ثم تُدرج
+# بمعاملة واحدة executemany، وتُنسخ للقناة بطلب send_media_group واحد عبر
+# الطابور، ويُرسل للمستخدم رد ملخّص واحد.
+ALBUM_WINDOW = float(os.getenv("ALBUM_WINDOW", "1.0"))
+
+_albums: dict = {}   # media_group_id -> {"message", "entries", "state", "timer"}
+
+def album_add(message: types.Message, cat: str, file_id: str, thumb_id: Optional[str],
+              name: Optional[str], caption: Optional[str], file_unique_id: Optional[str] = None,
+              state: Optional[FSMContext] = None):
+    gid = message.media_group_id
+    group = _albums.get(gid)
+    if group is None:
+        group = _albums[gid] = {"message": message, "entries": [], "state": None, "timer": None}
+    else:
+        group["timer"].cancel()
+    group["entries"].append((channel_kind(message, cat), cat, file_id, thumb_id, name, caption, file_unique_id,
+                             message_file_size(message)))
+    group["state"] = group["state"] or state
+    group["timer"] = asyncio.get_running_loop().call_later(
+        ALBUM_WINDOW, lambda: asyncio.ensure_future(album_flush(gid)))
+
+async def store_album(uploader_id: int, entries: list) -> Tuple[list, list]:
+    # يعيد (معرّفات العناصر الجديدة، معرّفات العناصر الموجودة مسبقًا)
+    created = now_str()
+    def insert(con):
+        fresh, dups, seen = [], [], set()
+        for e in entries:
+            dup = claim_duplicate(con, e[6])
+            if dup is not None:
+                dups.append(dup)
+            elif e[6] is None or e[6] not in seen:
+                seen.add(e[6])
+                fresh.append(e)
+        if not fresh:
+            return [], dups
+        quota_guard(con, uploader_id, sum(e[7] for e in fresh), len(fresh))
+        con.executemany(INSERT_ITEM_SQL, [(cat, file_id, thumb_id, name, caption, uploader_id, "active", None, created, unique_id, size, kind)
+                                          for kind, cat, file_id, thumb_id, name, caption, unique_id, size in fresh])
+        # كاتب واحد داخل معاملة واحدة: المعرّفات متتالية وتنتهي بآخر rowid
+        last = con.execute("SELECT last_insert_rowid()").fetchone()[0]
+        ids = list(range(last - len(fresh) + 1, last + 1))
+        posts = [{"item_id": item_id, "kind": kind, "file_id": file_id, "thumb_id": thumb_id, "caption": caption}
+                 for item_id, (kind, _, file_id, thumb_id, _, caption, _, _) in zip(ids, fresh)]
+        if len(posts) == 1:
+            # send_media_group يتطلب عنصرين على الأقل
+            p = posts[0]
+            outbox_enqueue(con, p["item_id"], p["kind"], {"file_id": p["file_id"], "thumb_id": p["thumb_id"], "caption": p["caption"]})
+        else:
+            outbox_enqueue(con, ids[0], "media_group", {"items": posts})
+        return ids, dups
+    ids, dups = await db.write(insert)
+    if ids:
+        outbox.wake()
+    return ids, dups
+
+async def album_flush(gid: str):
+    group = _albums.pop(gid)
+    message, entries = group["message"], group["entries"]
+    try:
+        ids, dups = await store_album(message.from_user.id, entries)
+    except QuotaExceeded as e:
+        return await message.answer(str(e))
+    except Exception:
+        logging.exception("album: فشل حفظ الألبوم %s", gid)
+        return await message.answer("⚠️ تعذّر حفظ الألبوم، أعد الإرسال.")
+    if group["state"] is not None:
+        await group["state"].finish()
+    if not ids:
+        return reply_duplicate(message, dups[0])
+    cats = "، ".join(sorted({e[1] for e in entries}))
+    note = f"\n♻️ {len(dups)} منها موجودة مسبقًا ولم تُرفع مرة أخرى." if dups else ""
+    followups.add(message.chat.id, f"✅ تم رفع ألبوم من {len(ids)} عناصر إلى فئة: {cats}{note}",
+                  reply_markup=send_main_menu(user_is_owner(message.from_user.id)))
+
 @dp.message_handler(state=UploadWait.for_type, content_types=types.ContentType.ANY)
 async def on_upload_any(message: types.Message, state: FSMContext):
     data = await state.get_data()
     cat = data.get("upload_for")
     try:
         # تأكد من النوع
-        det_cat, file_id, thumb_id, name = detect_category_from_message(message)
+        det_cat, file_id, thumb_id, name, unique_id = detect_category_from_message(message)
         if cat != det_cat and not (cat in ("file", "app") and det_cat == "file"):
             return await message.answer(f"الوسائط لا تتطابق مع فئة {cat}. أعد الإرسال بالصيغة الصحيحة.")
         caption = (message.caption or "").strip() or None
-        await store_to_channel_and_db(message, cat, file_id, thumb_id, name, caption)
-        await message.answer("✅ تم الرفع وتخزين العنصر في القناة.", reply_markup=send_main_menu(user_is_owner(message.from_user.id)))
+        if message.media_group_id:
+            over = await album_part_quota(message, unique_id)
+            if over:
+                return await message.answer(over)
+            # تنتهي الحالة عند تفريغ الألبوم حتى تصل بقية أجزائه إلى هذا المعالج
+            return album_add(message, cat, file_id, thumb_id, name, caption, unique_id, state)
+        dup = await find_duplicate(unique_id)
+        if dup is not None:
+            await state.finish()
+            return reply_duplicate(message, dup)
+        over = await quota_exceeded(message.from_user.id, message_file_size(message))
+        if over:
+            return await message.answer(over)
+        await store_to_channel_and_db(message, cat, file_id, thumb_id, name, caption, unique_id)
+        followups.add(message.chat.id, "✅ تم الرفع، وسيُنسخ العنصر إلى القناة خلال لحظات.",
+                      reply_markup=send_main_menu(user_is_owner(message.from_user.id)))
         await state.finish()
+    except QuotaExceeded as e:
+        await message.answer(str(e))
     except Exception:
         await message.answer("⚠️ لم أتمكن من قراءة هذا النوع. أرسل صورة/فيديو/صوت/ملف مناسب للفئة.")
 
@@ -489,46 +2760,155 @@ async def on_upload_any(message: types.Message, state: FSMContext):
     types.ContentType.AUDIO
 ])
 async def quick_upload(message: types.Message):
-    ensure_user(message.from_user)
-    if not user_is_registered(message.from_user.id):
+    await ensure_user(message.from_user)
+    if not await user_is_registered(message.from_user.id):
         return await message.answer("ℹ️ سجّل أولاً عبر /start ثم اضغط ✅ تسجيل حساب.")
-    det_cat, file_id, thumb_id, name = detect_category_from_message(message)
+    det_cat, file_id, thumb_id, name, unique_id = detect_category_from_message(message)
     caption = (message.caption or "").strip() or None
-    await store_to_channel_and_db(message, det_cat, file_id, thumb_id, name, caption)
-    await message.answer(f"✅ تم الرفع إلى فئة: {det_cat}", reply_markup=send_main_menu(user_is_owner(message.from_user.id)))
+    if message.media_group_id:
+        over = await album_part_quota(message, unique_id)
+        if over:
+            return await message.answer(over)
+        return album_add(message, det_cat, file_id, thumb_id, name, caption, unique_id)
+    try:
+        dup = await find_duplicate(unique_id)
+        if dup is not None:
+            return reply_duplicate(message, dup)
+        over = await quota_exceeded(message.from_user.id, message_file_size(message))
+        if over:
+            return await message.answer(over)
+        await store_to_channel_and_db(message, det_cat, file_id, thumb_id, name, caption, unique_id)
+    except QuotaExceeded as e:
+        return await message.answer(str(e))
+    followups.add(message.chat.id, f"✅ تم الرفع إلى فئة: {det_cat}", reply_markup=send_main_menu(user_is_owner(message.from_user.id)))
+
+# ================== رفعاتي وحصص الرفع ==================
+# uploader_counts يحمل عدد عناصر كل رافع وبايتاتها لكل حالة (تحدّثه مشغّلات items)،
+# فالتحقق من الحصة قراءة صف واحد بالمفتاح. الحصة تشمل العناصر النشطة فقط: الملف المكرر
+# لا يُفحص لأنه لا يضيف شيئًا. الفحص الملزم في معاملة الكاتب (quota_guard) قبل كل إدراج
+# أو إعادة عنصر من السلة أو الأرشيف (على حصة رافعه)، فلا تتجاوزها رفعات متوازية،
+# والألبوم يُقبل كله أو يُرفض كله؛ والفحص قبل الرفع على قارئ رد مبكر فقط.
+UPLOAD_QUOTA_ITEMS = int(os.getenv("UPLOAD_QUOTA_ITEMS", "0"))      # 0 = بلا حد
+UPLOAD_QUOTA_MB = float(os.getenv("UPLOAD_QUOTA_MB", "0"))          # 0 = بلا حد
+
+UPLOADER_USAGE_SQL = hot("uploader usage", "SELECT n, bytes FROM uploader_counts WHERE uploader_id=? AND status='active'")
+MY_UPLOADS_PAGE = hot_keyset("my uploads", ("id, name, caption, type", "items", "uploader_id=? AND status='active'",
+                                            "created_at", "id"))
+
+def fmt_size(n: int) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+
+async def uploader_usage(user_id: int) -> Tuple[int, int]:
+    row = await db.fetchone(UPLOADER_USAGE_SQL, (user_id,))
+    return (row[0], row[1]) if row else (0, 0)
+
+class QuotaExceeded(Exception):
+    # من quota_guard داخل معاملة الكاتب فتُلغى؛ نصها رسالة الرفض
+    pass
+
+def quota_message(n: int, used: int, size: int) -> Optional[str]:
+    if UPLOAD_QUOTA_ITEMS and n >= UPLOAD_QUOTA_ITEMS:
+        return f"⛔ بلغت حد الرفع ({UPLOAD_QUOTA_ITEMS} عنصر). احذف بعض رفعاتك لتتمكن من الرفع."
+    if UPLOAD_QUOTA_MB and used + size > UPLOAD_QUOTA_MB * 1024 ** 2:
+        return (f"⛔ هذا الملف يتجاوز مساحتك ({fmt_size(used)} من {fmt_size(UPLOAD_QUOTA_MB * 1024 ** 2)}). "
+                "احذف بعض رفعاتك لتتمكن من الرفع.")
+    return None
+
+async def quota_exceeded(user_id: int, size: int) -> Optional[str]:
+    # يعيد رسالة الرفض أو None
+    if user_is_owner(user_id) or not (UPLOAD_QUOTA_ITEMS or UPLOAD_QUOTA_MB):
+        return None
+    return quota_message(*await uploader_usage(user_id), size)
+
+async def album_part_quota(message: types.Message, file_unique_id: Optional[str]) -> Optional[str]:
+    # المكرر في الألبوم يُطابق عند تفريغه (store_album)، فيُعفى هنا ما هو موجود مسبقًا
+    if await is_known_file(file_unique_id):
+        return None
+    return await quota_exceeded(message.from_user.id, message_file_size(message))
+
+def quota_guard(con: sqlite3.Connection, uploader_id: Optional[int], size: Optional[int], count: int = 1):
+    # داخل معاملة الكاتب قبل إدراج count عنصرًا نشطًا بحجم size أو إعادتها إلى النشطة
+    if uploader_id is None or user_is_owner(uploader_id) or not (UPLOAD_QUOTA_ITEMS or UPLOAD_QUOTA_MB):
+        return
+    n, used = con.execute(UPLOADER_USAGE_SQL, (uploader_id,)).fetchone() or (0, 0)
+    over = quota_message(n + count - 1, used, size or 0)
+    if over:
+        raise QuotaExceeded(over)
+
+@router.route("user:uploads", "uu", int, rest=True)
+async def cb_my_uploads(call: CallbackQuery, page: int, cur: list):
+    uid = call.from_user.id
+    (n, used), (rows, prev_cur, next_cur) = await asyncio.gather(
+        uploader_usage(uid), keyset_page(MY_UPLOADS_PAGE, (uid,), decode_cursor(cur)))
+    usage = f"{n} عنصر، {fmt_size(used)}"
+    if UPLOAD_QUOTA_ITEMS or UPLOAD_QUOTA_MB:
+        limits = [f"{UPLOAD_QUOTA_ITEMS} عنصر"] if UPLOAD_QUOTA_ITEMS else []
+        limits += [fmt_size(UPLOAD_QUOTA_MB * 1024 ** 2)] if UPLOAD_QUOTA_MB else []
+        usage += f" (الحد: {'، '.join(limits)})"
+    kb = InlineKeyboardMarkup(row_width=2)
+    for it_id, name, caption, t in rows:
+        title = name or (caption[:20] + "…") if caption else f"{t} #{it_id}"
+        kb.insert(InlineKeyboardButton(title, callback_data=cb("item:view", it_id)))
+    nav = []
+    if prev_cur:
+        nav.append(InlineKeyboardButton("◀️ السابق", callback_data=cb("user:uploads", page - 1, prev_cur)))
+    if next_cur:
+        nav.append(InlineKeyboardButton("التالي ▶️", callback_data=cb("user:uploads", page + 1, next_cur)))
+    if nav:
+        kb.row(*nav)
+    kb.add(InlineKeyboardButton("🏠 الرئيسية", callback_data=cb("main:open")))
+    text = f"📤 رفعاتي (صفحة {page})\n{usage}" if rows else f"📤 رفعاتي\n{usage}\n\nلا عناصر نشطة."
+    await respond(call, text, reply_markup=kb)
 
 # ================== البحث ==================
-def search_items(keyword: str, cat: Optional[str] = None):
-    kw = f"%{keyword.lower()}%"
-    with closing(db_connect()) as con:
+# FTS5 مع ترتيب bm25 (rank، الاسم أثقل وزنًا من الوصف) ومطابقة بادئة لكل كلمة.
+SEARCH_LIMIT = 25
+SEARCH_SQL = hot("search", """
+    SELECT i.id, i.type, i.name, i.caption FROM items_fts f JOIN items i ON i.id = f.rowid
+    WHERE items_fts MATCH ? AND i.status='active' ORDER BY rank LIMIT ?
+""")
+SEARCH_CAT_SQL = hot("search in category", """
+    SELECT i.id, i.type, i.name, i.caption FROM items_fts f JOIN items i ON i.id = f.rowid
+    WHERE items_fts MATCH ? AND i.type=? AND i.status='active' ORDER BY rank LIMIT ?
+""")
+
+def fts_query(keyword: str) -> Optional[str]:
+    tokens = re.findall(r"\w+", normalize_ar(keyword))
+    if not tokens:
+        return None
+    return " ".join(f'"{t}"*' for t in tokens)
+
+async def search_items(keyword: str, cat: Optional[str] = None):
+    q = fts_query(keyword)
+    if not q:
+        return []
+    # المفتاح بالاستعلام المطبَّع، فتشترك "الإحصاء" و"احصاء" في مدخل واحد
+    key = ("search", q, cat, catalog_gen.get(cat or "*"))
+    rows = page_cache.get(key)
+    if rows is _MISSING:
         if cat:
-            rows = con.execute("""
-                SELECT id, type, name, caption FROM items
-                WHERE status='active' AND type=? AND (LOWER(COALESCE(name,'')) LIKE ? OR LOWER(COALESCE(caption,'')) LIKE ?)
-                ORDER BY created_at DESC LIMIT 25
-            """, (cat, kw, kw)).fetchall()
+            rows = await db.fetchall(SEARCH_CAT_SQL, (q, cat, SEARCH_LIMIT))
         else:
-            rows = con.execute("""
-                SELECT id, type, name, caption FROM items
-                WHERE status='active' AND (LOWER(COALESCE(name,'')) LIKE ? OR LOWER(COALESCE(caption,'')) LIKE ?)
-                ORDER BY created_at DESC LIMIT 25
-            """, (kw, kw)).fetchall()
+            rows = await db.fetchall(SEARCH_SQL, (q, SEARCH_LIMIT))
+        page_cache.put(key, rows)
     return rows
 
 class SearchWait(StatesGroup):
     global_kw = State()
     cat_kw = State()
 
-@dp.callback_query_handler(lambda c: c.data == "search:open")
+@router.route("search:open", "so")
 async def cb_search_open(call: CallbackQuery, state: FSMContext):
     await SearchWait.global_kw.set()
-    await call.message.edit_text("🔎 أرسل كلمة البحث الآن (بحث عام):")
-    await call.answer()
+    await respond(call, "🔎 أرسل كلمة البحث الآن (بحث عام):")
 
 @dp.message_handler(state=SearchWait.global_kw, content_types=types.ContentType.TEXT)
 async def on_search_global(message: types.Message, state: FSMContext):
     kw = message.text.strip()
-    rows = search_items(kw)
+    rows = await search_items(kw)
     if not rows:
         await message.answer("لا نتائج.")
         await state.finish()
@@ -537,25 +2917,23 @@ async def on_search_global(message: types.Message, state: FSMContext):
     for it in rows:
         it_id, t, name, cap = it
         title = name or (cap[:20] + "…") if cap else f"{t} #{it_id}"
-        kb.insert(InlineKeyboardButton(f"{t} | {title}", callback_data=f"item:view:{it_id}"))
-    kb.add(InlineKeyboardButton("🏠 الرئيسية", callback_data="main:open"))
+        kb.insert(InlineKeyboardButton(f"{t} | {title}", callback_data=cb("item:view", it_id)))
+    kb.add(InlineKeyboardButton("🏠 الرئيسية", callback_data=cb("main:open")))
     await message.answer(f"نتائج البحث عن: {kw}", reply_markup=kb)
     await state.finish()
 
-@dp.callback_query_handler(lambda c: c.data.startswith("search:cat:"))
-async def cb_search_cat(call: CallbackQuery, state: FSMContext):
-    cat = call.data.split(":")[2]
+@router.route("search:cat", "sc", str)
+async def cb_search_cat(call: CallbackQuery, cat: str, state: FSMContext):
     await state.update_data(cat=cat)
     await SearchWait.cat_kw.set()
-    await call.message.edit_text(f"🔎 أرسل كلمة البحث لفئة: {cat}")
-    await call.answer()
+    await respond(call, f"🔎 أرسل كلمة البحث لفئة: {cat}")
 
 @dp.message_handler(state=SearchWait.cat_kw, content_types=types.ContentType.TEXT)
 async def on_search_cat(message: types.Message, state: FSMContext):
     data = await state.get_data()
     cat = data.get("cat")
     kw = message.text.strip()
-    rows = search_items(kw, cat)
+    rows = await search_items(kw, cat)
     if not rows:
         await message.answer("لا نتائج ضمن الفئة.")
         await state.finish()
@@ -564,105 +2942,1226 @@ async def on_search_cat(message: types.Message, state: FSMContext):
     for it in rows:
         it_id, t, name, cap = it
         title = name or (cap[:20] + "…") if cap else f"{t} #{it_id}"
-        kb.insert(InlineKeyboardButton(f"{title}", callback_data=f"item:view:{it_id}"))
-    kb.add(InlineKeyboardButton("🏠 الرئيسية", callback_data="main:open"))
+        kb.insert(InlineKeyboardButton(f"{title}", callback_data=cb("item:view", it_id)))
+    kb.add(InlineKeyboardButton("🏠 الرئيسية", callback_data=cb("main:open")))
     await message.answer(f"نتائج البحث ضمن {cat}: {kw}", reply_markup=kb)
     await state.finish()
 
+# ================== البحث المضمّن (@bot كلمة) ==================
+# نتائج وسائط مخزّنة (file_id) تُرسل مباشرة في أي محادثة، بصفحات عبر next_offset.
+# الترتيب بالأحدث (rowid تنازليًا) لا bm25: FTS5 يمشي قوائم المستندات بهذا الترتيب
+# ويتوقف عند LIMIT بدل ترتيب كل المطابقات. الكلمات المكتملة (يليها فراغ) تُطابق كاملة،
+# والأخيرة قيد الكتابة كبادئة من فهرس البادئات (FTS_PREFIX) فلا تُدمج قوائم المصطلحات
+# قبل القراءة. الصفحات الأخيرة في LRU بمهلة قصيرة ومفتاحها يضم جيل الكتابة (catalog_gen)،
+# وتيليجرام يخزّن الإجابة لكل مستخدم INLINE_CACHE_TIME.
+INLINE_PAGE = 20
+INLINE_MAX_OFFSET = 1000
+INLINE_CACHE_SIZE = int(os.getenv("INLINE_CACHE_SIZE", "5000"))
+INLINE_CACHE_TTL = float(os.getenv("INLINE_CACHE_TTL", "30"))
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "30"))     # ثوانٍ عند تيليجرام
+inline_cache = LRUCache(INLINE_CACHE_SIZE, INLINE_CACHE_TTL)
+
+def inline_fts_query(text: str) -> Optional[str]:
+    tokens = re.findall(r"\w+", normalize_ar(text))
+    if not tokens:
+        return None
+    parts = [f'"{t}"' for t in tokens]
+    # الحرف الواحد كلمة كاملة: لا بادئات بطول 1 في الفهرس فتصير مسحًا لكل المصطلحات
+    if not text[-1:].isspace() and len(tokens[-1]) > 1:
+        parts[-1] += "*"
+    return " ".join(parts)
+
+def inline_result(row) -> types.InlineQueryResult:
+    # kind نوع الإرسال المخزّن عند الرفع: العنصر من فئة image قد يكون صورة أو وثيقة
+    it_id, t, file_id, name, cap, kind = row
+    title = name or (cap[:40] if cap else f"{t} #{it_id}")
+    rid = str(it_id)
+    if kind == "photo":
+        return types.InlineQueryResultCachedPhoto(id=rid, photo_file_id=file_id, title=title, caption=cap)
+    if kind == "video":
+        return types.InlineQueryResultCachedVideo(id=rid, video_file_id=file_id, title=title, caption=cap)
+    if kind == "audio":
+        return types.InlineQueryResultCachedAudio(id=rid, audio_file_id=file_id, caption=cap)
+    return types.InlineQueryResultCachedDocument(id=rid, title=title, document_file_id=file_id, caption=cap)
+
+# items_fts يضم النشطة فقط
+INLINE_MATCH_SQL = hot("inline match", """
+    SELECT id, type, file_id, name, caption, media_kind FROM items WHERE id IN (
+        SELECT rowid FROM items_fts WHERE items_fts MATCH ? ORDER BY rowid DESC LIMIT ? OFFSET ?
+    ) ORDER BY id DESC
+""")
+# النشطة deleted_at فيها NULL دائمًا، فالشرط يطابق idx_items_status_deleted مرتبًا بـ rowid
+INLINE_RECENT_SQL = hot("inline recent", """
+    SELECT id, type, file_id, name, caption, media_kind FROM items WHERE status='active' AND deleted_at IS NULL
+    ORDER BY id DESC LIMIT ? OFFSET ?
+""")
+
+async def inline_search(text: str, offset: int) -> Tuple[list, str]:
+    # يعيد (النتائج، next_offset)؛ next_offset فارغ = لا صفحات أخرى
+    q = inline_fts_query(text)
+    key = (q, offset, catalog_gen.get())
+    page = inline_cache.get(key)
+    if page is not _MISSING:
+        return page
+    if q:
+        rows = await db.fetchall(INLINE_MATCH_SQL, (q, INLINE_PAGE, offset))
+    else:
+        rows = await db.fetchall(INLINE_RECENT_SQL, (INLINE_PAGE, offset))
+    more = len(rows) == INLINE_PAGE and offset + INLINE_PAGE < INLINE_MAX_OFFSET
+    page = ([inline_result(r) for r in rows], str(offset + INLINE_PAGE) if more else "")
+    inline_cache.put(key, page)
+    return page
+
+@dp.inline_handler()
+async def on_inline_query(query: types.InlineQuery):
+    if not await user_is_registered(query.from_user.id):
+        return await query.answer([], cache_time=INLINE_CACHE_TIME, is_personal=True,
+                                  switch_pm_text="سجّل أولاً للبحث في المكتبة", switch_pm_parameter="start")
+    offset = int(query.offset) if query.offset.isdigit() else 0
+    results, next_offset = await inline_search(query.query, offset)
+    await query.answer(results, cache_time=INLINE_CACHE_TIME, is_personal=True, next_offset=next_offset)
+
 # ================== لوحة الإدارة الأساسية ==================
-@dp.callback_query_handler(lambda c: c.data == "admin:open")
+@router.route("admin:open", "ao")
 async def cb_admin_open(call: CallbackQuery):
-    if not user_is_mod(call.from_user.id):
+    if not await user_is_mod(call.from_user.id):
         return await call.answer("غير مسموح.", show_alert=True)
     kb = InlineKeyboardMarkup()
-    kb.add(InlineKeyboardButton("👥 المستخدمون", callback_data="admin:users:1"))
-    kb.add(InlineKeyboardButton("📊 إحصاءات", callback_data="admin:stats"))
-    kb.add(InlineKeyboardButton("⚙️ إعدادات القناة", callback_data="admin:settings"))
-    kb.add(InlineKeyboardButton("🔙 رجوع", callback_data="main:open"))
-    await call.message.edit_text("🛠️ لوحة الإدارة", reply_markup=kb)
-    await call.answer()
-
-@dp.callback_query_handler(lambda c: c.data.startswith("admin:users:"))
-async def cb_admin_users(call: CallbackQuery):
-    if not user_is_mod(call.from_user.id):
+    kb.add(InlineKeyboardButton("👥 المستخدمون", callback_data=cb("admin:users", 1)))
+    kb.add(InlineKeyboardButton("📊 إحصاءات", callback_data=cb("admin:stats")))
+    kb.add(InlineKeyboardButton("⚙️ إعدادات القناة", callback_data=cb("admin:settings")))
+    kb.add(InlineKeyboardButton("📮 طابور القناة", callback_data=cb("admin:outbox")))
+    kb.add(InlineKeyboardButton("⏱️ الأداء", callback_data=cb("admin:metrics")))
+    if user_is_owner(call.from_user.id):
+        kb.add(InlineKeyboardButton("📣 بث", callback_data=cb("admin:broadcast")))
+    kb.add(InlineKeyboardButton("🔙 رجوع", callback_data=cb("main:open")))
+    await respond(call, "🛠️ لوحة الإدارة", reply_markup=kb)
+
+USERS_PAGE = hot_keyset("users page", ("user_id, full_name, is_registered, is_mod", "users", "1",
+                                       "created_at", "user_id"))
+
+@router.route("admin:users", "au", int, rest=True)
+async def cb_admin_users(call: CallbackQuery, page: int, cur: list, note: Optional[str] = None):
+    if not await user_is_mod(call.from_user.id):
         return await call.answer("غير مسموح.", show_alert=True)
-    page = int(call.data.split(":")[2])
-    offset = (page - 1) * PAGE_SIZE
-    with closing(db_connect()) as con:
-        rows = con.execute("""
-            SELECT user_id, full_name, is_registered, is_mod FROM users
-            ORDER BY created_at DESC LIMIT ? OFFSET ?
-        """, (PAGE_SIZE + 1, offset)).fetchall()
-    has_next = len(rows) > PAGE_SIZE
-    rows = rows[:PAGE_SIZE]
+    rows, prev_cur, next_cur = await keyset_page(USERS_PAGE, (), decode_cursor(cur))
     kb = InlineKeyboardMarkup(row_width=1)
     if not rows:
-        kb.add(InlineKeyboardButton("🔙 رجوع", callback_data="admin:open"))
-        return await call.message.edit_text("لا مستخدمين.", reply_markup=kb)
+        kb.add(InlineKeyboardButton("🔙 رجوع", callback_data=cb("admin:open")))
+        return await respond(call, "لا مستخدمين.", reply_markup=kb, note=note)
     text = "👥 المستخدمون:\n"
     for u in rows:
         uid, fn, reg, mod = u
         text += f"- {fn} ({uid}) | {'مسجل' if reg else 'غير مسجل'} | {'مشرف' if mod else 'عضو'}\n"
         if user_is_owner(call.from_user.id) and uid != OWNER_ID:
-            toggle = "admin:toggle_mod:{}".format(uid)
-            kb.add(InlineKeyboardButton(f"{'إلغاء' if mod else 'تعيين'} مشرف: {uid}", callback_data=toggle))
+            kb.add(InlineKeyboardButton(f"{'إلغاء' if mod else 'تعيين'} مشرف: {uid}", callback_data=cb("admin:toggle_mod", uid)))
     nav = []
-    if page > 1:
-        nav.append(InlineKeyboardButton("◀️", callback_data=f"admin:users:{page-1}"))
-    if has_next:
-        nav.append(InlineKeyboardButton("▶️", callback_data=f"admin:users:{page+1}"))
+    if prev_cur:
+        nav.append(InlineKeyboardButton("◀️", callback_data=cb("admin:users", page - 1, prev_cur)))
+    if next_cur:
+        nav.append(InlineKeyboardButton("▶️", callback_data=cb("admin:users", page + 1, next_cur)))
     if nav:
         kb.row(*nav)
-    kb.add(InlineKeyboardButton("🔙 رجوع", callback_data="admin:open"))
-    await call.message.edit_text(text, reply_markup=kb)
-    await call.answer()
+    kb.add(InlineKeyboardButton("🔙 رجوع", callback_data=cb("admin:open")))
+    await respond(call, text, reply_markup=kb, note=note)
 
-@dp.callback_query_handler(lambda c: c.data.startswith("admin:toggle_mod:"))
-async def cb_admin_toggle_mod(call: CallbackQuery):
+@router.route("admin:toggle_mod", "am", int)
+async def cb_admin_toggle_mod(call: CallbackQuery, uid: int):
     if not user_is_owner(call.from_user.id):
         return await call.answer("فقط المالك.", show_alert=True)
-    uid = int(call.data.split(":")[2])
     if uid == OWNER_ID:
         return await call.answer("هذا هو المالك.", show_alert=True)
-    with closing(db_connect()) as con:
+    def toggle(con):
         row = con.execute("SELECT is_mod FROM users WHERE user_id=?", (uid,)).fetchone()
         if not row:
-            return await call.answer("المستخدم غير موجود.", show_alert=True)
+            return None
         new_val = 0 if row[0] else 1
-        with con:
-            con.execute("UPDATE users SET is_mod=? WHERE user_id=?", (new_val, uid))
-    await call.answer("تم التبديل.")
-    await cb_admin_users(call)
-
-@dp.callback_query_handler(lambda c: c.data == "admin:stats")
-async def cb_admin_stats(call: CallbackQuery):
-    if not user_is_mod(call.from_user.id):
+        con.execute("UPDATE users SET is_mod=? WHERE user_id=?", (new_val, uid))
+        return new_val
+    new_val = await db.write(toggle)
+    user_cache.invalidate(uid)
+    notify_workers("user", uid)
+    if new_val is None:
+        return await call.answer("المستخدم غير موجود.", show_alert=True)
+    await cb_admin_users(call, 1, [], note="تم التبديل.")
+
+@router.route("admin:stats", "as")
+async def cb_admin_stats(call: CallbackQuery, note: Optional[str] = None):
+    if not await user_is_mod(call.from_user.id):
         return await call.answer("غير مسموح.", show_alert=True)
-    with closing(db_connect()) as con:
-        total = con.execute("SELECT COUNT(*) FROM items").fetchone()[0]
-        active = con.execute("SELECT COUNT(*) FROM items WHERE status='active'").fetchone()[0]
-        trashed = con.execute("SELECT COUNT(*) FROM items WHERE status='trashed'").fetchone()[0]
-    await call.message.edit_text(f"📊 الإحصاءات\n\nإجمالي العناصر: {total}\nالنشطة: {active}\nفي السلة: {trashed}",
-                                 reply_markup=InlineKeyboardMarkup().add(InlineKeyboardButton("🔙 رجوع", callback_data="admin:open")))
-    await call.answer()
-
-@dp.callback_query_handler(lambda c: c.data == "admin:settings")
+    rows = await db.fetchall("SELECT type, status, n FROM item_counts WHERE n != 0")
+    per_type = {}
+    for t, st, n in rows:
+        per_type.setdefault(t, {})[st] = n
+    active = sum(c.get("active", 0) for c in per_type.values())
+    trashed = sum(c.get("trashed", 0) for c in per_type.values())
+    archived = (await db.fetchone("SELECT COALESCE(SUM(n), 0) FROM archive.counts WHERE name='items'"))[0]
+    trashed += archived
+    total = sum(n for _, _, n in rows) + archived
+    # المؤرشف يُضاف إلى سلة قسمه ليطابق مجموع السطور الإجمالي
+    for name, n in await db.fetchall("SELECT name, n FROM archive.counts WHERE name LIKE 'type:%' AND n != 0"):
+        c = per_type.setdefault(name[5:], {})
+        c["trashed"] = c.get("trashed", 0) + n
+    lines = [f"• {t or '؟'}: {c.get('active', 0)} نشط / {c.get('trashed', 0)} في السلة"
+             for t, c in sorted(per_type.items(), key=lambda kv: CAT_TYPES.index(kv[0]) if kv[0] in CAT_TYPES else len(CAT_TYPES))]
+    kb = InlineKeyboardMarkup()
+    if user_is_owner(call.from_user.id):
+        kb.add(InlineKeyboardButton("🔁 مطابقة العدادات", callback_data=cb("admin:stats:reconcile")))
+    kb.add(InlineKeyboardButton("🔙 رجوع", callback_data=cb("admin:open")))
+    await respond(call, f"📊 الإحصاءات\n\nإجمالي العناصر: {total}\nالنشطة: {active}\nفي السلة: {trashed} (منها مؤرشف: {archived})"
+                  + ("\n\n" + "\n".join(lines) if lines else "")
+                  + f"\n\n🧠 ذاكرة المستخدمين: {user_cache.stats()}"
+                  + f"\n🔎 ذاكرة البحث المضمّن: {inline_cache.stats()}"
+                  + f"\n📄 ذاكرة الصفحات: {page_cache.stats()}",
+                  reply_markup=kb, note=note)
+
+@router.route("admin:stats:reconcile", "ax")
+async def cb_admin_stats_reconcile(call: CallbackQuery):
+    if not user_is_owner(call.from_user.id):
+        return await call.answer("للمالك فقط.", show_alert=True)
+    drift = await db.write(counters_reconcile)
+    await cb_admin_stats(call, f"أُصلح {drift} عدّاد." if drift else "العدادات مطابقة.")
+
+@router.route("admin:settings", "ae")
 async def cb_admin_settings(call: CallbackQuery):
-    if not user_is_mod(call.from_user.id):
+    if not await user_is_mod(call.from_user.id):
         return await call.answer("غير مسموح.", show_alert=True)
     txt = f"⚙️ إعدادات القناة\nالقناة الحالية: {CHANNEL_ID}\nتأكد أن البوت مشرف."
-    await call.message.edit_text(txt, reply_markup=InlineKeyboardMarkup().add(InlineKeyboardButton("🔙 رجوع", callback_data="admin:open")))
-    await call.answer()
+    await respond(call, txt, reply_markup=InlineKeyboardMarkup().add(InlineKeyboardButton("🔙 رجوع", callback_data=cb("admin:open"))))
+
+@router.route("admin:outbox:retry", "ar")
+async def cb_admin_outbox_retry(call: CallbackQuery):
+    await cb_admin_outbox(call, retry=True)
+
+@router.route("admin:outbox", "ab")
+async def cb_admin_outbox(call: CallbackQuery, retry: bool = False):
+    if not await user_is_mod(call.from_user.id):
+        return await call.answer("غير مسموح.", show_alert=True)
+    if retry:
+        await db.execute("UPDATE outbox SET attempts=0, next_at=? WHERE next_at IS NULL", (time.time(),))
+        outbox.wake()
+    depth, due, dead, oldest = await outbox.stats()
+    txt = (f"📮 طابور النسخ للقناة\n\nفي الانتظار: {depth} (مستحق الآن: {due})\n"
+           f"متوقف بعد {OUTBOX_MAX_ATTEMPTS} محاولات: {dead}\n"
+           f"عمر أقدم عنصر: {f'{oldest:.0f} ث' if oldest is not None else '-'}\n"
+           f"تم التسليم: {outbox.delivered} | حُذف من القناة: {outbox.deleted} | إخفاقات: {outbox.failures}\n"
+           f"زمن آخر تسليم: {outbox.last_lag:.1f} ث")
+    kb = InlineKeyboardMarkup()
+    if dead:
+        kb.add(InlineKeyboardButton("🔁 إعادة المتوقف", callback_data=cb("admin:outbox:retry")))
+    kb.add(InlineKeyboardButton("🔄 تحديث", callback_data=cb("admin:outbox")))
+    kb.add(InlineKeyboardButton("🔙 رجوع", callback_data=cb("admin:open")))
+    await respond(call, txt, reply_markup=kb)
+
+def fmt_ms(seconds: float) -> str:
+    return f"{seconds * 1000:.0f}ms" if seconds >= 0.01 else f"{seconds * 1000:.1f}ms"
+
+@router.route("admin:metrics", "ap")
+async def cb_admin_metrics(call: CallbackQuery):
+    if not await user_is_mod(call.from_user.id):
+        return await call.answer("غير مسموح.", show_alert=True)
+    lines = ["⏱️ الأداء منذ التشغيل", "", "المعالجات (الأبطأ p95):"]
+    lines += [f"• {label} — {n}× p50 {fmt_ms(p50)} p95 {fmt_ms(p95)}"
+              for label, n, p50, p95, _ in metrics.top("bot_handler_seconds", 8)]
+    lines += ["", "SQL (الأعلى وقتًا إجماليًا):"]
+    lines += [f"• {label} — {n}× Σ {fmt_ms(total)} p95 {fmt_ms(p95)}"
+              for label, n, _, p95, total in metrics.top("bot_sql_seconds", 6, by="sum")]
+    lines += ["", "Bot API:"]
+    lines += [f"• {label} — {n}× p95 {fmt_ms(p95)}"
+              + (f" ⚠️ {metrics.counters[('bot_api_errors_total', label)]} أخطاء"
+                 if ("bot_api_errors_total", label) in metrics.counters else "")
+              for label, n, _, p95, _ in metrics.top("bot_api_seconds", 6, by="sum")]
+    calls, trips = metrics.counter("bot_api_calls_total"), metrics.counter("bot_api_round_trips_total")
+    handled = sum(n for label, n, *_ in metrics.top("bot_handler_seconds", 10 ** 6) if label in trips)
+    if handled:
+        lines += [f"رحلات Bot API لكل تحديث: {sum(trips.values()) / handled:.2f} (طلبات {sum(calls.values()) / handled:.2f})"]
+    waits = metrics.top("bot_db_wait_seconds", 2)
+    if waits:
+        lines += ["", "انتظار القاعدة: " + "، ".join(f"{label} p95 {fmt_ms(p95)}" for label, _, _, p95, _ in waits)]
+    kb = InlineKeyboardMarkup()
+    kb.add(InlineKeyboardButton("🔄 تحديث", callback_data=cb("admin:metrics")))
+    kb.add(InlineKeyboardButton("🔙 رجوع", callback_data=cb("admin:open")))
+    await respond(call, "\n".join(lines), reply_markup=kb)
+
+# ================== البث الجماعي ==================
+# المالك يرسل رسالة فتُنسخ (copy_message) لكل مستخدم مسجل. المستلمون يُقرؤون من users
+# بمؤشر على user_id دفعةً دفعة فلا تُحمَّل القائمة كلها، والإرسال بتزامن محدود ودلو
+# BROADCAST_RATE رسالة/ثانية (تحت حد تيليجرام ~30/ث ليبقى هامش لردود البوت). RetryAfter
+# يوقف الدلو كله ويُعاد للمستلم نفسه، ومن حظر البوت أو حذف حسابه يُعدّ ولا يُعاد.
+# التقدم يُحفظ في broadcasts كل BROADCAST_CHECKPOINT ثانية؛ last_user أعلى معرّف اكتمل
+# كل ما قبله (المستلمون يُرسلون بترتيب المعرّف)، فبعد إعادة التشغيل يستأنف العامل 0 البث
+# الجاري من بعده، وأقصى ما يتكرر رسائل كانت قيد الإرسال (BROADCAST_CONCURRENCY).
+# صف broadcasts هو مرجع بقية العمال: أزرار المالك قد تصل عاملًا غير الذي يبث، فالإلغاء
+# يكتب status='cancelled' ورسالة التقدم تُكتب في الصف، ويلتقطهما الباث عند نقطة الحفظ.
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+BROADCAST_BATCH = 500
+BROADCAST_CHECKPOINT = 5.0
+BROADCAST_PROGRESS_EVERY = 3.0
+BROADCAST_MAX_RETRIES = 5
+BROADCAST_GONE = (BotBlocked, BotKicked, UserDeactivated, ChatNotFound, CantInitiateConversation)
+
+BROADCAST_RECIPIENTS_SQL = hot("broadcast recipients",
+                               "SELECT user_id FROM users WHERE user_id > ? AND is_registered=1 ORDER BY user_id LIMIT ?")
+BROADCAST_COLUMNS = "id, from_chat, message_id, last_user, total, sent, blocked, failed, progress_chat, progress_msg"
+
+class BroadcastWait(StatesGroup):
+    message = State()
+
+class Broadcast:
+    def __init__(self, row: tuple):
+        (self.id, self.from_chat, self.message_id, self.last_user, self.total, self.sent, self.blocked,
+         self.failed, self.progress_chat, self.progress_msg) = row
+        self.bucket = TokenBucket(BROADCAST_RATE, BROADCAST_RATE)
+        self.inflight: set = set()
+        self.dispatched = self.last_user
+        self.cancelled = False
+        self.task: Optional[asyncio.Task] = None
+        self._sends: set = set()
+        self._started = time.monotonic()
+        self._processed_at_start = self.processed
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.blocked + self.failed
+
+    def start(self):
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        # إيقاف مع حفظ نقطة الاستئناف (عند إطفاء البوت)
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    async def cancel(self):
+        self.cancelled = True
+        await self.stop()
+
+    def checkpoint(self) -> int:
+        return min(self.inflight) - 1 if self.inflight else self.dispatched
+
+    async def save(self, status: str = "running") -> bool:
+        # False: أُلغي البث من عامل آخر فلم يعد الصف running
+        self.last_user = self.checkpoint()
+        row = await db.write(lambda con: con.execute("""
+            UPDATE broadcasts SET status=?, last_user=?, sent=?, blocked=?, failed=?, updated_at=?
+            WHERE id=? AND (status='running' OR ?) RETURNING progress_chat, progress_msg
+        """, (status, self.last_user, self.sent, self.blocked, self.failed, now_str(), self.id,
+              status != "running")).fetchone())
+        if row is None:
+            return False
+        self.progress_chat, self.progress_msg = row
+        return True
+
+    def progress_text(self, status: str = "running") -> str:
+        elapsed = time.monotonic() - self._started
+        rate = (self.processed - self._processed_at_start) / elapsed if elapsed > 0 else 0.0
+        left = max(self.total - self.processed, 0)
+        eta = str(timedelta(seconds=int(left / rate))) if rate > 0 and status == "running" else "-"
+        head = {"running": "📣 جارٍ البث", "done": "✅ انتهى البث", "cancelled": "⛔ أُلغي البث"}[status]
+        return (f"{head} #{self.id}\n\nعولج {self.processed} من {self.total}\n"
+                f"أُرسل: {self.sent} • حظروا البوت/غير متاحين: {self.blocked} • أخفق: {self.failed}\n"
+                f"المعدل: {rate:.1f} رسالة/ث • المتبقي: {eta}")
+
+    @staticmethod
+    def progress_markup(status: str = "running") -> InlineKeyboardMarkup:
+        kb = InlineKeyboardMarkup()
+        if status == "running":
+            kb.add(InlineKeyboardButton("🔄 تحديث", callback_data=cb("admin:broadcast")),
+                   InlineKeyboardButton("⛔ إلغاء", callback_data=cb("admin:broadcast:cancel")))
+        kb.add(InlineKeyboardButton("🔙 رجوع", callback_data=cb("admin:open")))
+        return kb
+
+    async def show(self, status: str = "running"):
+        try:
+            await edit_message_at(self.progress_chat, self.progress_msg, self.progress_text(status),
+                                  self.progress_markup(status))
+        except Exception as e:
+            logging.info("broadcast: تعذّر تحديث رسالة التقدم: %s", e)
+
+    async def run(self):
+        sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        last_save = last_show = time.monotonic()
+        cursor = self.last_user
+        try:
+            while True:
+                rows = await db.fetchall(BROADCAST_RECIPIENTS_SQL, (cursor, BROADCAST_BATCH))
+                if not rows:
+                    break
+                for (uid,) in rows:
+                    await sem.acquire()
+                    await self.bucket.take()
+                    self.inflight.add(uid)
+                    self.dispatched = uid
+                    task = asyncio.ensure_future(self._send(uid, sem))
+                    self._sends.add(task)
+                    task.add_done_callback(self._sends.discard)
+                    now = time.monotonic()
+                    if now - last_save >= BROADCAST_CHECKPOINT:
+                        last_save = now
+                        if not await self.save():
+                            self.cancelled = True
+                            raise asyncio.CancelledError
+                    if now - last_show >= BROADCAST_PROGRESS_EVERY:
+                        last_show = now
+                        await self.show()
+                cursor = rows[-1][0]
+            await asyncio.gather(*self._sends)
+        except asyncio.CancelledError:
+            for task in list(self._sends):
+                task.cancel()
+            await asyncio.gather(*self._sends, return_exceptions=True)
+            status = "cancelled" if self.cancelled else "running"
+            await self.save(status)
+            if self.cancelled:
+                await self.show(status)
+            raise
+        await self.save("done")
+        await self.show("done")
+        logging.info("broadcast #%s: انتهى، أُرسل %d، محظور %d، أخفق %d", self.id, self.sent, self.blocked, self.failed)
+
+    async def _send(self, uid: int, sem: asyncio.Semaphore):
+        try:
+            await self._deliver(uid)
+        finally:
+            sem.release()
+        # الإرسال الملغى (إطفاء البوت) يبقى في inflight فلا تتجاوزه نقطة الاستئناف
+        self.inflight.discard(uid)
+
+    async def _deliver(self, uid: int):
+        for _ in range(BROADCAST_MAX_RETRIES):
+            try:
+                await bot.copy_message(uid, self.from_chat, self.message_id)
+                self.sent += 1
+                return
+            except RetryAfter as e:
+                self.bucket.pause(e.timeout)
+                await self.bucket.take()
+            except BROADCAST_GONE:
+                self.blocked += 1
+                return
+            except Exception as e:
+                logging.warning("broadcast #%s: فشل الإرسال إلى %s: %s", self.id, uid, e)
+                break
+        self.failed += 1
+
+async def broadcast_resume():
+    row = await db.fetchone(f"SELECT {BROADCAST_COLUMNS} FROM broadcasts WHERE status='running' ORDER BY id DESC LIMIT 1")
+    if row is not None:
+        logging.info("broadcast #%s: استئناف بعد المستخدم %s", row[0], row[3])
+        dp["broadcast"] = Broadcast(row)
+        dp["broadcast"].start()
+
+@router.route("admin:broadcast", "bo")
+async def cb_admin_broadcast(call: CallbackQuery, state: FSMContext):
+    if not user_is_owner(call.from_user.id):
+        return await call.answer("للمالك فقط.", show_alert=True)
+    chat_id, msg_id = call.message.chat.id, call.message.message_id
+    row = await db.write(lambda con: con.execute(
+        f"UPDATE broadcasts SET progress_chat=?, progress_msg=? WHERE status='running' RETURNING {BROADCAST_COLUMNS}",
+        (chat_id, msg_id)).fetchone())
+    if row is not None:
+        # البث قد يجري في عامل آخر: يُعرض آخر ما حُفظ منه، وباثه يتبنى هذه الرسالة عند نقطة الحفظ
+        current = dp.get("broadcast")
+        if current is None or current.id != row[0] or current.task is None or current.task.done():
+            current = Broadcast(row)
+        current.progress_chat, current.progress_msg = chat_id, msg_id
+        return await respond(call, current.progress_text(), reply_markup=current.progress_markup())
+    await BroadcastWait.message.set()
+    kb = InlineKeyboardMarkup().add(InlineKeyboardButton("🔙 رجوع", callback_data=cb("admin:open")))
+    await respond(call, "📣 أرسل الآن الرسالة المراد بثها لكل المستخدمين المسجلين (نص أو وسائط).", reply_markup=kb)
+
+@dp.callback_query_handler(state=BroadcastWait.message)
+async def on_callback_broadcast_draft(call: CallbackQuery, state: FSMContext):
+    # الأزرار لا تصل on_callback أثناء حالة؛ أي زر هنا (ومنه "رجوع") يترك المسودة ثم يُنفَّذ،
+    # فلا تُؤخذ رسالة المالك التالية (رفع مثلًا) مسودةً للبث
+    await state.finish()
+    await on_callback(call, state)
+
+@dp.message_handler(state=BroadcastWait.message, content_types=types.ContentType.ANY)
+async def on_broadcast_message(message: types.Message, state: FSMContext):
+    await state.finish()
+    if not user_is_owner(message.from_user.id):
+        return
+    total = (await db.fetchone("SELECT COUNT(*) FROM users WHERE is_registered=1"))[0]
+    kb = InlineKeyboardMarkup().add(
+        InlineKeyboardButton(f"✅ إرسال إلى {total} مستخدم", callback_data=cb("admin:broadcast:send", message.message_id)),
+    ).add(InlineKeyboardButton("إلغاء", callback_data=cb("admin:open")))
+    await message.reply("سيُنسخ هذا إلى كل المستخدمين المسجلين. تأكيد؟", reply_markup=kb)
+
+@router.route("admin:broadcast:send", "bs", int)
+async def cb_admin_broadcast_send(call: CallbackQuery, message_id: int):
+    if not user_is_owner(call.from_user.id):
+        return await call.answer("للمالك فقط.", show_alert=True)
+    def create(con):
+        if con.execute("SELECT 1 FROM broadcasts WHERE status='running'").fetchone():
+            return None
+        total = con.execute("SELECT COUNT(*) FROM users WHERE is_registered=1").fetchone()[0]
+        now = now_str()
+        cur = con.execute("""
+            INSERT INTO broadcasts(from_chat, message_id, status, total, progress_chat, progress_msg, created_at, updated_at)
+            VALUES(?,?,'running',?,?,?,?,?)
+        """, (call.message.chat.id, message_id, total, call.message.chat.id, call.message.message_id, now, now))
+        return con.execute(f"SELECT {BROADCAST_COLUMNS} FROM broadcasts WHERE id=?", (cur.lastrowid,)).fetchone()
+    row = await db.write(create)
+    if row is None:
+        return await call.answer("يوجد بث جارٍ بالفعل.", show_alert=True)
+    dp["broadcast"] = Broadcast(row)
+    await asyncio.gather(call.answer("بدأ البث"), dp["broadcast"].show())
+    dp["broadcast"].start()
+
+@router.route("admin:broadcast:cancel", "bc")
+async def cb_admin_broadcast_cancel(call: CallbackQuery):
+    if not user_is_owner(call.from_user.id):
+        return await call.answer("للمالك فقط.", show_alert=True)
+    current = dp.get("broadcast")
+    if current is not None and current.task is not None and not current.task.done():
+        return await asyncio.gather(call.answer("جارٍ الإلغاء…"), current.cancel())
+    # البث في عامل آخر: يتوقف عند نقطة حفظه التالية
+    n = (await db.execute("UPDATE broadcasts SET status='cancelled', updated_at=? WHERE status='running'",
+                          (now_str(),))).rowcount
+    if not n:
+        return await call.answer("لا يوجد بث جارٍ.", show_alert=True)
+    await call.answer(f"سيتوقف البث خلال {BROADCAST_CHECKPOINT:.0f} ث.", show_alert=True)
 
 # ================== أمان بسيط: رفض الأوامر إن لم يُسجل ==================
 @dp.message_handler(commands=['admin'])
 async def cmd_admin_legacy(message: types.Message):
-    if not user_is_mod(message.from_user.id):
+    if not await user_is_mod(message.from_user.id):
         return await message.answer("🚫 هذا الأمر للمشرفين.")
     await message.answer("افتح لوحة الإدارة من الأزرار: 🛠️ إدارة الأزرار")
 
+@dp.message_handler(commands=['dedup'])
+async def cmd_dedup(message: types.Message):
+    # /dedup [all]: دمج التكرارات القديمة بالخلفية مع رسالة تقدّم واحدة؛ يستأنف من آخر
+    # نقطة حُفظت، وall يعيد الفحص من البداية
+    if not user_is_owner(message.from_user.id):
+        return await message.answer("🚫 هذا الأمر للمالك فقط.")
+    task = dp.get("dedup_task")
+    if task is not None and not task.done():
+        return await message.answer("⏳ الدمج قيد التشغيل بالفعل.")
+    status = await message.answer("🔁 بدأ فحص التكرارات…")
+    async def progress(st):
+        try:
+            await status.edit_text(f"🔁 فُحص {st['checked']} • دُمج {st['merged']} • تُخطي {st['skipped']}")
+        except Exception:
+            pass
+    async def run():
+        try:
+            st = await dedup_backfill(progress, restart="all" in message.get_args().split())
+        except Exception:
+            logging.exception("dedup: فشل الدمج")
+            return await message.answer("⚠️ توقف الدمج بسبب خطأ، أعد تشغيله للاستئناف.")
+        await message.answer(f"✅ انتهى الدمج: فُحص {st['checked']}، دُمج {st['merged']}، تُخطي {st['skipped']}.")
+    dp["dedup_task"] = asyncio.ensure_future(run())
+
+# ================== التصدير والاستيراد ==================
+# نسخ users وitems إلى ملف JSONL أو CSV (مضغوط gzip إن انتهى الاسم بـ .gz) وبالعكس،
+# بذاكرة ثابتة: القراءة بمؤشر يجلب دفعات، والكتابة دفعات executemany كل منها معاملة.
+# JSONL: سطر رأس {"table", "columns"} لكل جدول ثم صف مصفوفة في كل سطر، وCSV جدول
+# واحد لكل ملف (الاسم يبدأ باسم الجدول). الاستيراد INSERT OR IGNORE فلا يغيّر الموجود،
+# ويُستأنف من آخر دفعة ملتزمة. عند التحميل في جدول فارغ تُحذف فهارسه الثانوية وجدول
+# البحث ومشغّلاته ثم يعيد ensure_objects بناءها مرة واحدة في النهاية (وجدول البحث يُملأ
+# من items كله، فيشمل ما رُفع أثناء الاستيراد). البوت يعمل أثناء الاستيراد، فما تعتمد
+# عليه صحته يبقى: فهرسا مفتاح المحتوى (منع التكرار و/dedup)، ومشغّلات الأجيال (تبطل
+# الصفحات المخزّنة) والعدادات (الحصص والإحصاءات).
+DUMP_COLUMNS = {
+    "users": ("user_id", "full_name", "is_registered", "is_mod", "created_at"),
+    "items": ("id", "type", "file_id", "thumb_id", "name", "caption", "uploader_id", "status",
+              "channel_msg_id", "created_at", "deleted_at", "file_unique_id", "file_size", "media_kind"),
+}
+DEFERRED_OBJECTS = {   # من SCHEMA_OBJECTS، بترتيب الحذف
+    "users": ["idx_users_page"],
+    "items": ["idx_items_type_status_created", "idx_items_created", "idx_items_status_deleted",
+              "idx_items_uploader", "items_fts_ai", "items_fts_au", "items_fts_ad", "items_fts"],
+}
+DUMP_BATCH = int(os.getenv("DUMP_BATCH", "5000"))              # صفوف كل دفعة قراءة/معاملة استيراد
+DUMP_PROGRESS_EVERY = 50_000
+EXPORT_DIR = os.getenv("EXPORT_DIR") or os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), "exports")
+EXPORT_SEND_MAX = 50 * 1024 ** 2                                # حد إرسال المستندات في Bot API
+
+def dump_format(path: str) -> str:
+    return "csv" if path.removesuffix(".gz").endswith(".csv") else "jsonl"
+
+def dump_open(path: str, mode: str):
+    opener = gzip.open if path.endswith(".gz") else open
+    return opener(path, mode + "t", encoding="utf-8", newline="")
+
+# جداول لها طبقة باردة تُصدَّر معها (في اللقطة نفسها)، والاستيراد يعيدها إلى items كسلة عادية
+DUMP_ARCHIVE = {"items": "archive.items a WHERE NOT EXISTS (SELECT 1 FROM main.items m WHERE m.id = a.id)"}
+
+def iter_table(con: sqlite3.Connection, table: str, batch: int = DUMP_BATCH):
+    cols = ", ".join(DUMP_COLUMNS[table])
+    sources = [f"SELECT {cols} FROM main.{table} ORDER BY rowid"]
+    if table in DUMP_ARCHIVE:
+        sources.append(f"SELECT {cols} FROM {DUMP_ARCHIVE[table]} ORDER BY id")
+    for sql in sources:
+        cur = con.execute(sql)
+        while True:
+            rows = cur.fetchmany(batch)
+            if not rows:
+                break
+            yield from rows
+
+def export_catalog(path: str, tables=("users", "items"), progress: Optional[Callable] = None) -> dict:
+    # يعمل في خيط/عملية مستقلة باتصال خاص؛ كل الجداول من لقطة قراءة واحدة
+    fmt = dump_format(path)
+    if fmt == "csv" and len(tables) != 1:
+        raise ValueError("CSV يحمل جدولًا واحدًا لكل ملف")
+    t0, rows = time.perf_counter(), 0
+    with closing(db_connect()) as con, dump_open(path, "w") as f:
+        con.execute("BEGIN")
+        for table in tables:
+            if fmt == "csv":
+                writer = csv.writer(f)
+                writer.writerow(DUMP_COLUMNS[table])
+                write = writer.writerow
+            else:
+                f.write(json.dumps({"table": table, "columns": DUMP_COLUMNS[table]}) + "\n")
+                write = lambda row: f.write(json.dumps(row, ensure_ascii=False) + "\n")
+            for row in iter_table(con, table):
+                write(row)
+                rows += 1
+                if progress is not None and rows % DUMP_PROGRESS_EVERY == 0:
+                    progress({"rows": rows, "rate": rows / (time.perf_counter() - t0)})
+    elapsed = time.perf_counter() - t0
+    return {"rows": rows, "seconds": elapsed, "rate": rows / elapsed if elapsed else 0.0,
+            "bytes": os.path.getsize(path)}
+
+def _dump_records(path: str, table: Optional[str]):
+    # يولّد (رقم السطر، الجدول، الأعمدة، الصف)؛ الصف None لسطر الرأس
+    with dump_open(path, "r") as f:
+        if dump_format(path) == "csv":
+            table = table or os.path.basename(path).split(".")[0].split("-")[0]
+            reader = csv.reader(f)
+            columns = tuple(next(reader))
+            yield 0, table, columns, None
+            for line, row in enumerate(reader, start=1):
+                yield line, table, columns, [v if v != "" else None for v in row]
+            return
+        columns = ()
+        for line, text in enumerate(f, start=1):
+            rec = json.loads(text)
+            if isinstance(rec, dict):
+                table, columns = rec["table"], tuple(rec["columns"])
+                yield line, table, columns, None
+            else:
+                yield line, table, columns, rec
+
+def _defer_indexes(con: sqlite3.Connection, table: str):
+    for name in DEFERRED_OBJECTS.get(table, []):
+        con.execute(f"DROP {SCHEMA_OBJECTS[name][0]} IF EXISTS {name}")
+
+def import_catalog(path: str, table: Optional[str] = None, progress: Optional[Callable] = None,
+                   restart: bool = False) -> dict:
+    source = f"{os.path.basename(path)}:{os.path.getsize(path)}"
+    t0 = time.perf_counter()
+    stats = {"rows": 0, "inserted": 0, "resumed_from": 0, "done_before": False}
+    with closing(db_connect()) as con:
+        con.isolation_level = None
+        job = con.execute("SELECT line, deferred, done FROM import_jobs WHERE source=?", (source,)).fetchone()
+        if job and not restart:
+            if job[2]:
+                stats["done_before"] = True
+                return stats
+            stats["resumed_from"] = job[0]
+        deferred = set(json.loads(job[1] or "[]")) if job and not restart else set()
+        if deferred:
+            # ensure_objects عند إعادة التشغيل أعاد ما حُذف؛ يُحذف مجددًا حتى نهاية الاستيراد
+            con.execute("BEGIN IMMEDIATE")
+            for tbl in deferred:
+                _defer_indexes(con, tbl)
+            con.execute("COMMIT")
+        con.execute("""
+            INSERT INTO import_jobs(source, line, deferred, done, started_at, updated_at) VALUES (?, ?, ?, 0, ?, ?)
+            ON CONFLICT(source) DO UPDATE SET line=excluded.line, deferred=excluded.deferred, done=0,
+                updated_at=excluded.updated_at
+        """, (source, stats["resumed_from"], json.dumps(sorted(deferred)), now_str(), now_str()))
+
+        pending, sql, last_line = [], None, stats["resumed_from"]
+        def flush():
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                if pending:
+                    stats["inserted"] += con.executemany(sql, pending).rowcount
+                con.execute("UPDATE import_jobs SET line=?, deferred=?, updated_at=? WHERE source=?",
+                            (last_line, json.dumps(sorted(deferred)), now_str(), source))
+            except BaseException:
+                con.execute("ROLLBACK")
+                raise
+            con.execute("COMMIT")
+            stats["rows"] += len(pending)
+            pending.clear()
+            if progress is not None:
+                progress(dict(stats, rate=stats["rows"] / (time.perf_counter() - t0)))
+
+        for line, tbl, columns, row in _dump_records(path, table):
+            if row is None:
+                if pending:
+                    flush()
+                if tbl not in DUMP_COLUMNS or not set(columns) <= set(DUMP_COLUMNS[tbl]):
+                    raise ValueError(f"جدول أو أعمدة غير معروفة: {tbl} {columns}")
+                sql = f"INSERT OR IGNORE INTO {tbl}({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+                if tbl not in deferred and not con.execute(f"SELECT 1 FROM {tbl} LIMIT 1").fetchone():
+                    con.execute("BEGIN IMMEDIATE")
+                    _defer_indexes(con, tbl)
+                    deferred.add(tbl)
+                    con.execute("COMMIT")
+                continue
+            if line <= stats["resumed_from"]:
+                continue
+            pending.append(row)
+            last_line = line
+            if len(pending) >= DUMP_BATCH:
+                flush()
+        flush()
+        if table in (None, "items"):
+            # تصدير أقدم من الترحيل 6 بلا media_kind
+            con.execute("BEGIN IMMEDIATE")
+            media_kind_backfill(con)
+            con.execute("COMMIT")
+        if deferred:
+            # إعادة بناء ما أُجّل دفعة واحدة: الفهارس والمشغّلات وجدول البحث، ثم العدادات
+            ensure_objects(con)
+            con.execute("BEGIN IMMEDIATE")
+            counters_reconcile(con)
+            con.execute("COMMIT")
+        con.execute("UPDATE import_jobs SET done=1, updated_at=? WHERE source=?", (now_str(), source))
+    elapsed = time.perf_counter() - t0
+    stats.update(seconds=elapsed, rate=stats["rows"] / elapsed if elapsed else 0.0, deferred=sorted(deferred))
+    return stats
+
+async def _run_in_thread(fn: Callable, *args):
+    return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+def _thread_progress(status: types.Message, fmt: Callable, every: float = 3.0) -> Callable:
+    # يُستدعى من خيط التصدير/الاستيراد: التعديل يُجدول على حلقة الأحداث (بسياق المعالج
+    # ليبقى Bot.get_current متاحًا)، ومرة كل every ثانية على الأكثر
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    last = [0.0]
+    async def edit(st):
+        try:
+            await status.edit_text(fmt(st))
+        except Exception:
+            pass
+    def progress(st):
+        now = time.monotonic()
+        if now - last[0] >= every:
+            last[0] = now
+            loop.call_soon_threadsafe(lambda: asyncio.ensure_future(edit(st)), context=ctx)
+    return progress
+
+@dp.message_handler(commands=['export'])
+async def cmd_export(message: types.Message):
+    # /export [users|items] [csv]
+    if not user_is_owner(message.from_user.id):
+        return await message.answer("🚫 هذا الأمر للمالك فقط.")
+    words = message.get_args().split()
+    tables = tuple(t for t in DUMP_COLUMNS if t in words) or ("users", "items")
+    fmt = "csv" if "csv" in words else "jsonl"
+    if fmt == "csv" and len(tables) != 1:
+        return await message.answer("CSV لجدول واحد: /export items csv")
+    task = dp.get("dump_task")
+    if task is not None and not task.done():
+        return await message.answer("⏳ تصدير أو استيراد قيد التشغيل بالفعل.")
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(EXPORT_DIR, f"{tables[0] if fmt == 'csv' else 'catalog'}-{stamp}.{fmt}.gz")
+    status = await message.answer("📦 بدأ التصدير…")
+    progress = _thread_progress(status, lambda st: f"📦 صُدّر {st['rows']} صف • {st['rate']:.0f} صف/ث")
+    async def run():
+        try:
+            st = await _run_in_thread(export_catalog, path, tables, progress)
+        except Exception:
+            logging.exception("export: فشل التصدير")
+            return await message.answer("⚠️ فشل التصدير.")
+        caption = f"📦 {st['rows']} صف في {st['seconds']:.1f}ث ({st['rate']:.0f} صف/ث)"
+        if st["bytes"] > EXPORT_SEND_MAX:
+            return await message.answer(f"{caption}\nالملف أكبر من حد الإرسال، محفوظ على الخادم:\n<code>{path}</code>")
+        await message.answer_document(types.InputFile(path), caption=caption)
+    dp["dump_task"] = asyncio.ensure_future(run())
+
+@dp.message_handler(commands=['import'])
+async def cmd_import(message: types.Message):
+    # ردًا على مستند صدّره /export (أو CSV اسمه يبدأ باسم الجدول)
+    if not user_is_owner(message.from_user.id):
+        return await message.answer("🚫 هذا الأمر للمالك فقط.")
+    doc = message.reply_to_message.document if message.reply_to_message else None
+    if doc is None:
+        return await message.answer("أرسل /import ردًا على ملف التصدير.")
+    task = dp.get("dump_task")
+    if task is not None and not task.done():
+        return await message.answer("⏳ تصدير أو استيراد قيد التشغيل بالفعل.")
+    # المسار ثابت لكل ملف فيُستأنف الاستيراد نفسه إن أُعيد الأمر، والاسم الأصلي يحدد جدول CSV
+    folder = os.path.join(EXPORT_DIR, f"import-{doc.file_unique_id}")
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, os.path.basename(doc.file_name or "catalog.jsonl.gz"))
+    status = await message.answer("📥 تنزيل الملف…")
+    progress = _thread_progress(status, lambda st: f"📥 استُورد {st['rows']} صف (جديد {st['inserted']}) • {st['rate']:.0f} صف/ث")
+    async def run():
+        try:
+            if not os.path.exists(path):
+                await bot.download_file_by_id(doc.file_id, destination=path)
+            st = await _run_in_thread(import_catalog, path, None, progress)
+        except Exception:
+            logging.exception("import: فشل الاستيراد")
+            return await message.answer("⚠️ توقف الاستيراد، أعد الأمر على الملف نفسه للاستئناف.")
+        finally:
+            # الاستيراد يكتب على اتصاله الخاص لا عبر الكاتب، فتُرفع الأجيال هنا (ولو جزئيًا)
+            catalog_committed(set(CAT_TYPES))
+        if st["done_before"]:
+            return await message.answer("ℹ️ هذا الملف استُورد من قبل.")
+        await message.answer(f"✅ استُورد {st['rows']} صف (جديد {st['inserted']}) في {st['seconds']:.1f}ث "
+                             f"({st['rate']:.0f} صف/ث)" + (f"، استئناف من السطر {st['resumed_from']}" if st["resumed_from"] else ""))
+    dp["dump_task"] = asyncio.ensure_future(run())
+
+def catalog_cli(argv: list):
+    ap = argparse.ArgumentParser(prog="bot.py", description="تصدير/استيراد الكتالوج (JSONL/CSV، ‎.gz للضغط)")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    ex = sub.add_parser("export")
+    ex.add_argument("path")
+    ex.add_argument("--tables", default="users,items")
+    im = sub.add_parser("import")
+    im.add_argument("path")
+    im.add_argument("--table", help="لملفات CSV إن لم يبدأ الاسم باسم الجدول")
+    im.add_argument("--restart", action="store_true", help="تجاهل نقطة الاستئناف")
+    args = ap.parse_args(argv)
+    def show(st):
+        print(f"\r{st['rows']} rows  {st['rate']:.0f} rows/s", end="", file=sys.stderr, flush=True)
+    if args.cmd == "export":
+        st = export_catalog(args.path, tuple(args.tables.split(",")), show)
+    else:
+        st = import_catalog(args.path, args.table, show, args.restart)
+    print(file=sys.stderr)
+    print(json.dumps(st, ensure_ascii=False))
+
+# ================== فحص خطط الاستعلامات ==================
+# python bot.py check-plans: يطبّق الترحيلات ثم يعرض EXPLAIN QUERY PLAN لكل استعلام في
+# HOT_SQL، ويخرج بـ 1 إن مسح أحدها جدولًا كاملًا (SCAN بلا فهرس) أو رتّب في جدول
+# مؤقت (TEMP B-TREE)، فيصلح للتشغيل في CI بعد أي تغيير على المخطط أو الاستعلامات.
+def explain(con: sqlite3.Connection, sql: str) -> list:
+    # القيم لا تغيّر الخطة، فـ NULL لكل معامل
+    return [row[3] for row in con.execute("EXPLAIN QUERY PLAN " + sql, (None,) * sql.count("?"))]
+
+def plan_problem(detail: str) -> bool:
+    return (detail.startswith("SCAN ") and "VIRTUAL TABLE" not in detail
+            and "USING" not in detail) or "TEMP B-TREE" in detail
+
+def check_plans() -> int:
+    con = db_connect()
+    failed = 0
+    print(f"schema version {schema_version(con)}, {len(HOT_SQL)} hot queries")
+    for name, sql in HOT_SQL.items():
+        details = explain(con, sql)
+        bad = [d for d in details if plan_problem(d)]
+        failed += bool(bad)
+        print(f"{'FAIL' if bad else 'ok':4}  {name}")
+        for d in details:
+            print(f"{'!' if d in bad else ' ':>6} {d}")
+    con.close()
+    return 1 if failed else 0
+
 # ================== بدء التشغيل ==================
+async def on_startup(dp: Dispatcher):
+    dp.storage.start()
+    for is_owner in (False, True):
+        send_main_menu(is_owner)
+    for cat_type in CAT_TYPES:
+        category_menu(cat_type)
+    # المهام الدورية المشتركة على القاعدة تعمل في عملية واحدة فقط (العامل 0)
+    if WORKER_INDEX in (None, 0):
+        outbox.start()
+        dp["counters_task"] = asyncio.ensure_future(counters_job())
+        if TRASH_RETENTION_DAYS > 0:
+            dp["trash_sweeper"] = asyncio.ensure_future(trash_sweeper())
+        if ARCHIVE_AFTER_DAYS > 0:
+            dp["archive_task"] = asyncio.ensure_future(archiver())
+        await broadcast_resume()
+    if METRICS_PORT:
+        dp["metrics_runner"] = await metrics_serve()
+
+async def on_shutdown(dp: Dispatcher):
+    # الألبومات في نافذة التجميع أُقرّت تحديثاتها، فتُحفظ الآن ولا تضيع مع الإيقاف
+    for gid in list(_albums):
+        _albums[gid]["timer"].cancel()
+        await album_flush(gid)
+    await followups.flush_all()
+    for name in ("counters_task", "trash_sweeper", "archive_task", "purge_task", "dedup_task", "dump_task"):
+        if dp.get(name):
+            dp[name].cancel()
+    if dp.get("metrics_runner"):
+        await dp["metrics_runner"].cleanup()
+    if dp.get("broadcast"):
+        await dp["broadcast"].stop()
+    await outbox.stop()
+    await dp.storage.close()
+    db.close()
+
+# ================== وضع Webhook ==================
+# بديل للاستطلاع: خادم aiohttp يستقبل التحديثات من تيليجرام ويرد فورًا، والمعالجة
+# بالتوازي في الخلفية. تحديثات المستخدم الواحد تُعالج بترتيب وصولها (سلسلة لكل
+# مستخدم/محادثة)، والتوازي الكلي محدود بـ UPDATE_CONCURRENCY، وما زاد عن
+# UPDATE_QUEUE_MAX يُرد بـ 503 فيعيد تيليجرام إرساله لاحقًا. عند الإيقاف يُغلق
+# الاستقبال وتكتمل التحديثات الجارية خلال WEBHOOK_DRAIN_TIMEOUT.
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")                        # مثل https://bot.example.com ؛ فارغ = استطلاع
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")                  # يُطابق مع ترويسة X-Telegram-Bot-Api-Secret-Token
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))
+UPDATE_QUEUE_MAX = int(os.getenv("UPDATE_QUEUE_MAX", "2000"))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "30"))
+
+_UPDATE_FIELDS = ("message", "edited_message", "callback_query", "inline_query", "chosen_inline_result",
+                  "channel_post", "edited_channel_post", "shipping_query", "pre_checkout_query",
+                  "poll_answer", "my_chat_member", "chat_member", "chat_join_request")
+
+def update_key(data: dict) -> Optional[int]:
+    # مفتاح الترتيب من JSON التحديث الخام: المستخدم إن وُجد وإلا المحادثة؛ None = لا ترتيب مطلوب
+    for name in _UPDATE_FIELDS:
+        obj = data.get(name)
+        if obj is None:
+            continue
+        user = obj.get("from") or obj.get("user")
+        if user is not None:
+            return user["id"]
+        chat = obj.get("chat")
+        return chat["id"] if chat is not None else None
+    return None
+
+class UpdateScheduler:
+    def __init__(self, dispatcher: Dispatcher, limit: int, queue_max: int):
+        self.dp = dispatcher
+        self.queue_max = queue_max
+        self.closing = False
+        self._sem = asyncio.Semaphore(limit)
+        self._tails: dict = {}     # key -> آخر مهمة لهذا المستخدم
+        self._tasks: set = set()
+
+    @property
+    def pending(self) -> int:
+        return len(self._tasks)
+
+    def submit(self, data: dict):
+        key = update_key(data)
+        prev = self._tails.get(key) if key is not None else None
+        task = asyncio.ensure_future(self._run(data, prev))
+        self._tasks.add(task)
+        if key is not None:
+            self._tails[key] = task
+        task.add_done_callback(lambda t: self._done(t, key))
+
+    def _done(self, task: asyncio.Task, key):
+        self._tasks.discard(task)
+        if key is not None and self._tails.get(key) is task:
+            del self._tails[key]
+
+    async def _run(self, data: dict, prev: Optional[asyncio.Task]):
+        if prev is not None:
+            # ينتظر سابقه دون أن يأخذ مقعدًا من حد التوازي
+            await asyncio.wait([prev])
+        async with self._sem:
+            try:
+                await self.dp.updates_handler.notify(types.Update(**data))
+            except Exception:
+                logging.exception("webhook: فشلت معالجة التحديث %s", data.get("update_id"))
+
+    async def drain(self, timeout: float) -> int:
+        # يعيد عدد التحديثات التي لم تكتمل خلال المهلة (تُلغى)
+        if not self._tasks:
+            return 0
+        _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+        for t in pending:
+            t.cancel()
+        return len(pending)
+
+class WebhookServer:
+    def __init__(self, host: str, port: int, path: str):
+        self.host, self.port, self.path = host, port, path
+        self.scheduler: Optional[UpdateScheduler] = None
+        self._runner: Optional[web.AppRunner] = None
+        self._site: Optional[web.TCPSite] = None
+
+    def _rejected(self, data: dict) -> Optional[str]:
+        if self.scheduler.closing:
+            return "draining"
+        if self.scheduler.pending >= self.scheduler.queue_max:
+            return "busy"
+        return None
+
+    def _submit(self, data: dict):
+        self.scheduler.submit(data)
+
+    async def _handle(self, request: web.Request):
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        # جسم غير JSON أو ليس كائنًا: 400 بدل خطأ 500 يعيد تيليجرام إرساله بلا فائدة
+        try:
+            data = await request.json()
+        except (ValueError, ContentTypeError):   # JSONDecodeError وترميز غير صالح كلاهما ValueError
+            return web.Response(status=400)
+        if not isinstance(data, dict):
+            return web.Response(status=400)
+        reason = self._rejected(data)
+        if reason:
+            metrics.inc("bot_webhook_rejected_total", reason)
+            return web.Response(status=503)
+        self._submit(data)
+        return web.Response()
+
+    async def start(self):
+        Bot.set_current(bot)
+        Dispatcher.set_current(dp)
+        self.scheduler = UpdateScheduler(dp, UPDATE_CONCURRENCY, UPDATE_QUEUE_MAX)
+        await self._listen()
+
+    async def _listen(self):
+        app = web.Application()
+        app.router.add_post(self.path, self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        self._site = web.TCPSite(self._runner, self.host, self.port)
+        await self._site.start()
+
+    async def stop(self, timeout: float) -> int:
+        self.scheduler.closing = True
+        await self._site.stop()
+        left = await self.scheduler.drain(timeout)
+        await self._runner.cleanup()
+        return left
+
+async def set_webhook(max_connections: int):
+    await bot.set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                          max_connections=min(100, max_connections))
+    logging.info("webhook: يستقبل على %s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+
+async def wait_for_signal():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+async def run_webhook():
+    server = WebhookServer(WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+    await on_startup(dp)
+    await server.start()
+    await set_webhook(UPDATE_CONCURRENCY)
+    await wait_for_signal()
+    # الـ webhook يبقى مسجّلًا: تيليجرام يحتفظ بالتحديثات الجديدة حتى يعود البوت
+    logging.info("webhook: إيقاف، إكمال %d تحديث جارٍ", server.scheduler.pending)
+    left = await server.stop(WEBHOOK_DRAIN_TIMEOUT)
+    if left:
+        logging.warning("webhook: أُلغي %d تحديث بعد انتهاء مهلة الإيقاف", left)
+    await on_shutdown(dp)
+    await (await bot.get_session()).close()
+
+# ================== العمال المتعددون ==================
+# WORKERS > 1: عملية مشرفة تستقبل التحديثات (استطلاعًا أو webhook) دون أن تعالجها،
+# وتوزعها على WORKERS عملية عاملة حسب update_key % WORKERS، فتصل كل تحديثات
+# المستخدم الواحد إلى العامل نفسه وبترتيبها (وحالته في SQLiteStorage لا يكتبها
+# غيره). كل عامل يعالج بـ UpdateScheduler ويتصل ببوت API مباشرة، والقاعدة مشتركة:
+# WAL + BEGIN IMMEDIATE + DB_BUSY_TIMEOUT. المهام الدورية (الصندوق، العدادات،
+# الكنس) في العامل 0 فقط، وما يرسله العمال عبر notify_workers يعيد المشرف بثه
+# لبقية العمال. العامل الذي يتوقف يُعاد تشغيله.
+WORKERS = int(os.getenv("WORKERS", "1"))
+WORKER_INBOX_MAX = 2          # دفعات getUpdates المنتظرة لدى العامل قبل أن يتمهل الاستطلاع
+WORKER_RESTART_DELAY = 1.0
+
+def _inbox_get(inbox):
+    # ينتهي العامل وحده إن مات المشرف دون أن يرسل stop
+    parent = multiprocessing.parent_process()
+    while True:
+        try:
+            return inbox.get(timeout=1)
+        except queue.Empty:
+            if parent is not None and not parent.is_alive():
+                return ("stop",)
+
+async def worker_serve(index: int, inbox, bus):
+    global WORKER_INDEX, _worker_bus
+    WORKER_INDEX, _worker_bus = index, bus
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    await on_startup(dp)
+    scheduler = UpdateScheduler(dp, UPDATE_CONCURRENCY, UPDATE_QUEUE_MAX)
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(1, thread_name_prefix="worker-inbox") as reader:
+        while True:
+            msg = await loop.run_in_executor(reader, _inbox_get, inbox)
+            if msg[0] == "updates":
+                for data in msg[1]:
+                    scheduler.submit(data)
+                # لا يسحب المزيد من الطابور حتى ينخفض الجاري
+                while scheduler.pending >= scheduler.queue_max:
+                    await asyncio.sleep(0.01)
+            elif msg[0] == "notify":
+                NOTIFY_HANDLERS[msg[1]](msg[2])
+            else:
+                break
+    left = await scheduler.drain(WEBHOOK_DRAIN_TIMEOUT)
+    if left:
+        logging.warning("worker %d: أُلغي %d تحديث بعد انتهاء مهلة الإيقاف", index, left)
+    await on_shutdown(dp)
+    await (await bot.get_session()).close()
+
+def worker_main(index: int, inbox, bus):
+    # Ctrl+C يصل مجموعة العمليات كلها، والإيقاف يديره المشرف
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.info("worker %d: بدأ (pid %d)", index, os.getpid())
+    asyncio.run(worker_serve(index, inbox, bus))
+
+class Supervisor:
+    def __init__(self, workers: int):
+        self.n = workers
+        self.closing = False
+        self._ctx = multiprocessing.get_context("spawn")
+        self.inboxes = [self._ctx.Queue() for _ in range(workers)]
+        self.bus = self._ctx.Queue()
+        self.procs: list = [None] * workers
+        self._rr = 0
+
+    def _spawn(self, index: int):
+        proc = self._ctx.Process(target=worker_main, args=(index, self.inboxes[index], self.bus),
+                                 name=f"worker-{index}")
+        proc.start()
+        self.procs[index] = proc
+
+    def start(self):
+        for i in range(self.n):
+            self._spawn(i)
+
+    def shard(self, data: dict) -> int:
+        key = update_key(data)
+        if key is None:
+            self._rr += 1
+            return self._rr % self.n
+        return key % self.n
+
+    def backlog(self, index: Optional[int] = None) -> int:
+        if index is not None:
+            return self.inboxes[index].qsize()
+        return max(q.qsize() for q in self.inboxes)
+
+    def route(self, updates: list):
+        batches = [[] for _ in range(self.n)]
+        for data in updates:
+            batches[self.shard(data)].append(data)
+        for inbox, batch in zip(self.inboxes, batches):
+            if batch:
+                inbox.put(("updates", batch))
+
+    async def relay(self):
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(1, thread_name_prefix="supervisor-bus") as reader:
+            while True:
+                msg = await loop.run_in_executor(reader, self.bus.get)
+                if msg[0] != "notify":
+                    return
+                for i, inbox in enumerate(self.inboxes):
+                    if i != msg[3]:
+                        inbox.put(msg[:3])
+
+    async def monitor(self):
+        while not self.closing:
+            await asyncio.sleep(WORKER_RESTART_DELAY)
+            for i, proc in enumerate(self.procs):
+                if not self.closing and not proc.is_alive():
+                    logging.error("worker %d: توقف (exit %s)، إعادة تشغيل", i, proc.exitcode)
+                    self._spawn(i)
+
+    async def poll(self):
+        # getUpdates خام: التحديثات تُمرر للعمال JSON كما وصلت دون تحليلها هنا
+        await dp.skip_updates()
+        offset = None
+        while True:
+            while self.backlog() >= WORKER_INBOX_MAX:
+                await asyncio.sleep(0.05)
+            payload = {"timeout": 20, "limit": 100}
+            if offset is not None:
+                payload["offset"] = offset
+            try:
+                updates = await bot.request("getUpdates", payload)
+            except Exception:
+                logging.exception("supervisor: فشل getUpdates")
+                await asyncio.sleep(1)
+                continue
+            if updates:
+                offset = updates[-1]["update_id"] + 1
+                self.route(updates)
+
+    async def stop(self, timeout: float):
+        self.closing = True
+        for inbox in self.inboxes:
+            inbox.put(("stop",))
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + timeout + 10
+        for i, proc in enumerate(self.procs):
+            await loop.run_in_executor(None, proc.join, max(0.0, deadline - time.monotonic()))
+            if proc.is_alive():
+                logging.warning("worker %d: لم يتوقف في المهلة، إنهاء", i)
+                proc.terminate()
+        self.bus.put(("stop",))
+
+class ShardedWebhookServer(WebhookServer):
+    # استقبال المشرف: يمرر كل تحديث لعامله فورًا، والتصريف عند الإيقاف يتم في العمال
+    def __init__(self, host: str, port: int, path: str, supervisor: Supervisor):
+        super().__init__(host, port, path)
+        self.supervisor = supervisor
+
+    def _rejected(self, data: dict) -> Optional[str]:
+        if self.supervisor.closing:
+            return "draining"
+        if self.supervisor.backlog(self.supervisor.shard(data)) >= UPDATE_QUEUE_MAX:
+            return "busy"
+        return None
+
+    def _submit(self, data: dict):
+        self.supervisor.route([data])
+
+    async def start(self):
+        await self._listen()
+
+    async def stop(self, timeout: float) -> int:
+        await self._site.stop()
+        await self._runner.cleanup()
+        return 0
+
+async def run_supervisor():
+    supervisor = Supervisor(WORKERS)
+    supervisor.start()
+    tasks = [asyncio.ensure_future(supervisor.relay()), asyncio.ensure_future(supervisor.monitor())]
+    server = None
+    if WEBHOOK_URL:
+        server = ShardedWebhookServer(WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, supervisor)
+        await server.start()
+        await set_webhook(UPDATE_CONCURRENCY * WORKERS)
+    else:
+        tasks.append(asyncio.ensure_future(supervisor.poll()))
+    logging.info("supervisor: %d عامل", WORKERS)
+    await wait_for_signal()
+    logging.info("supervisor: إيقاف العمال")
+    supervisor.closing = True
+    if server is not None:
+        await server.stop(0)
+    for t in tasks[1:]:
+        t.cancel()
+    await supervisor.stop(WEBHOOK_DRAIN_TIMEOUT)
+    await tasks[0]
+    await (await bot.get_session()).close()
+
 if __name__ == "__main__":
+    if sys.argv[1:2] in (["export"], ["import"]):
+        raise SystemExit(catalog_cli(sys.argv[1:]))
+    if sys.argv[1:2] == ["check-plans"]:
+        raise SystemExit(check_plans())
     if API_TOKEN == "ضع_توكن_البوت_هنا":
         raise SystemExit("رجاء ضع توكن البوت في API_TOKEN أو BOT_TOKEN env.")
-    executor.start_polling(dp, skip_updates=True)
\ No newline at end of file
+    if WORKERS > 1:
+        asyncio.run(run_supervisor())
+    elif WEBHOOK_URL:
+        asyncio.run(run_webhook())
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
\ No newline at end of file